@@ -11,10 +11,25 @@ class Config(OscarConfig):
     verbose_name = _("Oscar API-Checkout")
     namespace = "oscarapicheckout"
     default = True
+    default_auto_field = "django.db.models.BigAutoField"
 
     def ready(self) -> None:
+        from django.core.signals import request_started
+
         # Register signal handlers
-        from . import handlers  # NOQA
+        from . import handlers
+
+        request_started.connect(
+            handlers.warm_payment_type_caches,
+            dispatch_uid=handlers.WARM_PAYMENT_TYPE_CACHES_UID,
+        )
+
+        # Import and instantiate the enabled payment methods and fraud rules once, up-front
+        from .fraud import get_enabled_fraud_checks
+        from .registry import get_payment_method_registry
+
+        get_payment_method_registry()
+        get_enabled_fraud_checks()
 
     def get_urls(self) -> list[URLPattern | URLResolver]:
         from .views import (
@@ -1,9 +1,22 @@
+from django.contrib.auth.models import AnonymousUser
 from django.http import HttpRequest
-from oscar.core.loading import get_class
+from oscar.core.loading import get_class, get_model
 
 OrderPlacementMixin = get_class("checkout.mixins", "OrderPlacementMixin")
 
+Order = get_model("order", "Order")
+
 
 class OrderMessageSender(OrderPlacementMixin):
     def __init__(self, request: HttpRequest):
         self.request = request
+
+
+def get_order_message_request(order: Order) -> HttpRequest:
+    """
+    Build a stand-in request for sending order messages when there is no shopper
+    request available, e.g. when a payment is authorized by a gateway webhook.
+    """
+    request = HttpRequest()
+    request.user = order.user or AnonymousUser()
+    return request
@@ -1,8 +1,18 @@
-from collections.abc import Generator
-from datetime import timedelta
+from collections import Counter
+from collections.abc import Iterable, Mapping, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
 from typing import Any, Literal, Protocol
+import hashlib
 import logging
+import threading
+import time
+import uuid
 
+from django import db
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpRequest
 from django.utils import timezone
 from django.utils.module_loading import import_string
@@ -11,12 +21,14 @@ from oscar.core.loading import get_model
 from rest_framework import serializers
 
 from . import settings
+from .models import OrderAddressFingerprint
 
 Order = get_model("order", "Order")
 
 logger = logging.getLogger(__name__)
 
 type CheckoutData = dict[str, Any]
+type AddressType = Literal["shipping_address", "billing_address"]
 
 
 class FraudRule(Protocol):
@@ -28,20 +40,377 @@ class FraudRule(Protocol):
     ) -> None: ...
 
 
-def get_enabled_fraud_checks() -> Generator[FraudRule, None, None]:
-    for config in settings.API_CHECKOUT_FRAUD_CHECKS:
-        RuleClass: type[FraudRule] = import_string(config["rule"])
-        rule = RuleClass(**config.get("kwargs", {}))
-        yield rule
+type FraudRuleOutcome = Literal["passed", "rejected", "error", "timeout"]
 
+EXECUTOR_SEQUENTIAL = "sequential"
+EXECUTOR_CONCURRENT = "concurrent"
 
-def run_enabled_fraud_checks(
+TIMEOUT_POLICY_FAIL_OPEN = "fail_open"
+TIMEOUT_POLICY_FAIL_CLOSED = "fail_closed"
+
+MODE_REJECT = "reject"
+MODE_SCORE = "score"
+
+# Rules run in order of cost: in-memory checks, then database queries, then remote calls
+COST_CHEAP = "cheap"
+COST_MODERATE = "moderate"
+COST_EXPENSIVE = "expensive"
+COST_RANKS = {
+    COST_CHEAP: 0,
+    COST_MODERATE: 1,
+    COST_EXPENSIVE: 2,
+}
+
+
+@dataclass
+class FraudRuleStats:
+    evaluations: int = 0
+    rejections: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    total_duration: float = 0.0
+    max_duration: float = 0.0
+
+
+@dataclass(frozen=True)
+class EnabledFraudRule:
+    rule: FraudRule
+    # What to do when the rule doesn't finish before the deadline, when run concurrently
+    timeout_policy: str = TIMEOUT_POLICY_FAIL_OPEN
+    cost: str = COST_MODERATE
+    # How much the rule's signal counts towards the score, in scoring mode
+    weight: float = 1.0
+
+
+class FraudRuleMetrics:
+    """
+    Default fraud rule metrics hook (``API_CHECKOUT_FRAUD_METRICS``). Keeps
+    per-rule counters in process memory and logs every evaluation at debug
+    level. Subclass it and override ``record`` to send the metrics elsewhere
+    (e.g. statsd).
+    """
+
+    def __init__(self) -> None:
+        self.stats: dict[str, FraudRuleStats] = {}
+        self._lock = threading.Lock()
+
+    def get_rule_name(self, rule: FraudRule) -> str:
+        return f"{rule.__class__.__module__}.{rule.__class__.__qualname__}"
+
+    def record(self, rule: FraudRule, outcome: FraudRuleOutcome, duration: float) -> None:
+        """
+        Record a fraud rule evaluation. A rule which is run concurrently and
+        misses the deadline is recorded twice: first with a ``timeout`` outcome,
+        and then with its real outcome and duration once it finishes.
+        """
+        name = self.get_rule_name(rule)
+        logger.debug("Fraud rule %s %s in %.3fs", name, outcome, duration)
+        with self._lock:
+            stats = self.stats.setdefault(name, FraudRuleStats())
+            if outcome == "timeout":
+                stats.timeouts += 1
+                return
+            stats.evaluations += 1
+            stats.rejections += outcome == "rejected"
+            stats.errors += outcome == "error"
+            stats.total_duration += duration
+            stats.max_duration = max(stats.max_duration, duration)
+
+
+_enabled_fraud_rules: list[EnabledFraudRule] | None = None
+_fraud_metrics: FraudRuleMetrics | None = None
+_fraud_check_executor: ThreadPoolExecutor | None = None
+
+
+def get_enabled_fraud_rules() -> list[EnabledFraudRule]:
+    """
+    Get the fraud rules enabled by ``API_CHECKOUT_FRAUD_CHECKS``, with their
+    configuration, cheapest first. Rules of the same cost keep their configured
+    order. The rules are imported and instantiated once, and shared between
+    checkouts.
+
+    The ``timeout_policy``, ``cost`` and ``weight`` of a rule can be set in its
+    configuration, or else declared as attributes of the rule class.
+    """
+    global _enabled_fraud_rules
+    if _enabled_fraud_rules is None:
+        rules = []
+        configs: list[settings.FraudRuleConfig] = settings.get_setting("API_CHECKOUT_FRAUD_CHECKS")
+        for config in configs:
+            RuleClass: type[FraudRule] = import_string(config["rule"])
+            rule = RuleClass(**config.get("kwargs", {}))
+            cost = config.get("cost", getattr(rule, "cost", COST_MODERATE))
+            if cost not in COST_RANKS:
+                raise ImproperlyConfigured(f"Fraud rule {config['rule']} has an invalid cost {cost!r}. Expected one of: {', '.join(COST_RANKS)}.")
+            rules.append(
+                EnabledFraudRule(
+                    rule=rule,
+                    timeout_policy=config.get("timeout_policy", getattr(rule, "timeout_policy", TIMEOUT_POLICY_FAIL_OPEN)),
+                    cost=cost,
+                    weight=config.get("weight", getattr(rule, "weight", 1.0)),
+                )
+            )
+        _enabled_fraud_rules = sorted(rules, key=lambda enabled: COST_RANKS[enabled.cost])
+    return _enabled_fraud_rules
+
+
+def get_enabled_fraud_checks() -> list[FraudRule]:
+    return [enabled.rule for enabled in get_enabled_fraud_rules()]
+
+
+def get_fraud_metrics() -> FraudRuleMetrics:
+    global _fraud_metrics
+    if _fraud_metrics is None:
+        MetricsClass: type[FraudRuleMetrics] = import_string(settings.get_setting("API_CHECKOUT_FRAUD_METRICS"))
+        _fraud_metrics = MetricsClass()
+    return _fraud_metrics
+
+
+def get_fraud_check_executor() -> ThreadPoolExecutor:
+    global _fraud_check_executor
+    if _fraud_check_executor is None:
+        _fraud_check_executor = ThreadPoolExecutor(
+            max_workers=settings.get_setting("API_CHECKOUT_FRAUD_CHECK_MAX_WORKERS"),
+            thread_name_prefix="oscarapicheckout-fraud",
+        )
+    return _fraud_check_executor
+
+
+def reload_enabled_fraud_checks() -> list[FraudRule]:
+    """
+    Rebuild the enabled fraud rules, metrics hook and thread pool from the settings.
+    """
+    global _enabled_fraud_rules, _fraud_metrics, _fraud_check_executor
+    _enabled_fraud_rules = None
+    _fraud_metrics = None
+    if _fraud_check_executor is not None:
+        _fraud_check_executor.shutdown(wait=False, cancel_futures=True)
+        _fraud_check_executor = None
+    return get_enabled_fraud_checks()
+
+
+def run_fraud_check(
+    rule: FraudRule,
     data: CheckoutData,
     recaptcha_score: float | None = None,
     request: HttpRequest | None = None,
 ) -> None:
-    for rule in get_enabled_fraud_checks():
+    """
+    Run a single fraud rule, recording its duration and outcome with the
+    metrics hook.
+    """
+    outcome: FraudRuleOutcome = "error"
+    started = time.perf_counter()
+    try:
         rule.validate(data, recaptcha_score, request)
+        outcome = "passed"
+    except serializers.ValidationError:
+        outcome = "rejected"
+        raise
+    finally:
+        get_fraud_metrics().record(rule, outcome, time.perf_counter() - started)
+
+
+def _run_fraud_check_in_thread(
+    rule: FraudRule,
+    data: CheckoutData,
+    recaptcha_score: float | None,
+    request: HttpRequest | None,
+) -> None:
+    # Like a request, so that the pooled thread's connections are reused until they're
+    # older than CONN_MAX_AGE (or broken), rather than leaked or reopened for every rule
+    db.close_old_connections()
+    try:
+        run_fraud_check(rule, data, recaptcha_score, request)
+    finally:
+        db.close_old_connections()
+
+
+def run_fraud_checks_concurrently(
+    rules: Sequence[EnabledFraudRule],
+    data: CheckoutData,
+    recaptcha_score: float | None = None,
+    request: HttpRequest | None = None,
+) -> None:
+    """
+    Run the given fraud rules concurrently, in a bounded thread pool, within
+    ``API_CHECKOUT_FRAUD_CHECK_DEADLINE`` seconds.
+
+    As soon as any rule rejects the order (or fails), that error is raised and
+    the rules which haven't started yet are cancelled. Rules which are already
+    running can't be interrupted, so they are left to finish in the background
+    and only the metrics hook sees their results. A rule which doesn't finish
+    before the deadline rejects the order if its ``timeout_policy`` is
+    ``fail_closed``, and is otherwise ignored.
+
+    Rules run in their own threads, and so outside of the checkout's database
+    transaction.
+    """
+    timeout: float = settings.get_setting("API_CHECKOUT_FRAUD_CHECK_DEADLINE")
+    deadline = time.monotonic() + timeout
+    executor = get_fraud_check_executor()
+    futures = {executor.submit(_run_fraud_check_in_thread, enabled.rule, data, recaptcha_score, request): enabled for enabled in rules}
+    pending: set[Future[None]] = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                # Raises the rule's error, if it rejected the order (or failed)
+                future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+    timed_out = [futures[future] for future in pending]
+    metrics = get_fraud_metrics()
+    for enabled in timed_out:
+        metrics.record(enabled.rule, "timeout", timeout)
+        logger.warning("Fraud rule %s didn't finish before the deadline", metrics.get_rule_name(enabled.rule))
+    if any(enabled.timeout_policy == TIMEOUT_POLICY_FAIL_CLOSED for enabled in timed_out):
+        raise serializers.ValidationError(_("Order rejected."))
+
+
+def get_fraud_signal(
+    rule: FraudRule,
+    data: CheckoutData,
+    recaptcha_score: float | None = None,
+    request: HttpRequest | None = None,
+) -> float:
+    """
+    Get a fraud rule's signal, between 0 (legitimate) and 1 (fraudulent), for
+    scoring mode. Rules may implement ``score(data, recaptcha_score, request)``.
+    Otherwise, the signal is 1 if the rule rejects the order and 0 if not.
+    """
+    score = getattr(rule, "score", None)
+    outcome: FraudRuleOutcome = "error"
+    started = time.perf_counter()
+    try:
+        if score is not None:
+            signal = min(max(float(score(data, recaptcha_score, request)), 0.0), 1.0)
+        else:
+            try:
+                rule.validate(data, recaptcha_score, request)
+                signal = 0.0
+            except serializers.ValidationError:
+                signal = 1.0
+        outcome = "rejected" if signal > 0 else "passed"
+        return signal
+    finally:
+        get_fraud_metrics().record(rule, outcome, time.perf_counter() - started)
+
+
+def run_fraud_scoring(
+    rules: Sequence[EnabledFraudRule],
+    data: CheckoutData,
+    recaptcha_score: float | None = None,
+    request: HttpRequest | None = None,
+) -> None:
+    """
+    Sum the weighted signals of the given rules, and reject the order if the
+    total reaches ``API_CHECKOUT_FRAUD_SCORE_THRESHOLD``. Stops as soon as the
+    threshold is crossed, or as soon as the remaining rules can no longer
+    cross it.
+    """
+    threshold: float = settings.get_setting("API_CHECKOUT_FRAUD_SCORE_THRESHOLD")
+    remaining_weight = sum(enabled.weight for enabled in rules)
+    total = 0.0
+    for enabled in rules:
+        if total + remaining_weight < threshold:
+            return
+        total += enabled.weight * get_fraud_signal(enabled.rule, data, recaptcha_score, request)
+        remaining_weight -= enabled.weight
+        if total >= threshold:
+            logger.info("Rejected order due to fraud score %.2f", total)
+            raise serializers.ValidationError(_("Order rejected."))
+
+
+def run_enabled_fraud_checks(
+    data: CheckoutData,
+    recaptcha_score: float | None = None,
+    request: HttpRequest | None = None,
+) -> None:
+    rules = get_enabled_fraud_rules()
+    if settings.get_setting("API_CHECKOUT_FRAUD_CHECK_MODE") == MODE_SCORE:
+        run_fraud_scoring(rules, data, recaptcha_score, request)
+        return
+    if settings.get_setting("API_CHECKOUT_FRAUD_CHECK_EXECUTOR") == EXECUTOR_CONCURRENT:
+        # Cheap rules aren't worth a thread, and can reject the order before any expensive rule starts
+        cheap_rules = [enabled for enabled in rules if enabled.cost == COST_CHEAP]
+        for enabled in cheap_rules:
+            run_fraud_check(enabled.rule, data, recaptcha_score, request)
+        run_fraud_checks_concurrently(
+            [enabled for enabled in rules if enabled.cost != COST_CHEAP],
+            data,
+            recaptcha_score,
+            request,
+        )
+        return
+    for enabled in rules:
+        run_fraud_check(enabled.rule, data, recaptcha_score, request)
+
+
+class RecaptchaScore:
+    """
+    Built-in example of a cheap, in-memory fraud check. Rejects new orders if the
+    reCAPTCHA score is below ``min_score``. Orders without a score (e.g. when
+    reCAPTCHA is disabled) are let through.
+    """
+
+    cost = COST_CHEAP
+    min_score: float
+
+    def __init__(self, min_score: float = 0.5) -> None:
+        self.min_score = min_score
+
+    def validate(self, data: CheckoutData, recaptcha_score: float | None, *args: Any, **kwargs: Any) -> None:
+        if recaptcha_score is not None and recaptcha_score < self.min_score:
+            logger.info("Rejected order due to reCAPTCHA score %s", recaptcha_score)
+            raise serializers.ValidationError(_("Order rejected."))
+
+
+ADDRESS_FINGERPRINT_FIELDS = ("line1", "line2", "line3", "line4", "postcode", "country")
+
+
+def get_address_data(address: Any) -> dict[str, Any]:
+    """
+    Get the fields of an order's shipping or billing address which address
+    velocity checks match on.
+    """
+    return {
+        "line1": address.line1,
+        "line2": address.line2,
+        "line3": address.line3,
+        "line4": address.line4,
+        "postcode": address.postcode,
+        "country": address.country_id,
+    }
+
+
+def normalize_address_data(addr_data: Mapping[str, Any]) -> dict[str, str]:
+    """
+    Normalize the fields of an address which address velocity checks match on,
+    upper-casing them and collapsing whitespace.
+
+    Fields missing from ``addr_data`` are normalized as blank, which is how they're
+    saved on the order. Note that this differs from ``AddressVelocity``, which
+    matches any value for a missing field, and compares whitespace exactly.
+    """
+    normalized = {}
+    for field in ADDRESS_FINGERPRINT_FIELDS:
+        value = addr_data.get(field) or ""
+        value = getattr(value, "pk", value)
+        normalized[field] = " ".join(str(value).split()).upper()
+    return normalized
+
+
+def get_address_fingerprint(addr_data: Mapping[str, Any]) -> str:
+    """
+    Hash an address, once normalized by ``normalize_address_data``.
+    """
+    parts = normalize_address_data(addr_data).values()
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
 
 
 class AddressVelocity:
@@ -51,6 +420,7 @@ class AddressVelocity:
     address.
     """
 
+    cost = COST_MODERATE
     period: timedelta
     threshold: int
 
@@ -68,14 +438,22 @@ class AddressVelocity:
 
     def _validate_addr(
         self,
-        addr_type: Literal["shipping_address", "billing_address"],
+        addr_type: AddressType,
         data: CheckoutData,
     ) -> None:
+        address_use_count = self.get_address_use_count(addr_type, data[addr_type])
+        if address_use_count >= self.threshold:
+            logger.info("Rejected order due to address velocity rules")
+            raise serializers.ValidationError(_("Order rejected."))
+
+    def get_address_use_count(self, addr_type: AddressType, addr_data: Mapping[str, Any]) -> int:
+        """
+        Count the orders placed within the period with the given address.
+        """
         timeframe_start = timezone.now() - self.period
         filter_args = {
             "date_placed__gte": timeframe_start,
         }
-        addr_data = data[addr_type]
         for addr_field in ["line1", "line2", "line3", "line4", "postcode"]:
             if addr_field in addr_data:
                 filter_key = f"{addr_type}__{addr_field}__iexact"
@@ -84,7 +462,205 @@ class AddressVelocity:
         if "country" in addr_data:
             filter_args[f"{addr_type}__country"] = addr_data["country"]
 
-        address_use_count = Order.objects.filter(**filter_args).count()
-        if address_use_count >= self.threshold:
-            logger.info("Rejected order due to address velocity rules")
-            raise serializers.ValidationError(_("Order rejected."))
+        return Order.objects.filter(**filter_args).count()
+
+
+class CachedAddressVelocity(AddressVelocity):
+    """
+    Address velocity check which counts orders using time-bucketed counters in
+    the Django cache, keyed by address fingerprint, instead of scanning the
+    orders table. The counters are incremented when orders are placed (see
+    ``record_order_addresses``), and checking an address only has to sum the
+    buckets covering the period. Since whole buckets are summed, the period is
+    effectively rounded up to a multiple of ``bucket_size``.
+
+    The first time an address is checked, or once its counters expired or were
+    evicted, its orders are counted in the database instead, and its counters are
+    seeded with the result. Each seeding starts a new generation of the address'
+    counters, so that counters left over from an earlier generation are never summed.
+    Addresses are matched by fingerprint (see ``get_address_fingerprint``) in both
+    cases, like ``IndexedAddressVelocity``.
+    """
+
+    bucket_size: timedelta
+
+    def __init__(
+        self,
+        period: timedelta | None = None,
+        threshold: int = 10,
+        bucket_size: timedelta | None = None,
+    ) -> None:
+        super().__init__(period=period, threshold=threshold)
+        self.bucket_size = bucket_size or timedelta(minutes=15)
+
+    @property
+    def cache_key_prefix(self) -> str:
+        period = int(self.period.total_seconds())
+        bucket_size = int(self.bucket_size.total_seconds())
+        return f"oscarapicheckout.fraud.{self.__class__.__name__}.{period}.{bucket_size}"
+
+    @property
+    def cache_timeout(self) -> int:
+        return int((self.period + self.bucket_size).total_seconds())
+
+    def get_bucket(self, when: datetime) -> int:
+        return int(when.timestamp() // self.bucket_size.total_seconds())
+
+    def get_bucket_start(self, bucket: int) -> datetime:
+        return datetime.fromtimestamp(bucket * self.bucket_size.total_seconds(), tz=UTC)
+
+    def get_generation_cache_key(self, addr_type: str, fingerprint: str) -> str:
+        return f"{self.cache_key_prefix}.{addr_type}.{fingerprint}"
+
+    def get_bucket_cache_key(self, addr_type: str, fingerprint: str, generation: str, bucket: int) -> str:
+        return f"{self.cache_key_prefix}.{addr_type}.{fingerprint}.{generation}.{bucket}"
+
+    def record_order(self, order: Order, previous: Iterable[OrderAddressFingerprint] = ()) -> None:
+        """
+        Increment the counters for the order's shipping and billing addresses.
+        When an existing order is updated, pass the address fingerprints it had
+        before the update (see ``get_order_address_fingerprints``), so that the
+        order is no longer counted against its previous addresses.
+        """
+        for fingerprint in previous:
+            self._add_to_counter(fingerprint, -1)
+        for fingerprint in get_order_address_fingerprints(order):
+            self._add_to_counter(fingerprint, 1)
+
+    def _add_to_counter(self, fingerprint: OrderAddressFingerprint, delta: int) -> None:
+        generation_key = self.get_generation_cache_key(fingerprint.address_type, fingerprint.fingerprint)
+        generation = cache.get(generation_key)
+        if generation is None:
+            # The address isn't being counted in the cache, so it will be counted in the database
+            # (including this order) when it's next checked
+            return
+        bucket = self.get_bucket(fingerprint.date_placed)
+        key = self.get_bucket_cache_key(fingerprint.address_type, fingerprint.fingerprint, generation, bucket)
+        if delta < 0:
+            try:
+                cache.decr(key, -delta)
+            except ValueError:
+                # The counter already expired, so there's nothing to take the order off
+                pass
+            return
+        cache.add(key, 0, self.cache_timeout)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # The counter expired or was evicted since it was added
+            cache.set(key, delta, self.cache_timeout)
+        # Keep counting the address in the cache for as long as it's being used
+        cache.touch(generation_key, self.cache_timeout)
+
+    def get_address_use_count(self, addr_type: AddressType, addr_data: Mapping[str, Any]) -> int:
+        now = timezone.now()
+        first_bucket = self.get_bucket(now - self.period)
+        fingerprint = get_address_fingerprint(addr_data)
+        generation = cache.get(self.get_generation_cache_key(addr_type, fingerprint))
+        if generation is None:
+            return self.seed_counters(addr_type, addr_data, first_bucket)
+        keys = [self.get_bucket_cache_key(addr_type, fingerprint, generation, bucket) for bucket in range(first_bucket, self.get_bucket(now) + 1)]
+        return sum(cache.get_many(keys).values())
+
+    def seed_counters(self, addr_type: AddressType, addr_data: Mapping[str, Any], first_bucket: int) -> int:
+        """
+        Count the orders placed with the given address since the start of
+        ``first_bucket`` in the database, and start a new generation of the
+        address' counters from the result. Returns the number of orders.
+        """
+        fingerprint = get_address_fingerprint(addr_data)
+        normalized = normalize_address_data(addr_data)
+        filter_args: dict[str, Any] = {
+            "date_placed__gte": self.get_bucket_start(first_bucket),
+        }
+        # Only orders whose address contains every word of the address can have the same
+        # fingerprint, so narrow the orders down to those before comparing fingerprints.
+        for addr_field in ["line1", "line2", "line3", "line4", "postcode"]:
+            words = normalized[addr_field].split()
+            if words:
+                filter_args[f"{addr_type}__{addr_field}__icontains"] = max(words, key=len)
+        orders = Order.objects.filter(**filter_args).values_list(
+            "date_placed",
+            *(f"{addr_type}__{addr_field}" for addr_field in ADDRESS_FINGERPRINT_FIELDS),
+        )
+        counts: Counter[int] = Counter()
+        for date_placed, *values in orders.iterator():
+            if get_address_fingerprint(dict(zip(ADDRESS_FINGERPRINT_FIELDS, values, strict=True))) == fingerprint:
+                counts[self.get_bucket(date_placed)] += 1
+
+        generation = uuid.uuid4().hex
+        # If another request seeded the counters first, leave its generation in place
+        if cache.add(self.get_generation_cache_key(addr_type, fingerprint), generation, self.cache_timeout):
+            cache.set_many(
+                {self.get_bucket_cache_key(addr_type, fingerprint, generation, bucket): count for bucket, count in counts.items()},
+                self.cache_timeout,
+            )
+        return counts.total()
+
+
+def get_order_address_fingerprints(order: Order) -> list[OrderAddressFingerprint]:
+    """
+    Build (but don't save) the address fingerprint rows of an order.
+    """
+    fingerprints = []
+    addresses: list[tuple[AddressType, Any]] = [
+        ("shipping_address", order.shipping_address),
+        ("billing_address", order.billing_address),
+    ]
+    for addr_type, address in addresses:
+        if address is None:
+            continue
+        fingerprints.append(
+            OrderAddressFingerprint(
+                order=order,
+                address_type=addr_type,
+                fingerprint=get_address_fingerprint(get_address_data(address)),
+                date_placed=order.date_placed,
+            )
+        )
+    return fingerprints
+
+
+class IndexedAddressVelocity(AddressVelocity):
+    """
+    Address velocity check which counts orders using the indexed
+    ``OrderAddressFingerprint`` table, instead of matching address fields
+    case-insensitively. Fingerprints are saved while this rule is enabled, when
+    orders are placed or updated. Run the ``backfill_address_fingerprints``
+    management command after enabling this rule, so that orders placed before
+    it was enabled are counted too.
+
+    Addresses are matched by fingerprint (see ``get_address_fingerprint``), so
+    unlike ``AddressVelocity``, addresses which only differ in whitespace are
+    counted together, and fields missing from the checked address only match
+    blank fields.
+    """
+
+    def get_address_use_count(self, addr_type: AddressType, addr_data: Mapping[str, Any]) -> int:
+        return OrderAddressFingerprint.objects.filter(
+            fingerprint=get_address_fingerprint(addr_data),
+            address_type=addr_type,
+            date_placed__gte=timezone.now() - self.period,
+        ).count()
+
+
+def is_fraud_check_enabled(rule_class: type[Any]) -> bool:
+    """
+    Check whether a rule of the given class (or a subclass of it) is enabled.
+    """
+    return any(isinstance(rule, rule_class) for rule in get_enabled_fraud_checks())
+
+
+def record_order_addresses(order: Order, previous: Iterable[OrderAddressFingerprint] = ()) -> None:
+    """
+    Increment the address counters of every enabled ``CachedAddressVelocity``
+    rule for a newly placed (or updated) order. Rules which share counters are
+    only incremented once. See ``CachedAddressVelocity.record_order`` for
+    ``previous``.
+    """
+    previous = list(previous)
+    recorded = set()
+    for rule in get_enabled_fraud_checks():
+        if isinstance(rule, CachedAddressVelocity) and rule.cache_key_prefix not in recorded:
+            rule.record_order(order, previous=previous)
+            recorded.add(rule.cache_key_prefix)
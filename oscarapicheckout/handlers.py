@@ -1,29 +1,75 @@
 from typing import Any
 import logging
 
-from django.db import transaction
+from django.core.signals import request_started, setting_changed
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.dispatch import receiver
 from django.http import HttpRequest
+from oscar.apps.order.signals import order_placed as oscar_order_placed
 from oscar.apps.order.signals import order_status_changed
 from oscar.core.loading import get_model
 
-from .email import OrderMessageSender
+from . import fraud, registry
+from . import settings as pkgsettings
+from .email import OrderMessageSender, get_order_message_request
+from .methods import payment_event_types, source_types
+from .models import OrderAddressFingerprint
 from .settings import ORDER_STATUS_PAYMENT_DECLINED
-from .signals import order_payment_authorized
+from .signals import order_payment_authorized, order_updated
 
 Order = get_model("order", "Order")
+PaymentEventType = get_model("order", "PaymentEventType")
+SourceType = get_model("payment", "SourceType")
 
 logger = logging.getLogger(__name__)
 
+WARM_PAYMENT_TYPE_CACHES_UID = "oscarapicheckout.handlers.warm_payment_type_caches"
+
 
 @receiver(order_payment_authorized)
 def send_order_confirmation_message(
     sender: type[Any],
     order: Order,
-    request: HttpRequest,
+    request: HttpRequest | None,
+    **kwargs: Any,
+) -> None:
+    if not order.email:
+        # Payment can be authorized by a gateway callback for an order with no one to notify
+        logger.info("Not sending confirmation message for Order[%s], since it has no email address.", order.number)
+        return
+    message_request = request if request is not None else get_order_message_request(order)
+    transaction.on_commit(lambda: OrderMessageSender(message_request).send_order_placed_email(order))
+
+
+@receiver(oscar_order_placed)
+def record_order_address_velocity(
+    sender: type[Any],
+    order: Order,
+    **kwargs: Any,
+) -> None:
+    if fraud.is_fraud_check_enabled(fraud.IndexedAddressVelocity):
+        OrderAddressFingerprint.objects.bulk_create(fraud.get_order_address_fingerprints(order), ignore_conflicts=True)
+    if fraud.is_fraud_check_enabled(fraud.CachedAddressVelocity):
+        transaction.on_commit(lambda: fraud.record_order_addresses(order))
+
+
+@receiver(order_updated)
+def record_updated_order_address_velocity(
+    sender: type[Any],
+    order: Order,
+    previous_order: Order,
     **kwargs: Any,
 ) -> None:
-    transaction.on_commit(lambda: OrderMessageSender(request).send_order_placed_email(order))
+    if fraud.is_fraud_check_enabled(fraud.IndexedAddressVelocity):
+        # The order's addresses and date placed have changed, so replace its fingerprints
+        order.address_fingerprints.all().delete()
+        OrderAddressFingerprint.objects.bulk_create(fraud.get_order_address_fingerprints(order))
+    if fraud.is_fraud_check_enabled(fraud.CachedAddressVelocity):
+        previous = fraud.get_order_address_fingerprints(previous_order)
+        # order_updated is sent inside OrderUpdater's transaction, so only count the order
+        # once it's committed
+        transaction.on_commit(lambda: fraud.record_order_addresses(order, previous=previous))
 
 
 @receiver(order_status_changed)
@@ -56,3 +102,65 @@ def update_basket_status_upon_order_status_change(
         new_status,
     )
     basket.submit()
+
+
+def warm_payment_type_caches(sender: type[Any], **kwargs: Any) -> None:
+    """
+    Load the payment event type and source type caches. Connected to
+    ``request_started`` in ``Config.ready()``, and disconnected after the first
+    request, since the database shouldn't be queried while apps are loading.
+    """
+    request_started.disconnect(dispatch_uid=WARM_PAYMENT_TYPE_CACHES_UID)
+    try:
+        payment_event_types.warm()
+        source_types.warm()
+    except DatabaseError:
+        logger.warning("Failed to warm payment type caches.", exc_info=True)
+
+
+@receiver(post_save, sender=PaymentEventType)
+@receiver(post_delete, sender=PaymentEventType)
+def clear_payment_event_type_cache(sender: type[Any], **kwargs: Any) -> None:
+    payment_event_types.clear()
+
+
+@receiver(post_save, sender=SourceType)
+@receiver(post_delete, sender=SourceType)
+def clear_source_type_cache(sender: type[Any], **kwargs: Any) -> None:
+    source_types.clear()
+
+
+@receiver(post_migrate)
+def clear_payment_type_caches(sender: type[Any], **kwargs: Any) -> None:
+    # Tables are also flushed (without sending delete signals) between transactional tests
+    payment_event_types.clear()
+    source_types.clear()
+
+
+@receiver(setting_changed)
+def reload_fraud_checks_upon_setting_change(
+    sender: type[Any],
+    setting: str,
+    **kwargs: Any,
+) -> None:
+    """
+    Rebuild the fraud rules when their settings are changed with ``override_settings``.
+    The settings themselves are read from ``django.conf.settings`` when they're used.
+    """
+    if not setting.startswith("API_CHECKOUT_FRAUD_") or setting not in pkgsettings.DEFAULTS:
+        return
+    fraud.reload_enabled_fraud_checks()
+
+
+@receiver(setting_changed)
+def reload_payment_method_registry_upon_setting_change(
+    sender: type[Any],
+    setting: str,
+    **kwargs: Any,
+) -> None:
+    """
+    Rebuild the payment method registry when ``API_ENABLED_PAYMENT_METHODS`` is changed
+    with ``override_settings``.
+    """
+    if setting == "API_ENABLED_PAYMENT_METHODS":
+        registry.reload_payment_method_registry()
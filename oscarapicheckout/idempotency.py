@@ -0,0 +1,148 @@
+from collections.abc import Callable
+from typing import Any, TypedDict
+import hashlib
+import json
+import time
+
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from . import settings as pkgsettings
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENT_REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+class IdempotentResponseCacheValue(TypedDict):
+    fingerprint: str
+    status: int
+    data: Any
+
+
+def get_request_scope(request: Request) -> str | None:
+    """
+    Identify the shopper making the request, so that cached responses are never
+    shared between shoppers. Returns ``None`` if the shopper can't be identified.
+    """
+    if request.user.is_authenticated:
+        return f"user-{request.user.pk}"
+    if request.session.session_key:
+        return f"session-{request.session.session_key}"
+    return None
+
+
+def get_request_fingerprint(request: Request) -> str:
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def get_response_cache_value(response: Response, fingerprint: str) -> IdempotentResponseCacheValue:
+    """
+    Build the cache entry used to replay the given response. The response data is
+    stored as rendered JSON, since it may contain objects (e.g. lazy translation
+    strings) which can't be pickled by the cache backend.
+    """
+    return {
+        "fingerprint": fingerprint,
+        "status": response.status_code,
+        "data": json.loads(JSONRenderer().render(response.data)),
+    }
+
+
+class IdempotentRequest:
+    """
+    Ensures that a non-idempotent view (e.g. checkout) does its work only once per
+    client supplied ``Idempotency-Key`` header.
+
+    The first successful response is stored in the cache and replayed to any retry
+    of the same request. While the first request is still being processed, duplicate
+    requests wait for its response instead of doing the work a second time.
+
+    Keys are scoped to the authenticated user, or else the session, so they can't be
+    used to read another shopper's response.
+    """
+
+    poll_interval: float = 0.1
+
+    def __init__(self, request: Request, scope: str, key: str) -> None:
+        self.request = request
+        self.scope = scope
+        self.key = key
+
+    @property
+    def cache_timeout(self) -> int:
+        timeout: int = pkgsettings.get_setting("API_CHECKOUT_IDEMPOTENCY_TTL")
+        return timeout
+
+    @property
+    def wait_timeout(self) -> float:
+        timeout: float = pkgsettings.get_setting("API_CHECKOUT_IDEMPOTENCY_WAIT")
+        return timeout
+
+    @classmethod
+    def from_request(cls, request: Request) -> "IdempotentRequest | None":
+        """
+        Return an ``IdempotentRequest`` for the given request, or ``None`` if the
+        client didn't send an ``Idempotency-Key`` header (or there is nothing to
+        scope the key to).
+        """
+        key = request.headers.get(IDEMPOTENCY_KEY_HEADER, "").strip()
+        scope = get_request_scope(request)
+        if not key or scope is None:
+            return None
+        return cls(request, scope, key)
+
+    @property
+    def cache_key(self) -> str:
+        digest = hashlib.sha256(self.key.encode()).hexdigest()
+        return f"oscarapicheckout.idempotency.{self.request.path}.{self.scope}.{digest}"
+
+    @property
+    def in_flight_cache_key(self) -> str:
+        return f"{self.cache_key}.in-flight"
+
+    def get_fingerprint(self) -> str:
+        return get_request_fingerprint(self.request)
+
+    def run(self, handler: Callable[[], Response]) -> Response:
+        fingerprint = self.get_fingerprint()
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            cached: IdempotentResponseCacheValue | None = cache.get(self.cache_key)
+            if cached is not None:
+                return self._replay(cached, fingerprint)
+            # Claim the key. Only the first of any concurrent duplicates gets to run the handler.
+            if cache.add(self.in_flight_cache_key, fingerprint, self.wait_timeout + 60):
+                try:
+                    return self._run_handler(handler, fingerprint)
+                finally:
+                    cache.delete(self.in_flight_cache_key)
+            if time.monotonic() >= deadline:
+                return Response(
+                    {"non_field_errors": [_("A request with this idempotency key is already being processed.")]},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            time.sleep(self.poll_interval)
+
+    def _run_handler(self, handler: Callable[[], Response], fingerprint: str) -> Response:
+        response = handler()
+        # Only successful responses are stored, so that a failed request can be corrected and retried.
+        if status.is_success(response.status_code):
+            cache.set(self.cache_key, get_response_cache_value(response, fingerprint), self.cache_timeout)
+        return response
+
+    def _replay(self, cached: IdempotentResponseCacheValue, fingerprint: str) -> Response:
+        if cached["fingerprint"] != fingerprint:
+            return Response(
+                {"non_field_errors": [_("This idempotency key was already used for a different request.")]},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        return Response(
+            cached["data"],
+            status=cached["status"],
+            headers={IDEMPOTENT_REPLAYED_HEADER: "true"},
+        )
@@ -0,0 +1,179 @@
+from collections.abc import Callable
+from urllib.parse import urlparse
+import logging
+import time
+import uuid
+
+from django.core.cache import cache
+from django.urls import Resolver404, resolve
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from . import settings as pkgsettings
+from .idempotency import IdempotentResponseCacheValue, get_request_fingerprint, get_request_scope, get_response_cache_value
+from .signals import checkout_lease_acquired, checkout_lease_contended
+
+logger = logging.getLogger(__name__)
+
+COALESCED_HEADER = "Checkout-Coalesced"
+
+
+def get_posted_basket_id(request: Request) -> str | None:
+    """
+    Get the primary key of the basket being checked out from the (un-validated)
+    request body, without querying the database.
+    """
+    basket = request.data.get("basket") if hasattr(request.data, "get") else None
+    if isinstance(basket, int):
+        return str(basket)
+    if not isinstance(basket, str) or not basket:
+        return None
+    if basket.isdigit():
+        return basket
+    try:
+        match = resolve(urlparse(basket).path)
+    except Resolver404:
+        return None
+    pk = match.kwargs.get("pk")
+    return str(pk) if pk is not None else None
+
+
+class BasketCheckoutLease:
+    """
+    Short-lived, cache-backed lease on checking out a basket, taken before the
+    checkout is validated.
+
+    Concurrent checkouts of the same basket by the same shopper (double-clicks,
+    parallel tabs) wait up to ``wait_timeout`` seconds for the lease holder to
+    finish. If the holder succeeded for an identical request, its response is
+    returned. Otherwise (e.g. the holder failed, or its lease expired) the waiter
+    takes over the lease once it's free, or fails with a 409 when the wait times
+    out. Set ``wait_timeout`` to 0 to fail fast.
+
+    Every contended checkout sends the ``checkout_lease_contended`` signal, and
+    every checkout which acquires the lease sends ``checkout_lease_acquired``, so
+    that contention rates can be tracked.
+    """
+
+    result_timeout: int = 60
+    poll_interval: float = 0.1
+
+    def __init__(self, request: Request, scope: str, basket_id: str) -> None:
+        self.request = request
+        self.scope = scope
+        self.basket_id = basket_id
+        self.token = uuid.uuid4().hex
+
+    @property
+    def lease_timeout(self) -> int:
+        timeout: int = pkgsettings.get_setting("API_CHECKOUT_BASKET_LEASE_TIMEOUT")
+        return timeout
+
+    @property
+    def wait_timeout(self) -> float:
+        timeout: float = pkgsettings.get_setting("API_CHECKOUT_BASKET_LEASE_WAIT")
+        return timeout
+
+    @classmethod
+    def from_request(cls, request: Request) -> "BasketCheckoutLease | None":
+        scope = get_request_scope(request)
+        basket_id = get_posted_basket_id(request)
+        if scope is None or basket_id is None:
+            return None
+        return cls(request, scope, basket_id)
+
+    @property
+    def cache_key(self) -> str:
+        return f"oscarapicheckout.leases.{self.__class__.__name__}.{self.scope}.{self.basket_id}"
+
+    def get_result_cache_key(self, token: str) -> str:
+        return f"{self.cache_key}.result.{token}"
+
+    def acquire(self) -> bool:
+        return cache.add(self.cache_key, self.token, self.lease_timeout)
+
+    def release(self) -> None:
+        # Don't release a lease which expired and was then taken by another request
+        if cache.get(self.cache_key) == self.token:
+            cache.delete(self.cache_key)
+
+    def run(self, handler: Callable[[], Response]) -> Response:
+        fingerprint = get_request_fingerprint(self.request)
+        started = time.monotonic()
+        holder: str | None = None
+        while True:
+            if self.acquire():
+                if holder is not None:
+                    # The holder stores its result before releasing the lease, so it may have
+                    # finished since its result was last checked.
+                    response = self._get_holder_response(holder, fingerprint)
+                    if response is not None:
+                        self.release()
+                        self._record_contention("coalesced", started)
+                        return response
+                    self._record_contention("acquired", started)
+                self._record_acquisition(holder is not None, started)
+                try:
+                    return self._run_handler(handler, fingerprint)
+                finally:
+                    self.release()
+
+            holder = cache.get(self.cache_key) or holder
+            if holder is not None:
+                response = self._get_holder_response(holder, fingerprint)
+                if response is not None:
+                    self._record_contention("coalesced", started)
+                    return response
+
+            if time.monotonic() - started >= self.wait_timeout:
+                self._record_contention("rejected", started)
+                return Response(
+                    {"non_field_errors": [_("This basket is already being checked out.")]},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            time.sleep(self.poll_interval)
+
+    def _get_holder_response(self, holder: str, fingerprint: str) -> Response | None:
+        result: IdempotentResponseCacheValue | None = cache.get(self.get_result_cache_key(holder))
+        if result is None or result["fingerprint"] != fingerprint:
+            return None
+        return Response(
+            result["data"],
+            status=result["status"],
+            headers={COALESCED_HEADER: "true"},
+        )
+
+    def _run_handler(self, handler: Callable[[], Response], fingerprint: str) -> Response:
+        response = handler()
+        if status.is_success(response.status_code):
+            cache.set(
+                self.get_result_cache_key(self.token),
+                get_response_cache_value(response, fingerprint),
+                self.result_timeout,
+            )
+        return response
+
+    def _record_acquisition(self, contended: bool, started: float) -> None:
+        checkout_lease_acquired.send(
+            sender=self.__class__,
+            basket_id=self.basket_id,
+            contended=contended,
+            wait_time=time.monotonic() - started,
+        )
+
+    def _record_contention(self, outcome: str, started: float) -> None:
+        wait_time = time.monotonic() - started
+        logger.info(
+            "Checkout of basket %s was contended (outcome=%s, waited=%.3fs)",
+            self.basket_id,
+            outcome,
+            wait_time,
+        )
+        checkout_lease_contended.send(
+            sender=self.__class__,
+            basket_id=self.basket_id,
+            outcome=outcome,
+            wait_time=wait_time,
+        )
@@ -0,0 +1,377 @@
+"""
+Set-based versions of the per-line order placement steps of Oscar's ``OrderCreator``.
+
+Oscar creates each order line, its prices, attributes and discounts, and allocates its
+stock, with a handful of queries per basket line. The helpers here do the same work with
+a fixed number of queries, regardless of the number of lines. The only exception are the
+receivers of the stockrecords' ``pre_save`` and ``post_save`` signals (e.g. Oscar's stock
+alerts), which are still sent once per allocated stockrecord.
+"""
+
+from collections import defaultdict
+from collections.abc import Iterable, Mapping
+from typing import Any
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+from django.db.models import Case, F, Field, IntegerField, Value, When, prefetch_related_objects
+from django.db.models.functions import Coalesce, Least
+from django.db.models.signals import post_save, pre_save
+from oscar.apps.order.exceptions import UnableToPlaceOrder
+from oscar.apps.order.utils import OrderCreator as BaseOrderCreator
+from oscar.core.loading import get_model
+
+Basket = get_model("basket", "Basket")
+BasketLine = get_model("basket", "Line")
+Order = get_model("order", "Order")
+Line = get_model("order", "Line")
+LineAttribute = get_model("order", "LineAttribute")
+LinePrice = get_model("order", "LinePrice")
+OrderDiscount = get_model("order", "OrderDiscount")
+OrderLineDiscount = get_model("order", "OrderLineDiscount")
+StockRecord = get_model("partner", "StockRecord")
+
+# OrderCreator methods which create the models of a single line. If a project overrides
+# any of them, its lines are created one at a time so the customization is honored.
+PER_LINE_METHODS = (
+    "create_line_models",
+    "create_line_price_models",
+    "create_line_attributes",
+    "create_line_discount_models",
+)
+
+
+def get_stock_quantities(lines: Iterable[BasketLine | Line]) -> dict[int, int]:
+    """
+    Sum the quantities of the given basket or order lines per stockrecord, skipping
+    lines of products which don't track stock.
+    """
+    quantities: dict[int, int] = defaultdict(int)
+    for line in lines:
+        if line.product is None or line.stockrecord_id is None:
+            continue
+        product_class = line.product.get_product_class()
+        if product_class is None or not product_class.track_stock:
+            continue
+        quantities[line.stockrecord_id] += line.quantity
+    return dict(quantities)
+
+
+@transaction.atomic(savepoint=False)
+def _update_stock_allocations(quantities: Mapping[int, int], cancel: bool) -> None:
+    if not quantities:
+        return
+    # Lock the rows in primary key order before updating them, so that concurrent checkouts
+    # of overlapping stockrecords can't deadlock.
+    pks = sorted(quantities.keys())
+    stockrecords = list(StockRecord.objects.select_for_update().filter(pk__in=pks).order_by("pk"))
+    using = router.db_for_write(StockRecord)
+
+    # Keep sending the same signals as StockRecord.allocate and StockRecord.cancel_allocation.
+    # Their receivers (e.g. Oscar's stock alerts) therefore still run once per stockrecord.
+    for stockrecord in stockrecords:
+        pre_save.send(sender=StockRecord, instance=stockrecord, created=False, raw=False, using=using)
+
+    quantity = Case(
+        *[When(pk=pk, then=Value(quantities[pk])) for pk in pks],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+    num_allocated = Coalesce(F("num_allocated"), 0)
+    StockRecord.objects.filter(pk__in=pks).update(
+        num_allocated=(num_allocated - Least(num_allocated, quantity)) if cancel else (num_allocated + quantity),
+    )
+
+    allocated = dict(StockRecord.objects.filter(pk__in=pks).values_list("pk", "num_allocated"))
+    for stockrecord in stockrecords:
+        stockrecord.num_allocated = allocated[stockrecord.pk]
+        post_save.send(sender=StockRecord, instance=stockrecord, created=False, raw=False, using=using)
+
+
+def allocate_stock(quantities: Mapping[int, int]) -> None:
+    """
+    Allocate the given quantities of stock (keyed by stockrecord ID) in a single update.
+    """
+    _update_stock_allocations(quantities, cancel=False)
+
+
+def cancel_stock_allocations(quantities: Mapping[int, int]) -> None:
+    """
+    Cancel the allocation of the given quantities of stock (keyed by stockrecord ID) in a
+    single update. Like ``StockRecord.cancel_allocation``, this never cancels more than
+    the quantity currently allocated.
+    """
+    _update_stock_allocations(quantities, cancel=True)
+
+
+def delete_order_lines(order: Order) -> None:
+    """
+    Delete all lines of the given order, cancelling the stock they allocated.
+    """
+    order_lines = order.lines.select_related(
+        "product__product_class",
+        "product__parent__product_class",
+    )
+    cancel_stock_allocations(get_stock_quantities(order_lines))
+    order.lines.all().delete()
+
+
+def get_line_data(basket_line: BasketLine) -> dict[str, Any]:
+    """
+    Field values (besides the order) of the order line for the given basket line, the
+    same as Oscar's ``OrderCreator.create_line_models``.
+    """
+    product = basket_line.product
+    stockrecord = basket_line.stockrecord
+    if not stockrecord:
+        raise UnableToPlaceOrder(f"Basket line #{basket_line.id} has no stockrecord")
+    partner = stockrecord.partner
+    line_data = {
+        # Partner details
+        "partner": partner,
+        "partner_name": partner.name,
+        "partner_sku": stockrecord.partner_sku,
+        "stockrecord": stockrecord,
+        # Product details
+        "product": product,
+        "title": product.get_title(),
+        "upc": product.upc,
+        "quantity": basket_line.quantity,
+        # Price details
+        "line_price_excl_tax": basket_line.line_price_excl_tax_incl_discounts,
+        "line_price_incl_tax": basket_line.line_price_incl_tax_incl_discounts,
+        "line_price_before_discounts_excl_tax": basket_line.line_price_excl_tax,
+        "line_price_before_discounts_incl_tax": basket_line.line_price_incl_tax,
+        # Reporting details
+        "unit_price_incl_tax": basket_line.unit_price_incl_tax,
+        "unit_price_excl_tax": basket_line.unit_price_excl_tax,
+        "tax_code": basket_line.tax_code,
+        "num_allocated": basket_line.quantity,
+    }
+    if hasattr(settings, "OSCAR_INITIAL_LINE_STATUS"):
+        line_data["status"] = settings.OSCAR_INITIAL_LINE_STATUS
+    return line_data
+
+
+def _get_line_match_key(line: BasketLine | Line) -> tuple[Any, ...]:
+    attributes = sorted((attr.option_id, json.dumps(attr.value, sort_keys=True, cls=DjangoJSONEncoder)) for attr in line.attributes.all())
+    return (line.product_id, line.stockrecord_id, tuple(attributes))
+
+
+class PreparedLine:
+    """
+    Everything needed to create the order line for a basket line, besides the order
+    and its discounts.
+    """
+
+    def __init__(self, basket_line: BasketLine) -> None:
+        self.basket_line = basket_line
+        self.data = get_line_data(basket_line)
+        self.match_key = _get_line_match_key(basket_line)
+        self.price_breakdown = basket_line.get_price_breakdown()
+        self.attributes = [(attr.option, attr.option.code, attr.value) for attr in basket_line.attributes.all()]
+
+    def build(self, order: Order) -> Line:
+        return Line(order=order, **self.data)
+
+
+class PreparedOrderLines:
+    """
+    The order lines for a basket, computed before the transaction which writes them is
+    opened, so that as little work as possible happens while rows are locked.
+
+    Projects which customized how ``OrderCreator`` creates lines, or allocates stock, get
+    those steps run the customized way, one line at a time.
+    """
+
+    def __init__(self, creator: BaseOrderCreator, basket_lines: Iterable[BasketLine]) -> None:
+        self.creator = creator
+        self.basket_lines = list(basket_lines)
+        self.bulk_create = all(getattr(type(creator), name) is getattr(BaseOrderCreator, name) for name in PER_LINE_METHODS)
+        self.bulk_allocate = type(creator).update_stock_records is BaseOrderCreator.update_stock_records
+        if self.bulk_create or self.bulk_allocate:
+            _prefetch_basket_lines(self.basket_lines)
+        self.lines = [PreparedLine(basket_line) for basket_line in self.basket_lines] if self.bulk_create else []
+        self.stock_quantities = get_stock_quantities(self.basket_lines) if self.bulk_allocate else {}
+
+    @property
+    def can_reconcile(self) -> bool:
+        return self.bulk_create and self.bulk_allocate
+
+    def create_lines(self, order: Order) -> list[Line]:
+        """
+        Create the order lines, with their prices, attributes and discounts. Doesn't
+        allocate stock; see ``allocate_stock``.
+        """
+        if not self.bulk_create:
+            return [self.creator.create_line_models(order, basket_line) for basket_line in self.basket_lines]
+        return _bulk_create_lines(self.creator, order, self.lines)
+
+    def allocate_stock(self) -> None:
+        if not self.bulk_allocate:
+            for basket_line in self.basket_lines:
+                self.creator.update_stock_records(basket_line)
+            return
+        allocate_stock(self.stock_quantities)
+
+
+def _prefetch_basket_lines(basket_lines: list[BasketLine]) -> None:
+    # Fetch everything the line data is built from up-front, instead of once per line
+    prefetch_related_objects(
+        basket_lines,
+        "stockrecord__partner",
+        "product__product_class",
+        "product__parent__product_class",
+        "attributes__option",
+    )
+
+
+def _create_line_related_models(
+    order: Order,
+    line_pairs: list[tuple[Line, PreparedLine]],
+    with_attributes: bool = True,
+) -> None:
+    # Like OrderCreator.create_line_discount_models, link each line discount to the first
+    # order discount recorded for its offer.
+    order_discounts: dict[int, OrderDiscount] = {}
+    for discount in order.discounts.order_by("pk"):
+        if discount.offer_id is not None:
+            order_discounts.setdefault(discount.offer_id, discount)
+
+    prices = []
+    attributes = []
+    discounts = []
+    for order_line, prepared in line_pairs:
+        for price_incl_tax, price_excl_tax, quantity in prepared.price_breakdown:
+            prices.append(
+                LinePrice(
+                    order=order,
+                    line=order_line,
+                    quantity=quantity,
+                    price_incl_tax=price_incl_tax,
+                    price_excl_tax=price_excl_tax,
+                    tax_code=prepared.basket_line.tax_code,
+                )
+            )
+        if with_attributes:
+            for option, option_code, value in prepared.attributes:
+                attributes.append(LineAttribute(line=order_line, option=option, type=option_code, value=value))
+        for line_discount in prepared.basket_line.discounts:
+            if not line_discount.offer:
+                continue
+            order_discount = order_discounts.get(line_discount.offer.id)
+            if order_discount:
+                discounts.append(
+                    OrderLineDiscount(
+                        line=order_line,
+                        order_discount=order_discount,
+                        is_incl_tax=line_discount.incl_tax,
+                        amount=line_discount.amount,
+                    )
+                )
+    LinePrice._default_manager.bulk_create(prices)
+    LineAttribute._default_manager.bulk_create(attributes)
+    OrderLineDiscount._default_manager.bulk_create(discounts)
+
+
+def _bulk_create_lines(
+    creator: BaseOrderCreator,
+    order: Order,
+    prepared_lines: list[PreparedLine],
+) -> list[Line]:
+    order_lines = Line._default_manager.bulk_create([prepared.build(order) for prepared in prepared_lines])
+    line_pairs = list(zip(order_lines, prepared_lines, strict=True))
+    _create_line_related_models(order, line_pairs)
+    # This hook is meant to be customized per line, so it's always called per line
+    for order_line, prepared in line_pairs:
+        creator.create_additional_line_models(order, order_line, prepared.basket_line)
+    return order_lines
+
+
+def _get_changed_fields(order_line: Line, line_data: Mapping[str, Any]) -> list[str]:
+    changed = []
+    for name, value in line_data.items():
+        field = Line._meta.get_field(name)
+        # Line data only ever holds concrete fields of the line, not reverse relations
+        assert isinstance(field, Field)
+        current = getattr(order_line, field.attname)
+        new = value.pk if field.is_relation and value is not None else value
+        if current != new:
+            changed.append(name)
+    return changed
+
+
+def reconcile_order_lines(prepared_lines: PreparedOrderLines, order: Order) -> None:
+    """
+    Bring the lines of an existing order in line with the prepared basket lines, changing
+    only what differs between them.
+
+    Order lines are matched to basket lines by product, stockrecord and options. Matched
+    lines keep their row and stock allocation; only their changed fields (e.g. quantity
+    or price) are updated, and their stock allocation adjusted by the difference in
+    quantity. Unmatched order lines are deleted and unmatched basket lines get a new
+    order line. Line prices and discounts of every line are re-created, so that they're
+    linked to the order's current discounts.
+
+    Projects which customized how lines are created, or stock is allocated, get all of
+    their order lines replaced instead.
+    """
+    if not prepared_lines.can_reconcile:
+        delete_order_lines(order)
+        prepared_lines.create_lines(order)
+        prepared_lines.allocate_stock()
+        return
+
+    existing_lines: dict[tuple[Any, ...], list[Line]] = defaultdict(list)
+    for order_line in order.lines.select_related(
+        "product__product_class",
+        "product__parent__product_class",
+    ).prefetch_related("attributes"):
+        existing_lines[_get_line_match_key(order_line)].append(order_line)
+
+    kept: list[tuple[Line, PreparedLine]] = []
+    added: list[PreparedLine] = []
+    for prepared in prepared_lines.lines:
+        matches = existing_lines.get(prepared.match_key)
+        if matches:
+            kept.append((matches.pop(0), prepared))
+        else:
+            added.append(prepared)
+    removed = [order_line for order_lines in existing_lines.values() for order_line in order_lines]
+
+    # Work out the net change in allocated stock per stockrecord
+    stock_deltas: dict[int, int] = defaultdict(int, prepared_lines.stock_quantities)
+    for stockrecord_id, quantity in get_stock_quantities(removed).items():
+        stock_deltas[stockrecord_id] -= quantity
+    for stockrecord_id, quantity in get_stock_quantities(order_line for order_line, _prepared in kept).items():
+        stock_deltas[stockrecord_id] -= quantity
+    cancel_stock_allocations({pk: -delta for pk, delta in stock_deltas.items() if delta < 0})
+    allocate_stock({pk: delta for pk, delta in stock_deltas.items() if delta > 0})
+
+    if removed:
+        Line._default_manager.filter(pk__in=[order_line.pk for order_line in removed]).delete()
+
+    # Update the fields which changed on the kept lines
+    changed_lines = []
+    changed_fields: set[str] = set()
+    for order_line, prepared in kept:
+        fields = _get_changed_fields(order_line, prepared.data)
+        if fields:
+            for name in fields:
+                setattr(order_line, name, prepared.data[name])
+            changed_lines.append(order_line)
+            changed_fields.update(fields)
+    if changed_lines:
+        Line._default_manager.bulk_update(changed_lines, sorted(changed_fields))
+
+    # Re-create the prices and discounts of the kept lines. Their attributes already match.
+    kept_line_ids = [order_line.pk for order_line, _prepared in kept]
+    if kept_line_ids:
+        LinePrice._default_manager.filter(line_id__in=kept_line_ids).delete()
+        OrderLineDiscount._default_manager.filter(line_id__in=kept_line_ids).delete()
+        _create_line_related_models(order, kept, with_attributes=False)
+
+    if added:
+        _bulk_create_lines(prepared_lines.creator, order, added)
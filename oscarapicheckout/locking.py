@@ -0,0 +1,80 @@
+from collections.abc import Iterable
+
+from django.db import OperationalError
+from django.db.models import Model, QuerySet
+from django.utils.translation import gettext_lazy as _
+from oscar.core.loading import get_model
+from rest_framework import exceptions, status
+
+from . import settings as pkgsettings
+
+Basket = get_model("basket", "Basket")
+Order = get_model("order", "Order")
+StockRecord = get_model("partner", "StockRecord")
+Voucher = get_model("voucher", "Voucher")
+
+LOCK_MODE_WAIT = "wait"
+LOCK_MODE_NOWAIT = "nowait"
+LOCK_MODE_SKIP_LOCKED = "skip_locked"
+
+# Postgres' lock_not_available error code, raised by NOWAIT
+PGCODE_LOCK_NOT_AVAILABLE = "55P03"
+
+
+class CheckoutLockUnavailable(exceptions.APIException):
+    """
+    Raised, instead of waiting, when a row needed to place an order is locked by
+    another checkout and ``API_CHECKOUT_LOCK_MODE`` is ``nowait`` or ``skip_locked``.
+    The checkout can safely be retried.
+    """
+
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = _("Another order for some of these items is being placed right now. Please try again.")
+    default_code = "lock_unavailable"
+
+
+def lock_rows[M: Model](queryset: QuerySet[M], pks: Iterable[int]) -> list[M]:
+    """
+    Lock the rows with the given primary keys for update, in primary key order, using
+    the configured ``API_CHECKOUT_LOCK_MODE``. Must be called inside a transaction.
+    """
+    sorted_pks = sorted(set(pks))
+    if not sorted_pks:
+        return []
+    mode = pkgsettings.get_setting("API_CHECKOUT_LOCK_MODE")
+    locking_queryset = (
+        queryset.filter(pk__in=sorted_pks)
+        .order_by("pk")
+        .select_for_update(
+            nowait=(mode == LOCK_MODE_NOWAIT),
+            skip_locked=(mode == LOCK_MODE_SKIP_LOCKED),
+        )
+    )
+    try:
+        rows = list(locking_queryset)
+    except OperationalError as e:
+        # Don't mistake other errors (e.g. statement timeouts, dropped connections) for a held lock
+        if mode == LOCK_MODE_NOWAIT and getattr(e.__cause__, "pgcode", None) == PGCODE_LOCK_NOT_AVAILABLE:
+            raise CheckoutLockUnavailable() from e
+        raise
+    # With SKIP LOCKED, rows locked by another transaction are silently left out
+    if mode == LOCK_MODE_SKIP_LOCKED and len(rows) < len(sorted_pks):
+        raise CheckoutLockUnavailable()
+    return rows
+
+
+def lock_checkout_rows(basket: Basket, order: Order | None = None) -> list[Voucher]:
+    """
+    Lock every voucher and stockrecord that placing an order for the given basket (or
+    updating the given existing order) will update, up-front. Vouchers are always
+    locked before stockrecords, and each in primary key order, so that concurrent
+    checkouts acquire their locks in the same order and can't deadlock.
+
+    Returns the basket's vouchers.
+    """
+    vouchers = lock_rows(Voucher._default_manager.all(), basket.vouchers.values_list("pk", flat=True))
+    stockrecord_ids = {line.stockrecord_id for line in basket.all_lines() if line.stockrecord_id is not None}
+    if order is not None:
+        stockrecord_ids.update(order.lines.exclude(stockrecord=None).values_list("stockrecord_id", flat=True))
+    lock_rows(StockRecord._default_manager.all(), stockrecord_ids)
+    return vouchers
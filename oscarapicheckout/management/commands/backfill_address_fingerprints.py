@@ -0,0 +1,69 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+from oscar.core.loading import get_model
+
+from ...fraud import get_order_address_fingerprints
+from ...models import OrderAddressFingerprint
+
+Order = get_model("order", "Order")
+
+
+class Command(BaseCommand):
+    help = "Create the address fingerprints of existing orders, for the IndexedAddressVelocity fraud rule."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of orders to fingerprint per query.",
+        )
+        parser.add_argument(
+            "--start-id",
+            type=int,
+            default=0,
+            help="Only fingerprint orders with a greater primary key (e.g. to resume an interrupted backfill).",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        batch_size: int = options["batch_size"]
+        last_id: int = options["start_id"]
+        num_orders = 0
+        # Page through the orders by primary key, so that each batch is an index range scan
+        while True:
+            orders = list(
+                Order.objects.filter(pk__gt=last_id)
+                .order_by("pk")
+                .select_related("shipping_address", "billing_address")
+                .only(
+                    "pk",
+                    "date_placed",
+                    "shipping_address__line1",
+                    "shipping_address__line2",
+                    "shipping_address__line3",
+                    "shipping_address__line4",
+                    "shipping_address__postcode",
+                    "shipping_address__country",
+                    "billing_address__line1",
+                    "billing_address__line2",
+                    "billing_address__line3",
+                    "billing_address__line4",
+                    "billing_address__postcode",
+                    "billing_address__country",
+                )[:batch_size]
+            )
+            if not orders:
+                break
+            fingerprints = [fingerprint for order in orders for fingerprint in get_order_address_fingerprints(order)]
+            # Existing fingerprints are refreshed, in case their order was updated while the rule wasn't enabled
+            OrderAddressFingerprint.objects.bulk_create(
+                fingerprints,
+                update_conflicts=True,
+                unique_fields=["order", "address_type"],
+                update_fields=["fingerprint", "date_placed"],
+            )
+            num_orders += len(orders)
+            last_id = orders[-1].pk
+            self.stdout.write(f"Fingerprinted {num_orders} orders (up to order ID {last_id})")
+        self.stdout.write(self.style.SUCCESS(f"Done. Fingerprinted {num_orders} orders."))
@@ -1,8 +1,11 @@
+from collections.abc import Iterable
 from decimal import Decimal
 from typing import Any, NotRequired, TypedDict
 import logging
+import threading
 
 from django.db import transaction
+from django.db.models import Model, Prefetch, prefetch_related_objects
 from django.http import HttpRequest
 from django.utils.translation import gettext_lazy as _
 from django.utils.translation import gettext_noop
@@ -24,6 +27,64 @@ Transaction = get_model("payment", "Transaction")
 logger = logging.getLogger(__name__)
 
 
+class NamedRowCache[M: Model]:
+    """
+    Process-local cache of the rows of a small lookup table (``PaymentEventType``,
+    ``SourceType``), by name. Rows are created on demand, like ``get_or_create``.
+
+    Rows are only added to the cache once the transaction which read (or created)
+    them commits, so that a rolled back row is never cached. The cache is cleared
+    whenever a row of the model is saved or deleted in this process (see
+    ``handlers.py``). Rows deleted by other processes aren't noticed, so
+    processes should be restarted after deleting one of these rows.
+    """
+
+    def __init__(self, model: type[M]) -> None:
+        self.model = model
+        self._rows: dict[str, M] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: StrOrPromise) -> M:
+        name = str(name)
+        row = self._rows.get(name)
+        if row is not None:
+            return row
+        row, _created = self.model._default_manager.get_or_create(name=name)
+        transaction.on_commit(lambda: self._add({name: row}))
+        return row
+
+    def warm(self) -> None:
+        """
+        Load every existing row into the cache.
+        """
+        rows = {row.name: row for row in self.model._default_manager.all()}  # type:ignore[attr-defined]
+        transaction.on_commit(lambda: self._add(rows))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows = {}
+
+    def _add(self, rows: dict[str, M]) -> None:
+        with self._lock:
+            self._rows = self._rows | rows
+
+
+payment_event_types = NamedRowCache(PaymentEventType)
+source_types = NamedRowCache(SourceType)
+
+# Order attribute holding the payment sources fetched by ``prefetch_order_sources``
+PREFETCHED_SOURCES_ATTR = "prefetched_payment_sources"
+
+
+def prefetch_order_sources(order: Order) -> None:
+    """
+    Fetch all of the order's payment sources at once. ``PaymentMethod.get_source``
+    and ``PaymentMethod.void_existing_payment`` then look sources up among them,
+    rather than querying once per payment method.
+    """
+    prefetch_related_objects([order], Prefetch("sources", to_attr=PREFETCHED_SOURCES_ATTR))
+
+
 class PaymentMethodData(TypedDict):
     method_type: str
     enabled: NotRequired[bool]
@@ -72,7 +133,7 @@ class PaymentMethod[T: PaymentMethodData]:
         amount: Decimal,
         reference: str = "",
     ) -> PaymentEvent:
-        etype, _created = PaymentEventType.objects.get_or_create(name=type_name)
+        etype = payment_event_types.get(type_name)
         event = PaymentEvent()
         event.order = order
         event.amount = amount
@@ -128,17 +189,67 @@ class PaymentMethod[T: PaymentMethodData]:
     ) -> PaymentEventQuantity:
         return PaymentEventQuantity.objects.create(event=event, line=line, quantity=quantity)
 
+    def make_event_quantities(
+        self,
+        event: PaymentEvent,
+        line_quantities: Iterable[tuple[OrderLine, int]],
+    ) -> list[PaymentEventQuantity]:
+        """
+        Record the quantity of each of the given lines which the payment event
+        affects, in a single INSERT.
+        """
+        # Preserve the behavior of payment methods which customize ``make_event_quantity``
+        if type(self).make_event_quantity is not PaymentMethod.make_event_quantity:
+            return [self.make_event_quantity(event, line, quantity) for line, quantity in line_quantities]
+        return PaymentEventQuantity.objects.bulk_create([PaymentEventQuantity(event=event, line=line, quantity=quantity) for line, quantity in line_quantities])
+
+    def make_order_event_quantities(
+        self,
+        event: PaymentEvent,
+        order: Order,
+    ) -> list[PaymentEventQuantity]:
+        """
+        Record that the payment event affects the full quantity of every line of the order.
+        """
+        return self.make_event_quantities(event, ((line, line.quantity) for line in order.lines.all()))
+
     def get_source(
         self,
         order: Order,
         reference: str = "",
     ) -> Source:
-        stype, _created = SourceType.objects.get_or_create(name=self.name)
-        source, _created = Source.objects.get_or_create(order=order, source_type=stype, reference=reference)
-        source.currency = order.currency
-        source.save()
+        """
+        Get (or create) this method's payment source for the order. If the order's
+        sources have been fetched with ``prefetch_order_sources``, the source is
+        looked up among them.
+        """
+        stype = source_types.get(self.name)
+        prefetched = self._get_prefetched_sources(order)
+        if prefetched is not None:
+            source = next((s for s in prefetched if s.source_type_id == stype.pk and s.reference == reference), None)
+            if source is None:
+                source = Source.objects.create(order=order, source_type=stype, reference=reference, currency=order.currency)
+                # Keep the prefetched sources in sync, for the next method to look up
+                prefetched.append(source)
+                return source
+        else:
+            source, created = Source.objects.get_or_create(
+                order=order,
+                source_type=stype,
+                reference=reference,
+                defaults={"currency": order.currency},
+            )
+            if created:
+                return source
+        if source.currency != order.currency:
+            source.currency = order.currency
+            source.save(update_fields=["currency"])
         return source
 
+    def _get_prefetched_sources(self, order: Order) -> list[Source] | None:
+        sources: list[Source] | None = getattr(order, PREFETCHED_SOURCES_ATTR, None)
+        return sources
+
     @transaction.atomic()
     def void_existing_payment(
         self,
@@ -148,7 +259,14 @@ class PaymentMethod[T: PaymentMethodData]:
         state_to_void: states.PaymentStatus,
     ) -> None:
         source_id: int | None = getattr(state_to_void, "source_id", None)
-        source = Source.objects.filter(pk=source_id).first() if source_id is not None else None
+        source = None
+        if source_id is not None:
+            prefetched = self._get_prefetched_sources(order)
+            if prefetched is not None:
+                # Update the prefetched instance, so that a new payment recorded against the same source sees the change
+                source = next((s for s in prefetched if s.pk == source_id), None)
+            else:
+                source = Source.objects.filter(pk=source_id).first()
         if not source:
             logger.warning(
                 "Attempted to void PaymentSource for Order[%s], MethodKey[%s], but no source was found.",
@@ -230,8 +348,7 @@ class Cash(PaymentMethod[PaymentMethodData]):
         source.debit(amount_to_debit, reference)
 
         event = self.make_debit_event(order, amount_to_debit, reference)
-        for line in order.lines.all():
-            self.make_event_quantity(event, line, line.quantity)
+        self.make_order_event_quantities(event, order)
 
         return states.Complete(source.amount_debited, source_id=source.pk)
 
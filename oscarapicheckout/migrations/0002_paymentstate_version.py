@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("oscarapicheckout", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="paymentstate",
+            name="version",
+            field=models.PositiveIntegerField(
+                default=1,
+                help_text="Incremented each time the state is written.",
+                verbose_name="Version",
+            ),
+        ),
+    ]
@@ -0,0 +1,59 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("oscarapicheckout", "0002_paymentstate_version"),
+        ("order", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrderAddressFingerprint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "address_type",
+                    models.CharField(
+                        choices=[
+                            ("shipping_address", "Shipping Address"),
+                            ("billing_address", "Billing Address"),
+                        ],
+                        max_length=20,
+                        verbose_name="Address Type",
+                    ),
+                ),
+                ("fingerprint", models.CharField(max_length=64, verbose_name="Fingerprint")),
+                ("date_placed", models.DateTimeField(verbose_name="Date Placed")),
+                (
+                    "order",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="address_fingerprints",
+                        to="order.order",
+                        verbose_name="Order",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Order Address Fingerprint",
+                "verbose_name_plural": "Order Address Fingerprints",
+                "indexes": [
+                    models.Index(
+                        fields=["fingerprint", "address_type", "date_placed"],
+                        name="oscarapicheckout_addr_fp_idx",
+                    )
+                ],
+                "unique_together": {("order", "address_type")},
+            },
+        ),
+    ]
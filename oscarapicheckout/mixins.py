@@ -1,3 +1,4 @@
+from collections.abc import Callable
 from decimal import Decimal
 from typing import Any, cast
 
@@ -11,6 +12,9 @@ from oscar.apps.order.signals import order_placed
 from oscar.core.loading import get_class, get_model
 from oscar.core.prices import Price
 
+from .lines import PreparedOrderLines
+from .locking import lock_checkout_rows
+
 Basket = get_model("basket", "Basket")
 Order = get_model("order", "Order")
 ShippingAddress = get_model("order", "ShippingAddress")
@@ -19,6 +23,18 @@ BillingAddress = get_model("order", "BillingAddress")
 OrderCreator = get_class("order.utils", "OrderCreator")
 ShippingMethod = get_class("shipping.methods", "Base")
 
+# Saves the order's addresses, returning the saved shipping and billing address
+type AddressWriter = Callable[[], tuple[ShippingAddress | None, BillingAddress | None]]
+
+
+def get_shipping_discount(basket: Basket, shipping_method: ShippingMethod) -> Decimal | None:
+    """
+    Work out the shipping discount for the basket, if any of its offers affect shipping.
+    """
+    if not any(application["result"].affects_shipping for application in basket.offer_applications):
+        return None
+    return shipping_method.discount(basket)
+
 
 class OrderCreatorMixin(OrderCreator):
     """
@@ -40,11 +56,15 @@ class OrderCreatorMixin(OrderCreator):
         status: str | None = None,
         request: HttpRequest | None = None,
         surcharges: list[Any] | None = None,
+        save_addresses: AddressWriter | None = None,
         **kwargs: Any,
     ) -> Order:
         """
         Placing an order involves creating all the relevant models based on the
         basket and session data.
+
+        If given, ``save_addresses`` is called to save the order's addresses in the
+        same transaction as the order, before any rows are locked.
         """
         # Make sure basket isn't empty
         if basket.is_empty:
@@ -66,8 +86,20 @@ class OrderCreatorMixin(OrderCreator):
             # Translators: User facing error message in checkout
             raise ValueError(_("There is already an order with number %(order_number)s") % {"order_number": order_number})
 
+        # Work out the order lines, and any shipping discount, before opening the transaction, so
+        # that the rows locked below are held for as short a time as possible.
+        prepared_lines = PreparedOrderLines(self, basket.all_lines())
+        shipping_discount = get_shipping_discount(basket, shipping_method)
+
         # Open a transaction so that order creation is atomic.
         with transaction.atomic():
+            if save_addresses is not None:
+                shipping_address, billing_address = save_addresses()
+
+            # Lock the vouchers and stockrecords this order will update before changing anything, in a
+            # consistent order.
+            vouchers = lock_checkout_rows(basket)
+
             # Create the actual order.Order model
             order = cast(
                 Order,
@@ -88,7 +120,7 @@ class OrderCreatorMixin(OrderCreator):
 
             # Make sure all the vouchers in the order are active and can actually be used by the order placing user.
             voucher_user = request.user if request and request.user else user
-            for voucher in basket.vouchers.select_for_update():
+            for voucher in vouchers:
                 available_to_user, msg = voucher.is_available_to_user(user=voucher_user)
                 if not voucher.is_active() or not available_to_user:
                     raise ValueError(msg)
@@ -100,8 +132,7 @@ class OrderCreatorMixin(OrderCreator):
                 # Record offer application results
                 if application["result"].affects_shipping:
                     # Skip zero shipping discounts
-                    shipping_discount = shipping_method.discount(basket)
-                    if shipping_discount <= Decimal("0.00"):
+                    if shipping_discount is None or shipping_discount <= Decimal("0.00"):
                         continue
                     # If a shipping offer, we need to grab the actual discount off
                     # the shipping method instance, which should be wrapped in an
@@ -116,9 +147,9 @@ class OrderCreatorMixin(OrderCreator):
 
             # Create order lines last so that create_line_discount_models can
             # link each OrderLine to the OrderDiscount records created above.
-            for line in basket.all_lines():
-                self.create_line_models(order, line)
-                self.update_stock_records(line)
+            prepared_lines.create_lines(order)
+            # Allocate all the stock in one statement, locking the stockrecords in primary key order.
+            prepared_lines.allocate_stock()
 
         # Send signal for analytics to pick up
         order_placed.send(sender=self, order=order, user=user)
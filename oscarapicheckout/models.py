@@ -0,0 +1,75 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class PaymentState(models.Model):
+    """
+    Serialized PaymentStatus of a single payment method used on an order. Used
+    by ``oscarapicheckout.stores.DatabasePaymentStateStore``. Rows are unique
+    (and therefore indexed) on order and method key.
+    """
+
+    order = models.ForeignKey(
+        "order.Order",
+        on_delete=models.CASCADE,
+        related_name="payment_states",
+        verbose_name=_("Order"),
+    )
+    method_key = models.CharField(_("Method Key"), max_length=128)
+    state = models.TextField(_("State"))
+    version = models.PositiveIntegerField(
+        _("Version"),
+        default=1,
+        help_text=_("Incremented each time the state is written."),
+    )
+    date_created = models.DateTimeField(_("Date Created"), auto_now_add=True)
+    date_updated = models.DateTimeField(_("Date Updated"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("Payment State")
+        verbose_name_plural = _("Payment States")
+        unique_together = ("order", "method_key")
+
+    def __str__(self) -> str:
+        return f"Order[{self.order_id}], MethodKey[{self.method_key}]"
+
+
+class OrderAddressFingerprint(models.Model):
+    """
+    Normalized hash of an order's shipping or billing address, and when the
+    order was placed. Used by ``oscarapicheckout.fraud.IndexedAddressVelocity``
+    to count recent orders with an address using an index range scan. Rows are
+    created when orders are placed. Rows for existing orders can be created with
+    the ``backfill_address_fingerprints`` management command.
+    """
+
+    ADDRESS_TYPE_SHIPPING = "shipping_address"
+    ADDRESS_TYPE_BILLING = "billing_address"
+    ADDRESS_TYPE_CHOICES = (
+        (ADDRESS_TYPE_SHIPPING, _("Shipping Address")),
+        (ADDRESS_TYPE_BILLING, _("Billing Address")),
+    )
+
+    order = models.ForeignKey(
+        "order.Order",
+        on_delete=models.CASCADE,
+        related_name="address_fingerprints",
+        verbose_name=_("Order"),
+    )
+    address_type = models.CharField(_("Address Type"), max_length=20, choices=ADDRESS_TYPE_CHOICES)
+    fingerprint = models.CharField(_("Fingerprint"), max_length=64)
+    date_placed = models.DateTimeField(_("Date Placed"))
+
+    class Meta:
+        verbose_name = _("Order Address Fingerprint")
+        verbose_name_plural = _("Order Address Fingerprints")
+        unique_together = ("order", "address_type")
+        indexes = (
+            models.Index(
+                fields=["fingerprint", "address_type", "date_placed"],
+                name="oscarapicheckout_addr_fp_idx",
+            ),
+        )
+
+    def __str__(self) -> str:
+        return f"Order[{self.order_id}], AddressType[{self.address_type}]"
@@ -1,38 +1,123 @@
-from django.contrib.auth.models import User
+from collections.abc import Hashable, Sequence
+from typing import Any, Self
+
+from django.contrib.auth.models import AnonymousUser, User
 from django.http import HttpRequest
 
+REQUEST_CACHE_ATTR = "_oscarapicheckout_payment_method_permissions"
+
 
 class PaymentMethodPermission:
     def is_permitted(
         self,
         request: HttpRequest | None = None,
-        user: User | None = None,
+        user: User | AnonymousUser | None = None,
     ) -> bool:
         raise NotImplementedError("Class must implement is_method_permitted(request=None, user=None)")
 
+    @classmethod
+    def is_permitted_many(
+        cls,
+        permissions: Sequence[Self],
+        request: HttpRequest | None = None,
+        user: User | AnonymousUser | None = None,
+    ) -> list[bool]:
+        """
+        Evaluate several instances of this permission class (e.g. one per payment
+        method) at once, returning one result per permission. Override this to
+        answer for all of them with a single query.
+        """
+        return [permission.is_permitted(request=request, user=user) for permission in permissions]
+
+    def get_cache_key(self) -> Hashable | None:
+        """
+        Key under which the result of this permission is memoized for the rest of
+        the request. Permissions with equal keys must give the same result for the
+        same request and user. Defaults to the permission instance itself. Return
+        ``None`` to never memoize the result.
+        """
+        return self
+
 
 class Public(PaymentMethodPermission):
     def is_permitted(
         self,
         request: HttpRequest | None = None,
-        user: User | None = None,
+        user: User | AnonymousUser | None = None,
     ) -> bool:
         return True
 
+    def get_cache_key(self) -> Hashable | None:
+        return (self.__class__,)
+
 
 class StaffOnly(PaymentMethodPermission):
     def is_permitted(
         self,
         request: HttpRequest | None = None,
-        user: User | None = None,
+        user: User | AnonymousUser | None = None,
     ) -> bool:
         return user is not None and user.is_authenticated and user.is_staff
 
+    def get_cache_key(self) -> Hashable | None:
+        return (self.__class__,)
+
 
 class CustomerOnly(PaymentMethodPermission):
     def is_permitted(
         self,
         request: HttpRequest | None = None,
-        user: User | None = None,
+        user: User | AnonymousUser | None = None,
     ) -> bool:
         return user is None or not user.is_authenticated or (user.is_authenticated and not user.is_staff)
+
+    def get_cache_key(self) -> Hashable | None:
+        return (self.__class__,)
+
+
+def _get_request_cache(
+    request: HttpRequest | None,
+    user: User | AnonymousUser | None,
+) -> dict[Hashable, bool] | None:
+    if request is None:
+        return None
+    # Memoize on the underlying ``HttpRequest``, which all DRF ``Request`` wrappers of it share
+    request = getattr(request, "_request", request)
+    caches: dict[Any, dict[Hashable, bool]] = request.__dict__.setdefault(REQUEST_CACHE_ATTR, {})
+    user_key = user.pk if user is not None and user.is_authenticated else None
+    return caches.setdefault(user_key, {})
+
+
+def evaluate_permissions(
+    permissions: Sequence[PaymentMethodPermission],
+    request: HttpRequest | None = None,
+    user: User | AnonymousUser | None = None,
+) -> list[bool]:
+    """
+    Evaluate the given permissions, returning one result per permission. Results
+    are memoized for the rest of the request (and user), and permissions of the
+    same class are evaluated together with ``is_permitted_many``.
+    """
+    request_cache = _get_request_cache(request, user)
+    results: dict[int, bool] = {}
+    pending: dict[type[PaymentMethodPermission], list[tuple[int, PaymentMethodPermission]]] = {}
+    for i, permission in enumerate(permissions):
+        key = permission.get_cache_key()
+        if request_cache is not None and key is not None and key in request_cache:
+            results[i] = request_cache[key]
+        else:
+            pending.setdefault(permission.__class__, []).append((i, permission))
+
+    for permission_class, group in pending.items():
+        answers = permission_class.is_permitted_many(
+            [permission for _i, permission in group],
+            request=request,
+            user=user,
+        )
+        for (i, permission), answer in zip(group, answers, strict=True):
+            results[i] = answer
+            key = permission.get_cache_key()
+            if request_cache is not None and key is not None:
+                request_cache[key] = answer
+
+    return [results[i] for i in range(len(permissions))]
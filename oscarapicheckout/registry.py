@@ -0,0 +1,87 @@
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Any
+import hashlib
+import json
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpRequest
+from django.utils.encoding import force_str
+from django.utils.module_loading import import_string
+
+from . import settings as pkgsettings
+from .methods import PaymentMethod, PaymentMethodData
+from .permissions import PaymentMethodPermission, evaluate_permissions
+from .settings import PaymentMethodConfig
+
+
+@dataclass(frozen=True)
+class RegisteredPaymentMethod:
+    method: PaymentMethod[Any]
+    permission: PaymentMethodPermission
+
+    @property
+    def code(self) -> str:
+        return self.method.code
+
+    @property
+    def method_type_choices(self) -> list[tuple[str, str]]:
+        return [(self.method.code, force_str(self.method.name))]
+
+
+class PaymentMethodRegistry:
+    """
+    The enabled payment methods (``API_ENABLED_PAYMENT_METHODS``), with their
+    method and permission classes imported and instantiated once, rather than on
+    every request. Payment method and permission instances are therefore shared
+    between requests, and must not keep any per-request state.
+    """
+
+    def __init__(self, configs: Sequence[PaymentMethodConfig]) -> None:
+        # Changes whenever the configuration does, e.g. to version cached data derived from it
+        self.version = hashlib.sha256(json.dumps(configs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.entries: list[RegisteredPaymentMethod] = []
+        for config in configs:
+            PermissionClass: type[PaymentMethodPermission] = import_string(config["permission"])
+            MethodClass: type[PaymentMethod[Any]] = import_string(config["method"])
+            self.entries.append(
+                RegisteredPaymentMethod(
+                    method=MethodClass(**config.get("method_kwargs", {})),
+                    permission=PermissionClass(**config.get("permission_kwargs", {})),
+                )
+            )
+
+    def get_permitted_entries(
+        self,
+        request: HttpRequest | None,
+        user: User | AnonymousUser | None,
+    ) -> dict[str, RegisteredPaymentMethod]:
+        permitted = evaluate_permissions([entry.permission for entry in self.entries], request=request, user=user)
+        return {entry.code: entry for entry, is_permitted in zip(self.entries, permitted, strict=True) if is_permitted}
+
+    def get_permitted_methods(
+        self,
+        request: HttpRequest | None,
+        user: User | AnonymousUser | None,
+    ) -> dict[str, PaymentMethod[PaymentMethodData]]:
+        return {code: entry.method for code, entry in self.get_permitted_entries(request, user).items()}
+
+
+_registry: PaymentMethodRegistry | None = None
+
+
+def get_payment_method_registry() -> PaymentMethodRegistry:
+    global _registry
+    if _registry is None:
+        _registry = PaymentMethodRegistry(pkgsettings.get_setting("API_ENABLED_PAYMENT_METHODS"))
+    return _registry
+
+
+def reload_payment_method_registry() -> PaymentMethodRegistry:
+    """
+    Rebuild the registry from ``API_ENABLED_PAYMENT_METHODS``, e.g. after the
+    setting is changed with ``override_settings``.
+    """
+    global _registry
+    _registry = None
+    return get_payment_method_registry()
@@ -7,13 +7,14 @@ import logging
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.signing import BadSignature, Signer
-from django.db import models, transaction
+from django.db import models
 from django.http import HttpRequest
-from django.utils.encoding import force_str, smart_str
+from django.utils.encoding import smart_str
 from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
 from drf_recaptcha.fields import ReCaptchaV3Field
 from oscar.core.loading import get_class, get_model
+from oscar.core.prices import Price
 from oscarapi.basket.operations import get_basket
 from oscarapi.serializers.checkout import CheckoutSerializer as OscarCheckoutSerializer
 from oscarapi.serializers.checkout import OrderSerializer as OscarOrderSerializer
@@ -24,6 +25,8 @@ from rest_framework.utils import html
 
 from . import fraud, settings, utils
 from .methods import PaymentMethod, PaymentMethodData
+from .mixins import AddressWriter
+from .registry import get_payment_method_registry
 from .signals import pre_calculate_total
 from .states import PaymentMethodStatus, PaymentStatus, RequiredAction
 
@@ -32,7 +35,9 @@ Order = get_model("order", "Order")
 BillingAddress = get_model("order", "BillingAddress")
 ShippingAddress = get_model("order", "ShippingAddress")
 
+OrderCreator = get_class("order.utils", "OrderCreator")
 OrderTotalCalculator = get_class("checkout.calculators", "OrderTotalCalculator")
+ShippingMethod = get_class("shipping.methods", "Base")
 
 logger = logging.getLogger(__name__)
 
@@ -146,22 +151,17 @@ class PaymentMethodsSerializer(serializers.DictField):
             "the serializer."
         )
 
-        self.methods = {}
-        for m in settings.API_ENABLED_PAYMENT_METHODS:
-            PermissionClass = import_string(m["permission"])
-            permission = PermissionClass(**m.get("permission_kwargs", {}))
-            if permission.is_permitted(request=request, user=request.user):
-                MethodClass = import_string(m["method"])
-                method = MethodClass(**m.get("method_kwargs", {}))
-                self.methods[method.code] = method
+        # Only the permission checks run per request. The methods come from the registry.
+        entries = get_payment_method_registry().get_permitted_entries(request=request, user=request.user)
+        self.methods = {code: entry.method for code, entry in entries.items()}
 
         if not any(self.methods):
             raise RuntimeError(f"No payment methods were permitted for user {request.user}")
 
         union_types = {}
-        for code, method in self.methods.items():
-            union_types[method.code] = method.serializer_class(
-                method_type_choices=[(code, force_str(method.name))],
+        for code, entry in entries.items():
+            union_types[code] = entry.method.serializer_class(
+                method_type_choices=entry.method_type_choices,
                 required=False,
                 context=context,
             )
@@ -433,7 +433,6 @@ class CheckoutSerializer(OscarCheckoutSerializer):
 
         return data
 
-    @transaction.atomic()
     def create(self, validated_data: dict[str, Any]) -> Order:
         basket: Basket = validated_data["basket"]
         order_number = self.generate_order_number(basket)
@@ -489,7 +488,7 @@ class CheckoutSerializer(OscarCheckoutSerializer):
         # If no orders were pre-existing, make a new one.
         order = existing_orders.first()
         if existing_count == 0 or order is None:
-            return self.place_order(  # type:ignore[no-any-return]
+            return self.place_order(
                 basket=basket,
                 user=user,
                 shipping_address=shipping_address,
@@ -501,23 +500,70 @@ class CheckoutSerializer(OscarCheckoutSerializer):
         # Update this order instead of making a new one.
         kwargs["order_number"] = order.number
         status = self.get_initial_order_status(basket)
-        shipping_address = self.create_shipping_address(user=user, shipping_address=shipping_address)
-        billing_address = self.create_billing_address(
-            user=user,
-            billing_address=billing_address,
-            shipping_address=shipping_address,
-            **kwargs,
-        )
         return utils.OrderUpdater().update_order(
             order=order,
             basket=basket,
             user=user,
-            shipping_address=shipping_address,
-            billing_address=billing_address,
             status=status,
             request=request,
+            save_addresses=self._get_address_writer(user, shipping_address, billing_address, **kwargs),
+            **kwargs,
+        )
+
+    def place_order(
+        self,
+        order_number: str | int,
+        user: AnonymousUser | User | None,
+        basket: Basket,
+        shipping_address: ShippingAddress | None,
+        shipping_method: ShippingMethod,
+        shipping_charge: Price,
+        order_total: Price,
+        billing_address: BillingAddress | None = None,
+        surcharges: list[Any] | None = None,
+        **kwargs: Any,
+    ) -> Order:
+        """
+        Like Oscar's ``OrderPlacementMixin.place_order``, except that the addresses are saved
+        by the order creator, in the same transaction as the order, so that they're rolled back
+        if placing the order fails.
+        """
+        status = kwargs.pop("status") if "status" in kwargs else self.get_initial_order_status(basket)
+        request = kwargs.pop("request") if "request" in kwargs else self.context.get("request", None)
+        order: Order = OrderCreator().place_order(
+            user=user,
+            order_number=order_number,
+            basket=basket,
+            shipping_method=shipping_method,
+            shipping_charge=shipping_charge,
+            total=order_total,
+            status=status,
+            request=request,
+            surcharges=surcharges,
+            save_addresses=self._get_address_writer(user, shipping_address, billing_address, **kwargs),
             **kwargs,
         )
+        self.save_payment_details(order)
+        return order
+
+    def _get_address_writer(
+        self,
+        user: AnonymousUser | User | None,
+        shipping_address: ShippingAddress | None,
+        billing_address: BillingAddress | None,
+        **kwargs: Any,
+    ) -> AddressWriter:
+        def save_addresses() -> tuple[ShippingAddress | None, BillingAddress | None]:
+            saved_shipping_address = self.create_shipping_address(user=user, shipping_address=shipping_address)
+            saved_billing_address = self.create_billing_address(
+                user=user,
+                billing_address=billing_address,
+                shipping_address=saved_shipping_address,
+                **kwargs,
+            )
+            return saved_shipping_address, saved_billing_address
+
+        return save_addresses
 
 
 class CompleteDeferredPaymentSerializer(serializers.Serializer[Any]):
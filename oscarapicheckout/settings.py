@@ -1,12 +1,23 @@
-from typing import Any, TypedDict
+from typing import Any, NotRequired, TypedDict
 
 from django.conf import settings
 
+DEFAULTS: dict[str, Any] = {}
+
 
 def overridable(name: str, default: Any | None = None) -> Any:
+    DEFAULTS[name] = default
     return getattr(settings, name, default)
 
 
+def get_setting(name: str) -> Any:
+    """
+    Get the current value of a setting, rather than the value it had when this module
+    was imported, so that changes made with ``override_settings`` are seen.
+    """
+    return getattr(settings, name, DEFAULTS[name])
+
+
 class PaymentMethodConfig(TypedDict):
     method: str
     permission: str
@@ -17,6 +28,9 @@ class PaymentMethodConfig(TypedDict):
 class FraudRuleConfig(TypedDict):
     rule: str
     kwargs: dict[str, Any]
+    timeout_policy: NotRequired[str]
+    cost: NotRequired[str]
+    weight: NotRequired[float]
 
 
 API_ENABLED_PAYMENT_METHODS: list[PaymentMethodConfig] = overridable(
@@ -39,6 +53,28 @@ API_CHECKOUT_FRAUD_CHECKS: list[FraudRuleConfig] = overridable(
     "API_CHECKOUT_FRAUD_CHECKS",
     [],
 )
+API_CHECKOUT_FRAUD_METRICS: str = overridable(
+    "API_CHECKOUT_FRAUD_METRICS",
+    "oscarapicheckout.fraud.FraudRuleMetrics",
+)
+API_CHECKOUT_FRAUD_CHECK_EXECUTOR: str = overridable("API_CHECKOUT_FRAUD_CHECK_EXECUTOR", "sequential")
+API_CHECKOUT_FRAUD_CHECK_MAX_WORKERS: int = overridable("API_CHECKOUT_FRAUD_CHECK_MAX_WORKERS", 4)
+API_CHECKOUT_FRAUD_CHECK_DEADLINE: float = overridable("API_CHECKOUT_FRAUD_CHECK_DEADLINE", 2.0)
+API_CHECKOUT_FRAUD_CHECK_MODE: str = overridable("API_CHECKOUT_FRAUD_CHECK_MODE", "reject")
+API_CHECKOUT_FRAUD_SCORE_THRESHOLD: float = overridable("API_CHECKOUT_FRAUD_SCORE_THRESHOLD", 1.0)
+API_CHECKOUT_PAYMENT_STATE_STORE: str = overridable(
+    "API_CHECKOUT_PAYMENT_STATE_STORE",
+    "oscarapicheckout.stores.SessionPaymentStateStore",
+)
+API_CHECKOUT_PAYMENT_STATE_MAX_RETRIES: int = overridable("API_CHECKOUT_PAYMENT_STATE_MAX_RETRIES", 5)
+API_CHECKOUT_PAYMENT_STATE_RETRY_BACKOFF: float = overridable("API_CHECKOUT_PAYMENT_STATE_RETRY_BACKOFF", 0.05)
+API_CHECKOUT_IDEMPOTENCY_TTL: int = overridable("API_CHECKOUT_IDEMPOTENCY_TTL", 60 * 60 * 24)
+API_CHECKOUT_IDEMPOTENCY_WAIT: float = overridable("API_CHECKOUT_IDEMPOTENCY_WAIT", 30)
+API_CHECKOUT_BASKET_LEASE_TIMEOUT: int = overridable("API_CHECKOUT_BASKET_LEASE_TIMEOUT", 60)
+API_CHECKOUT_BASKET_LEASE_WAIT: float = overridable("API_CHECKOUT_BASKET_LEASE_WAIT", 5)
+API_CHECKOUT_RECONCILE_ORDER_LINES: bool = overridable("API_CHECKOUT_RECONCILE_ORDER_LINES", True)
+API_CHECKOUT_LOCK_MODE: str = overridable("API_CHECKOUT_LOCK_MODE", "wait")
+API_CHECKOUT_PAYMENT_METHODS_METADATA_TIMEOUT: int = overridable("API_CHECKOUT_PAYMENT_METHODS_METADATA_TIMEOUT", 60 * 5)
 
 ORDER_STATUS_PENDING: str = overridable("ORDER_STATUS_PENDING", "Pending")
 ORDER_STATUS_PAYMENT_DECLINED: str = overridable("ORDER_STATUS_PAYMENT_DECLINED", "Payment Declined")
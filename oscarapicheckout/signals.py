@@ -4,6 +4,16 @@ pre_calculate_total = Signal()
 
 order_placed = Signal()
 
+# Sent inside the transaction which updates the order, so receivers with side effects outside
+# the database (e.g. writing to the cache) must defer them with ``transaction.on_commit``
+order_updated = Signal()
+
 order_payment_authorized = Signal()
 
 order_payment_declined = Signal()
+
+payment_state_conflict = Signal()
+
+checkout_lease_contended = Signal()
+
+checkout_lease_acquired = Signal()
@@ -1,7 +1,7 @@
-from collections.abc import Sequence
+from collections.abc import Callable, Sequence
 from decimal import Decimal
 from enum import UNIQUE, StrEnum, verify
-from typing import Any, Literal, TypedDict
+from typing import Any, ClassVar, Literal, Self, TypedDict
 
 
 @verify(UNIQUE)
@@ -42,17 +42,69 @@ class ClientSidePaymentData(TypedDict):
 
 type RequiredAction = FormPostRequiredFormData | ClientSidePaymentData | None
 
+_registered_state_classes: dict[str, type["PaymentStatus"]] = {}
+
+
+def register_state_class[T: type["PaymentStatus"]](tag: str) -> Callable[[T], T]:
+    """
+    Class decorator which registers a PaymentStatus subclass under the given
+    type tag, allowing it to be stored using the compact encoding in
+    ``oscarapicheckout.stores`` instead of pickle. The class must implement
+    ``encode_fields`` and ``decode_fields``.
+    """
+
+    def decorator(cls: T) -> T:
+        if not tag or '"' in tag or "\\" in tag:
+            raise ValueError(f"Invalid payment state tag: {tag!r}")
+        if tag in _registered_state_classes:
+            raise ValueError(f"Payment state tag {tag} is already registered to {_registered_state_classes[tag]}")
+        cls.encoding_tag = tag
+        _registered_state_classes[tag] = cls
+        return cls
+
+    return decorator
+
+
+def get_registered_state_class(tag: str) -> type["PaymentStatus"] | None:
+    return _registered_state_classes.get(tag)
+
+
+def _is_json_round_trippable(value: Any) -> bool:
+    """
+    Check whether JSON encoding and then decoding the value gives back an equal value
+    of exactly the same types. E.g. tuples would be decoded as lists, and non-str dict
+    keys as strings.
+    """
+    if value is None or type(value) in (str, int, float, bool):
+        return True
+    if type(value) is list:
+        return all(_is_json_round_trippable(item) for item in value)
+    if type(value) is dict:
+        return all(type(key) is str and _is_json_round_trippable(item) for key, item in value.items())
+    return False
+
 
 class PaymentStatus:
     status: PaymentMethodStatus
     amount: Decimal
 
+    # Type tag and field layout version used by the compact encoding. See ``register_state_class``.
+    encoding_tag: ClassVar[str | None] = None
+    encoding_version: ClassVar[int] = 1
+
     def __init__(self, amount: Decimal) -> None:
         self.amount = amount
 
     def get_required_action(self) -> RequiredAction:
         raise NotImplementedError("Subclass does not implement get_required_action()")
 
+    def encode_fields(self) -> list[Any]:
+        raise NotImplementedError("Subclass does not implement encode_fields()")
+
+    @classmethod
+    def decode_fields(cls, version: int, fields: list[Any]) -> Self:
+        raise NotImplementedError("Subclass does not implement decode_fields(version, fields)")
+
 
 class SourceBoundPaymentStatus(PaymentStatus):
     def __init__(
@@ -63,23 +115,36 @@ class SourceBoundPaymentStatus(PaymentStatus):
         super().__init__(amount)
         self.source_id = source_id
 
+    def encode_fields(self) -> list[Any]:
+        return [str(self.amount), self.source_id]
 
+    @classmethod
+    def decode_fields(cls, version: int, fields: list[Any]) -> Self:
+        amount, source_id = fields
+        return cls(Decimal(amount), source_id=source_id)
+
+
+@register_state_class("complete")
 class Complete(SourceBoundPaymentStatus):
     status = PaymentMethodStatus.COMPLETE
 
 
+@register_state_class("deferred")
 class Deferred(SourceBoundPaymentStatus):
     status = PaymentMethodStatus.DEFERRED
 
 
+@register_state_class("declined")
 class Declined(SourceBoundPaymentStatus):
     status = PaymentMethodStatus.DECLINED
 
 
+@register_state_class("consumed")
 class Consumed(SourceBoundPaymentStatus):
     status = PaymentMethodStatus.CONSUMED
 
 
+@register_state_class("form-post-required")
 class FormPostRequired(PaymentStatus):
     status = PaymentMethodStatus.PENDING
     form_data: FormPostRequiredFormData
@@ -104,7 +169,28 @@ class FormPostRequired(PaymentStatus):
     def get_required_action(self) -> RequiredAction:
         return self.form_data
 
+    def encode_fields(self) -> list[Any]:
+        return [
+            str(self.amount),
+            self.form_data["name"],
+            self.form_data["url"],
+            self.form_data["method"],
+            [[field["key"], field["value"]] for field in self.form_data["fields"]],
+        ]
+
+    @classmethod
+    def decode_fields(cls, version: int, fields: list[Any]) -> Self:
+        amount, name, url, method, form_fields = fields
+        return cls(
+            Decimal(amount),
+            name=name,
+            url=url,
+            method=method,
+            fields=[FormPostRequiredFormDataField(key=key, value=value) for key, value in form_fields],
+        )
 
+
+@register_state_class("client-side-payment-required")
 class ClientSidePaymentRequired(PaymentStatus):
     status = PaymentMethodStatus.PENDING
     action_data: ClientSidePaymentData
@@ -124,3 +210,23 @@ class ClientSidePaymentRequired(PaymentStatus):
 
     def get_required_action(self) -> RequiredAction:
         return self.action_data
+
+    def encode_fields(self) -> list[Any]:
+        # Processor data is arbitrary, so make sure it would decode unchanged. Otherwise the
+        # state is pickled instead.
+        if not _is_json_round_trippable(self.action_data["data"]):
+            raise TypeError("Client-side payment data doesn't survive a JSON round trip")
+        return [
+            str(self.amount),
+            self.action_data["payment_processor"],
+            self.action_data["data"],
+        ]
+
+    @classmethod
+    def decode_fields(cls, version: int, fields: list[Any]) -> Self:
+        amount, payment_processor, data = fields
+        return cls(
+            Decimal(amount),
+            payment_processor=payment_processor,
+            data=data,
+        )
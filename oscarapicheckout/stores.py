@@ -0,0 +1,551 @@
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+from contextlib import contextmanager
+from typing import Any
+import base64
+import json
+import logging
+import pickle
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, QuerySet
+from django.http import HttpRequest
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from oscar.core.loading import get_model
+
+from . import settings
+from .models import PaymentState
+from .states import PaymentMethodStatus, PaymentStatus, get_registered_state_class
+
+Order = get_model("order", "Order")
+
+logger = logging.getLogger(__name__)
+
+CHECKOUT_ORDER_ID = "checkout_order_id"
+CHECKOUT_PAYMENT_STEPS = "api_checkout_payment_steps"
+
+type StateVersion = int | str
+
+
+class PaymentStateConflict(Exception):
+    pass
+
+
+def _session_pickle(obj: Any) -> str:
+    pickled = pickle.dumps(obj)
+    base64ed = base64.standard_b64encode(pickled)
+    utfed = base64ed.decode("utf8")
+    return utfed
+
+
+def _session_unpickle(utfed: str) -> Any:
+    base64ed = utfed.encode("utf8")
+    pickled = base64.standard_b64decode(base64ed)
+    obj = pickle.loads(pickled)
+    return obj
+
+
+def encode_state(state: PaymentStatus) -> str:
+    """
+    Encode a payment state into a compact JSON array of ``[tag, version, *fields]``.
+    States whose class isn't registered using ``states.register_state_class`` fall
+    back to the legacy pickle encoding.
+    """
+    tag = state.encoding_tag
+    if tag is not None and get_registered_state_class(tag) is type(state):
+        try:
+            return json.dumps([tag, state.encoding_version, *state.encode_fields()], separators=(",", ":"))
+        except TypeError:
+            logger.warning("Payment state %r isn't JSON serializable. Falling back to pickle.", state)
+    return _session_pickle(state)
+
+
+def decode_state(data: str) -> PaymentStatus:
+    """
+    Decode a payment state previously encoded with ``encode_state``. Legacy
+    base64-encoded pickles are still accepted.
+    """
+    if not data.startswith("["):
+        return _session_unpickle(data)  # type:ignore[no-any-return]
+    tag, version, *fields = json.loads(data)
+    StateClass = get_registered_state_class(tag)
+    if StateClass is None:
+        raise ValueError(f"Unknown payment state tag: {tag}")
+    return StateClass.decode_fields(version, fields)
+
+
+def peek_state_status(data: str) -> PaymentMethodStatus | None:
+    """
+    Get the status of an encoded payment state by reading only its type tag,
+    without decoding the rest of it. Returns ``None`` if the status can't be
+    determined this way (e.g. for legacy pickled states).
+    """
+    if not data.startswith('["'):
+        return None
+    tag = data[2 : data.find('"', 2)]
+    StateClass = get_registered_state_class(tag)
+    return StateClass.status if StateClass is not None else None
+
+
+class LazyPaymentStates(Mapping[str, PaymentStatus]):
+    """
+    Read-only mapping of method keys to payment states which decodes each state
+    only when it is first accessed.
+
+    ``versions`` holds the version stamp of each state at the time it was read,
+    for use with ``PaymentStateStore.compare_and_set``. Unless the store provides
+    its own, the encoded state itself is used as its version stamp.
+    """
+
+    versions: dict[str, StateVersion]
+
+    def __init__(
+        self,
+        encoded: Mapping[str, str],
+        decoder: Callable[[str], PaymentStatus],
+        versions: Mapping[str, StateVersion] | None = None,
+    ) -> None:
+        self._encoded = encoded
+        self._decoder = decoder
+        self.versions = dict(versions if versions is not None else encoded)
+
+    def __getitem__(self, method_key: str) -> PaymentStatus:
+        return self._decoder(self._encoded[method_key])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._encoded)
+
+    def __len__(self) -> int:
+        return len(self._encoded)
+
+    def get_status(self, method_key: str) -> PaymentMethodStatus:
+        status = peek_state_status(self._encoded[method_key])
+        if status is None:
+            status = self[method_key].status
+        return status
+
+    def statuses(self) -> dict[str, PaymentMethodStatus]:
+        return {method_key: self.get_status(method_key) for method_key in self}
+
+
+class PaymentStateStore:
+    """
+    Persists the PaymentStatus of each payment method used on an order, keyed by
+    order and method key. Concrete backends are selected using the
+    ``API_CHECKOUT_PAYMENT_STATE_STORE`` setting.
+
+    When ``order`` is omitted, the order currently being checked-out in the
+    request's session is used.
+    """
+
+    def __init__(self, request: HttpRequest | None = None) -> None:
+        self.request = request
+        # Decoded states, keyed by their encoded form, so that each distinct state
+        # is decoded at most once for the lifetime of the store (i.e. the request).
+        self._decoded: dict[str, PaymentStatus] = {}
+
+    def _encode(self, state: PaymentStatus) -> str:
+        data = encode_state(state)
+        self._decoded[data] = state
+        return data
+
+    def _decode(self, data: str) -> PaymentStatus:
+        if data not in self._decoded:
+            self._decoded[data] = decode_state(data)
+        return self._decoded[data]
+
+    def _lazy(
+        self,
+        encoded: Mapping[str, str],
+        versions: Mapping[str, StateVersion] | None = None,
+    ) -> "LazyPaymentStates":
+        return LazyPaymentStates(encoded, self._decode, versions)
+
+    def get_order_id(self, order: Order | None = None) -> int | None:
+        if order is not None:
+            return order.pk
+        if self.request is None:
+            return None
+        return self.request.session.get(CHECKOUT_ORDER_ID)
+
+    def list(self, order: Order | None = None) -> "LazyPaymentStates":
+        raise NotImplementedError("Subclass must implement list(order=None)")
+
+    def get(self, method_key: str, order: Order | None = None) -> PaymentStatus | None:
+        return self.list(order).get(method_key)
+
+    def set(self, method_key: str, state: PaymentStatus, order: Order | None = None) -> None:
+        raise NotImplementedError("Subclass must implement set(method_key, state, order=None)")
+
+    def set_many(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        """
+        Store each of the given states, leaving any other stored states untouched.
+        Backends should override this to write the states in a single operation.
+        """
+        for method_key, state in states.items():
+            self.set(method_key, state, order=order)
+
+    def replace(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        """
+        Replace every stored state for the order with the given states. Backends
+        should override this to write the new state map in a single operation.
+        """
+        self.clear(order=order)
+        self.set_many(states, order=order)
+
+    def compare_and_set(
+        self,
+        states: Mapping[str, PaymentStatus],
+        expected_versions: Mapping[str, StateVersion | None],
+        order: Order | None = None,
+    ) -> bool:
+        """
+        Store the given states, but only if the version stamp of every method key in
+        ``expected_versions`` still matches (``None`` meaning the key must not exist).
+        Returns ``False``, without writing anything, if the versions didn't match.
+
+        This default implementation isn't atomic. Backends which can be written to
+        concurrently should override it.
+        """
+        current_versions = self.list(order=order).versions
+        if any(current_versions.get(key) != version for key, version in expected_versions.items()):
+            return False
+        self.set_many(states, order=order)
+        return True
+
+    def delete(self, method_keys: Iterable[str], order: Order | None = None) -> None:
+        raise NotImplementedError("Subclass must implement delete(method_keys, order=None)")
+
+    def clear(self, order: Order | None = None) -> None:
+        raise NotImplementedError("Subclass must implement clear(order=None)")
+
+
+class SessionPaymentStateStore(PaymentStateStore):
+    """
+    Stores payment states in the user's session. This is the default backend.
+    Since the session belongs to the shopper rather than to an order, states are
+    shared by every order placed within the session, which allows a pending
+    payment to be recycled when the shopper re-submits checkout.
+
+    Django sessions are saved with last-write-wins semantics, so concurrent
+    updates to the same session (e.g. two simultaneous gateway callbacks) can
+    be lost. Use an order-keyed store if that is a concern.
+    """
+
+    def _get_session_states(self) -> dict[str, str]:
+        if self.request is None:
+            raise RuntimeError("SessionPaymentStateStore requires a request. Use an order-keyed store, such as DatabasePaymentStateStore, instead.")
+        return self.request.session.get(CHECKOUT_PAYMENT_STEPS, {})  # type:ignore[no-any-return]
+
+    def _set_session_states(self, states: dict[str, str]) -> None:
+        assert self.request is not None
+        self.request.session[CHECKOUT_PAYMENT_STEPS] = states
+        self.request.session.modified = True
+
+    def list(self, order: Order | None = None) -> "LazyPaymentStates":
+        return self._lazy(dict(self._get_session_states()))
+
+    def get(self, method_key: str, order: Order | None = None) -> PaymentStatus | None:
+        state = self._get_session_states().get(method_key)
+        return self._decode(state) if state is not None else None
+
+    def set(self, method_key: str, state: PaymentStatus, order: Order | None = None) -> None:
+        states = self._get_session_states()
+        states[method_key] = self._encode(state)
+        self._set_session_states(states)
+
+    def set_many(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        session_states = self._get_session_states()
+        session_states.update({method_key: self._encode(state) for method_key, state in states.items()})
+        self._set_session_states(session_states)
+
+    def replace(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        self._set_session_states({method_key: self._encode(state) for method_key, state in states.items()})
+
+    def delete(self, method_keys: Iterable[str], order: Order | None = None) -> None:
+        states = self._get_session_states()
+        for method_key in method_keys:
+            states.pop(method_key, None)
+        self._set_session_states(states)
+
+    def clear(self, order: Order | None = None) -> None:
+        self._set_session_states({})
+
+
+class DatabasePaymentStateStore(PaymentStateStore):
+    """
+    Stores payment states in the ``oscarapicheckout.PaymentState`` table, one
+    row per order and method key. Since states aren't tied to the shopper's
+    session, they can be updated by any worker (e.g. when handling a gateway
+    webhook). Every write increments the row's version.
+    """
+
+    def _get_queryset(self, order_id: int) -> QuerySet[PaymentState]:
+        return PaymentState.objects.filter(order_id=order_id)
+
+    def list(self, order: Order | None = None) -> "LazyPaymentStates":
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return self._lazy({})
+        rows = self._get_queryset(order_id).order_by("pk").values_list("method_key", "state", "version")
+        return self._lazy(
+            {method_key: state for method_key, state, _version in rows},
+            {method_key: version for method_key, _state, version in rows},
+        )
+
+    def get(self, method_key: str, order: Order | None = None) -> PaymentStatus | None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return None
+        state = self._get_queryset(order_id).filter(method_key=method_key).values_list("state", flat=True).first()
+        return self._decode(state) if state is not None else None
+
+    def set(self, method_key: str, state: PaymentStatus, order: Order | None = None) -> None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            raise RuntimeError("Can not store a payment state without an order")
+        data = self._encode(state)
+        updated = (
+            self._get_queryset(order_id)
+            .filter(method_key=method_key)
+            .update(
+                state=data,
+                version=F("version") + 1,
+                date_updated=timezone.now(),
+            )
+        )
+        if not updated:
+            PaymentState.objects.create(order_id=order_id, method_key=method_key, state=data)
+
+    def set_many(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            raise RuntimeError("Can not store a payment state without an order")
+        versions = dict(self._get_queryset(order_id).filter(method_key__in=list(states.keys())).values_list("method_key", "version"))
+        PaymentState.objects.bulk_create(
+            [
+                PaymentState(
+                    order_id=order_id,
+                    method_key=method_key,
+                    state=self._encode(state),
+                    version=versions.get(method_key, 0) + 1,
+                )
+                for method_key, state in states.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["order", "method_key"],
+            update_fields=["state", "version", "date_updated"],
+        )
+
+    @transaction.atomic()
+    def replace(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            raise RuntimeError("Can not store a payment state without an order")
+        self._get_queryset(order_id).exclude(method_key__in=list(states.keys())).delete()
+        self.set_many(states, order=order)
+
+    def compare_and_set(
+        self,
+        states: Mapping[str, PaymentStatus],
+        expected_versions: Mapping[str, StateVersion | None],
+        order: Order | None = None,
+    ) -> bool:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            raise RuntimeError("Can not store a payment state without an order")
+        try:
+            with transaction.atomic():
+                for method_key, state in states.items():
+                    self._compare_and_set_row(order_id, method_key, state, expected_versions.get(method_key))
+                # Keys which were only given a version to check, but no new state
+                for method_key in set(expected_versions) - set(states):
+                    expected = expected_versions[method_key]
+                    rows = self._get_queryset(order_id).filter(method_key=method_key)
+                    matched = rows.filter(version=expected).exists() if expected is not None else not rows.exists()
+                    if not matched:
+                        raise PaymentStateConflict(method_key)
+        except PaymentStateConflict:
+            return False
+        return True
+
+    def _compare_and_set_row(self, order_id: int, method_key: str, state: PaymentStatus, expected: StateVersion | None) -> None:
+        data = self._encode(state)
+        if expected is None:
+            try:
+                with transaction.atomic():
+                    PaymentState.objects.create(order_id=order_id, method_key=method_key, state=data)
+            except IntegrityError:
+                raise PaymentStateConflict(method_key)
+            return
+        updated = PaymentState.objects.filter(
+            order_id=order_id,
+            method_key=method_key,
+            version=expected,
+        ).update(
+            state=data,
+            version=F("version") + 1,
+            date_updated=timezone.now(),
+        )
+        if not updated:
+            raise PaymentStateConflict(method_key)
+
+    def delete(self, method_keys: Iterable[str], order: Order | None = None) -> None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return
+        self._get_queryset(order_id).filter(method_key__in=list(method_keys)).delete()
+
+    def clear(self, order: Order | None = None) -> None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return
+        self._get_queryset(order_id).delete()
+
+
+class CachePaymentStateStore(PaymentStateStore):
+    """
+    Stores payment states in the default Django cache. Each state is stored under
+    its own key, alongside an index key listing the method keys in use for the
+    order.
+
+    The cache API has no compare-and-swap primitive, so every write to an order's
+    states is serialized with a short-lived lock. ``cache.add`` is atomic on every
+    shared backend. Writers wait up to ``lock_wait`` seconds for the lock.
+    """
+
+    cache_timeout: int = 60 * 60 * 24  # 24 hours
+    lock_timeout: int = 10
+    lock_wait: float = 5
+    poll_interval: float = 0.02
+
+    def _index_key(self, order_id: int) -> str:
+        return f"oscarapicheckout.stores.{self.__class__.__name__}.{order_id}"
+
+    def _state_key(self, order_id: int, method_key: str) -> str:
+        return f"{self._index_key(order_id)}.{method_key}"
+
+    def _get_index(self, order_id: int) -> list[str]:
+        return cache.get(self._index_key(order_id)) or []
+
+    @contextmanager
+    def _lock(self, order_id: int) -> Iterator[None]:
+        """
+        Hold the write lock of the order's states, raising ``PaymentStateConflict``
+        if it couldn't be acquired within ``lock_wait`` seconds.
+        """
+        lock_key = f"{self._index_key(order_id)}.lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_wait
+        while not cache.add(lock_key, token, self.lock_timeout):
+            if time.monotonic() >= deadline:
+                raise PaymentStateConflict(f"Timed out waiting for the payment state lock of order {order_id}")
+            time.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            # Don't release a lock which expired and was then taken by another writer
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    def _require_order_id(self, order: Order | None) -> int:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            raise RuntimeError("Can not store a payment state without an order")
+        return order_id
+
+    def list(self, order: Order | None = None) -> "LazyPaymentStates":
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return self._lazy({})
+        method_keys = self._get_index(order_id)
+        state_keys = {self._state_key(order_id, method_key): method_key for method_key in method_keys}
+        found = cache.get_many(state_keys.keys())
+        return self._lazy({state_keys[key]: found[key] for key in state_keys if key in found})
+
+    def get(self, method_key: str, order: Order | None = None) -> PaymentStatus | None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return None
+        state = cache.get(self._state_key(order_id, method_key))
+        return self._decode(state) if state is not None else None
+
+    def set(self, method_key: str, state: PaymentStatus, order: Order | None = None) -> None:
+        self.set_many({method_key: state}, order=order)
+
+    def _set_entries(self, order_id: int, states: Mapping[str, PaymentStatus], method_keys: Sequence[str]) -> None:
+        entries: dict[str, Any] = {self._state_key(order_id, method_key): self._encode(state) for method_key, state in states.items()}
+        entries[self._index_key(order_id)] = method_keys
+        cache.set_many(entries, self.cache_timeout)
+
+    def _set_many(self, order_id: int, states: Mapping[str, PaymentStatus]) -> None:
+        method_keys = self._get_index(order_id)
+        method_keys += [k for k in states if k not in method_keys]
+        self._set_entries(order_id, states, method_keys)
+
+    def set_many(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        order_id = self._require_order_id(order)
+        with self._lock(order_id):
+            self._set_many(order_id, states)
+
+    def replace(self, states: Mapping[str, PaymentStatus], order: Order | None = None) -> None:
+        order_id = self._require_order_id(order)
+        with self._lock(order_id):
+            stale = [k for k in self._get_index(order_id) if k not in states]
+            if stale:
+                cache.delete_many([self._state_key(order_id, method_key) for method_key in stale])
+            self._set_entries(order_id, states, list(states.keys()))
+
+    def compare_and_set(
+        self,
+        states: Mapping[str, PaymentStatus],
+        expected_versions: Mapping[str, StateVersion | None],
+        order: Order | None = None,
+    ) -> bool:
+        order_id = self._require_order_id(order)
+        try:
+            with self._lock(order_id):
+                current_versions = self.list(order=order).versions
+                if any(current_versions.get(key) != version for key, version in expected_versions.items()):
+                    return False
+                self._set_many(order_id, states)
+        except PaymentStateConflict:
+            return False
+        return True
+
+    def delete(self, method_keys: Iterable[str], order: Order | None = None) -> None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return
+        to_delete = set(method_keys)
+        with self._lock(order_id):
+            cache.delete_many([self._state_key(order_id, method_key) for method_key in to_delete])
+            remaining = [k for k in self._get_index(order_id) if k not in to_delete]
+            cache.set(self._index_key(order_id), remaining, self.cache_timeout)
+
+    def clear(self, order: Order | None = None) -> None:
+        order_id = self.get_order_id(order)
+        if order_id is None:
+            return
+        with self._lock(order_id):
+            method_keys = self._get_index(order_id)
+            cache.delete_many([self._state_key(order_id, method_key) for method_key in method_keys])
+            cache.delete(self._index_key(order_id))
+
+
+def get_payment_state_store(request: HttpRequest | None = None) -> PaymentStateStore:
+    """
+    Get the configured payment state store. The store is memoized on the request
+    so that decoded states are shared by every call made while handling it.
+    """
+    StoreClass: type[PaymentStateStore] = import_string(settings.get_setting("API_CHECKOUT_PAYMENT_STATE_STORE"))
+    if request is None:
+        return StoreClass(request)
+    store: PaymentStateStore | None = getattr(request, "_payment_state_store", None)
+    if store is None or type(store) is not StoreClass:
+        store = StoreClass(request)
+        request._payment_state_store = store  # type:ignore[attr-defined]
+    return store
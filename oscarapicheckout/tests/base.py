@@ -17,9 +17,9 @@ class BaseTest(APITestCase):
             printable_name="United States",
         )
 
-    def login(self, is_staff=False, email="joe@example.com"):
-        user = User.objects.create_user(username="joe", password="schmoe", email=email)
+    def login(self, is_staff=False, email="joe@example.com", username="joe"):
+        user = User.objects.create_user(username=username, password="schmoe", email=email)
         user.is_staff = is_staff
         user.save()
-        self.client.login(username="joe", password="schmoe")
+        self.client.login(username=username, password="schmoe")
         return user
@@ -1,20 +1,46 @@
 from decimal import Decimal as D
 from unittest import mock
+import json
 
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from oscar.apps.customer.alerts.receivers import send_product_alerts
+from oscar.apps.partner.receivers import update_stock_alerts
 from oscar.core.loading import get_class, get_model
 from oscar.test import factories
 from rest_framework import status
 from rest_framework.reverse import reverse
 
+from sandbox.creditcards.methods import CreditCard
+
+from .. import utils
+from ..idempotency import IdempotentRequest, get_request_fingerprint
+from ..leases import BasketCheckoutLease
+from ..locking import CheckoutLockUnavailable
 from ..serializers import OrderTokenField
-from ..signals import order_payment_authorized, order_placed, pre_calculate_total
+from ..signals import (
+    checkout_lease_acquired,
+    checkout_lease_contended,
+    order_payment_authorized,
+    order_placed,
+    pre_calculate_total,
+)
+from ..stores import CHECKOUT_PAYMENT_STEPS, decode_state, encode_state
 from ..utils import _set_order_payment_declined
 from .base import BaseTest
 
 Order = get_model("order", "Order")
 OrderLineDiscount = get_model("order", "OrderLineDiscount")
+ShippingAddress = get_model("order", "ShippingAddress")
+BillingAddress = get_model("order", "BillingAddress")
+UserAddress = get_model("address", "UserAddress")
 Basket = get_model("basket", "Basket")
+StockRecord = get_model("partner", "StockRecord")
 Default = get_class("partner.strategy", "Default")
 OrderCreator = get_class("order.utils", "OrderCreator")
 
@@ -3307,6 +3333,27 @@ class CheckoutAPITest(BaseTest):
         # API should return a new Basket now
         self.assertNotEqual(self._get_basket_id(), basket_id)
 
+    def test_failed_order_placement_rolls_back_addresses(self):
+        self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {"cash": {"enabled": True, "pay_balance": True}}
+
+        # Placing the order fails after the addresses have been saved, in the same transaction
+        def lock_checkout_rows(basket):
+            self.assertEqual(ShippingAddress.objects.count(), 1)
+            self.assertEqual(BillingAddress.objects.count(), 1)
+            raise CheckoutLockUnavailable()
+
+        with mock.patch("oscarapicheckout.mixins.lock_checkout_rows", side_effect=lock_checkout_rows) as lock:
+            order_resp = self._checkout(data)
+        self.assertEqual(lock.call_count, 1)
+        self.assertEqual(order_resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(ShippingAddress.objects.count(), 0)
+        self.assertEqual(BillingAddress.objects.count(), 0)
+        self.assertEqual(UserAddress.objects.count(), 0)
+
     def test_voucher_for_order_payment_declined(self):
         # Login as one user
         self.login(is_staff=False)
@@ -3884,3 +3931,455 @@ class CheckoutAPITest(BaseTest):
 
         # The recycled state should have the same action data (including token)
         self.assertEqual(action1, action2)
+
+    def test_split_payment_state_encoding_is_linear(self):
+        """
+        Placing an order with N payment methods should encode each state once, and
+        shouldn't decode them again to evaluate the order status.
+        """
+        for num_methods in (1, 3, 5):
+            with self.subTest(num_methods=num_methods):
+                basket_id = self._prepare_basket()
+                data = self._get_checkout_data(basket_id)
+                data["payment"] = {
+                    f"credit-card-{i}": {
+                        "method_type": "credit-card",
+                        "enabled": True,
+                        "pay_balance": i == 0,
+                        "amount": "1.00",
+                    }
+                    for i in range(num_methods)
+                }
+                with (
+                    mock.patch("oscarapicheckout.stores.encode_state", wraps=encode_state) as encode,
+                    mock.patch("oscarapicheckout.stores.decode_state", wraps=decode_state) as decode,
+                ):
+                    order_resp = self._checkout(data)
+                self.assertEqual(order_resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(encode.call_count, num_methods)
+                self.assertEqual(decode.call_count, 0)
+
+                # Clear out the session so that the next iteration starts fresh
+                self.client.logout()
+
+    def test_split_payment_consumption_is_linear(self):
+        """
+        Authorizing an order with N complete payment methods should consume them all
+        with a single batch of N encodes, rather than re-evaluating the order status
+        (and decoding every state) once per method.
+        """
+        for num_methods in (1, 3, 5):
+            with self.subTest(num_methods=num_methods):
+                self.login(is_staff=True, email=f"joe{num_methods}@example.com", username=f"joe{num_methods}")
+                basket_id = self._prepare_basket()
+                data = self._get_checkout_data(basket_id)
+                data["payment"] = {
+                    f"cash-{i}": {
+                        "method_type": "cash",
+                        "enabled": True,
+                        "pay_balance": i == 0,
+                        "amount": "1.00",
+                    }
+                    for i in range(num_methods)
+                }
+                with (
+                    mock.patch("oscarapicheckout.stores.encode_state", wraps=encode_state) as encode,
+                    mock.patch("oscarapicheckout.stores.decode_state", wraps=decode_state) as decode,
+                ):
+                    order_resp = self._checkout(data)
+                self.assertEqual(order_resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(encode.call_count, num_methods * 2)
+                self.assertEqual(decode.call_count, 0)
+
+                states_resp = self.client.get(order_resp.data["payment_url"])
+                self.assertEqual(states_resp.data["order_status"], "Authorized")
+                for state in states_resp.data["payment_method_states"].values():
+                    self.assertEqual(state["status"], "Consumed")
+                self.client.logout()
+
+    @override_settings(API_CHECKOUT_PAYMENT_STATE_STORE="oscarapicheckout.stores.DatabasePaymentStateStore")
+    def test_form_post_payment_with_database_store(self):
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "credit-card": {
+                "enabled": True,
+                "pay_balance": True,
+            }
+        }
+        order_resp = self._checkout(data)
+        self.assertEqual(order_resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn(CHECKOUT_PAYMENT_STEPS, self.client.session)
+
+        states_resp = self.client.get(order_resp.data["payment_url"])
+        self.assertEqual(states_resp.data["order_status"], "Pending")
+        cc_state = states_resp.data["payment_method_states"]["credit-card"]
+        self.assertEqual(cc_state["status"], "Pending")
+
+        self._do_payment_step_form_post(cc_state["required_action"])
+        states_resp = self.client.get(order_resp.data["payment_url"])
+        cc_state = states_resp.data["payment_method_states"]["credit-card"]
+        self._do_payment_step_form_post(cc_state["required_action"], extra={"uuid": "cc-uuid-12345"})
+
+        states_resp = self.client.get(order_resp.data["payment_url"])
+        self.assertEqual(states_resp.data["order_status"], "Authorized")
+        self.assertEqual(states_resp.data["payment_method_states"]["credit-card"]["status"], "Consumed")
+
+        order = Order.objects.get(number=order_resp.data["number"])
+        self.assertEqual(list(order.payment_states.values_list("method_key", flat=True)), ["credit-card"])
+
+    @override_settings(API_CHECKOUT_PAYMENT_STATE_STORE="oscarapicheckout.stores.DatabasePaymentStateStore")
+    def test_payment_state_updated_by_order_number(self):
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "credit-card": {
+                "enabled": True,
+                "pay_balance": True,
+            }
+        }
+        order_resp = self._checkout(data)
+        self.assertEqual(order_resp.status_code, status.HTTP_200_OK)
+        order_number = order_resp.data["number"]
+
+        # Simulate a gateway webhook, which has no access to the shopper's session
+        order = Order.objects.get(number=order_number)
+        new_state = CreditCard().record_successful_authorization(order, D("10.00"), "webhook-ref")
+        with self.captureOnCommitCallbacks(execute=True):
+            updated_order = utils.update_payment_method_state_by_order_number(order_number, "credit-card", new_state)
+        self.assertEqual(updated_order.status, "Authorized")
+        self.assertEqual(len(mail.outbox), 1)
+
+        states = utils.list_payment_method_states_by_order_number(order_number)
+        self.assertEqual(states["credit-card"].status, "Consumed")
+
+        # The shopper sees the update too
+        states_resp = self.client.get(order_resp.data["payment_url"])
+        self.assertEqual(states_resp.data["order_status"], "Authorized")
+        self.assertEqual(states_resp.data["payment_method_states"]["credit-card"]["status"], "Consumed")
+
+    def _checkout_idempotently(self, data, key):
+        url = reverse("api-checkout")
+        return self.client.post(url, data, format="json", headers={"Idempotency-Key": key})
+
+    def test_idempotent_checkout_replays_response(self):
+        self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "cash": {
+                "enabled": True,
+                "amount": "10.00",
+            }
+        }
+        order_placed_handler = mock.MagicMock()
+        order_placed.connect(order_placed_handler)
+        self.addCleanup(order_placed.disconnect, order_placed_handler)
+
+        resp1 = self._checkout_idempotently(data, "retry-me")
+        self.assertEqual(resp1.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Idempotent-Replayed", resp1.headers)
+
+        # A retry with the same key gets the same response, without placing the order again
+        resp2 = self._checkout_idempotently(data, "retry-me")
+        self.assertEqual(resp2.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp2.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(resp2.data["number"], resp1.data["number"])
+        self.assertEqual(resp2.data, json.loads(resp1.content))
+        self.assertEqual(order_placed_handler.call_count, 1)
+        self.assertEqual(Order.objects.count(), 1)
+
+        # Re-using the key for a different request is an error
+        data["payment"]["cash"]["amount"] = "5.00"
+        resp3 = self._checkout_idempotently(data, "retry-me")
+        self.assertEqual(resp3.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertNotIn("Idempotent-Replayed", resp3.headers)
+        self.assertEqual(
+            resp3.data["non_field_errors"],
+            ["This idempotency key was already used for a different request."],
+        )
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_idempotent_checkout_failures_not_replayed(self):
+        self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        # Provide more payment than is necessary
+        data["payment"] = {
+            "cash": {"enabled": True, "pay_balance": False, "amount": "20.00"},
+            "credit-card": {"enabled": True, "pay_balance": True},
+        }
+        resp1 = self._checkout_idempotently(data, "fix-me")
+        self.assertEqual(resp1.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+        resp = self._checkout_idempotently(data, "fix-me")
+        self.assertEqual(resp.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+        self.assertEqual(resp.data, resp1.data)
+
+        # The corrected request can re-use the key
+        data["payment"] = {"cash": {"enabled": True, "pay_balance": True}}
+        resp = self._checkout_idempotently(data, "fix-me")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+        self.assertEqual(Order.objects.count(), 1)
+
+    @mock.patch.object(IdempotentRequest, "wait_timeout", 0)
+    def test_idempotent_checkout_in_flight(self):
+        user = self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "cash": {
+                "enabled": True,
+                "amount": "10.00",
+            }
+        }
+        # Pretend that the first request with this key is still being processed
+        request = mock.Mock(path=reverse("api-checkout"), data=data)
+        in_flight = IdempotentRequest(request, f"user-{user.pk}", "in-flight")
+        cache.set(in_flight.in_flight_cache_key, in_flight.get_fingerprint())
+        self.addCleanup(cache.delete, in_flight.in_flight_cache_key)
+
+        resp = self._checkout_idempotently(data, "in-flight")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Order.objects.count(), 0)
+
+    def _hold_basket_lease(self, user, basket_id, token="other-request"):
+        lease = BasketCheckoutLease(mock.Mock(), f"user-{user.pk}", str(basket_id))
+        cache.set(lease.cache_key, token)
+        self.addCleanup(cache.delete, lease.cache_key)
+        return lease
+
+    @mock.patch.object(BasketCheckoutLease, "wait_timeout", 0)
+    def test_concurrent_checkout_of_basket_rejected(self):
+        user = self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "cash": {
+                "enabled": True,
+                "amount": "10.00",
+            }
+        }
+        contended = mock.MagicMock()
+        checkout_lease_contended.connect(contended)
+        self.addCleanup(checkout_lease_contended.disconnect, contended)
+
+        self._hold_basket_lease(user, basket_id)
+        resp = self._checkout(data)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(contended.call_count, 1)
+        self.assertEqual(contended.call_args.kwargs["outcome"], "rejected")
+        self.assertEqual(contended.call_args.kwargs["basket_id"], str(basket_id))
+
+    @mock.patch.object(BasketCheckoutLease, "wait_timeout", 0)
+    def test_concurrent_checkout_of_basket_coalesced(self):
+        user = self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "cash": {
+                "enabled": True,
+                "amount": "10.00",
+            }
+        }
+        contended = mock.MagicMock()
+        checkout_lease_contended.connect(contended)
+        self.addCleanup(checkout_lease_contended.disconnect, contended)
+
+        # Another request for the same basket is holding the lease, and has already placed the order
+        lease = self._hold_basket_lease(user, basket_id, token="winner")
+        cache.set(
+            lease.get_result_cache_key("winner"),
+            {
+                "fingerprint": get_request_fingerprint(mock.Mock(data=data)),
+                "status": status.HTTP_200_OK,
+                "data": {"number": "100001"},
+            },
+        )
+        self.addCleanup(cache.delete, lease.get_result_cache_key("winner"))
+
+        resp = self._checkout(data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Checkout-Coalesced"], "true")
+        self.assertEqual(resp.data["number"], "100001")
+        self.assertEqual(Order.objects.count(), 0)
+        self.assertEqual(contended.call_args.kwargs["outcome"], "coalesced")
+
+    def test_concurrent_checkout_coalesced_onto_cached_result(self):
+        user = self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "cash": {
+                "enabled": True,
+                "amount": "10.00",
+            }
+        }
+        with mock.patch("oscarapicheckout.leases.uuid.uuid4", return_value=mock.Mock(hex="winner")):
+            resp1 = self._checkout(data)
+        self.assertEqual(resp1.status_code, status.HTTP_200_OK)
+        lease = BasketCheckoutLease(mock.Mock(), f"user-{user.pk}", str(basket_id))
+        self.addCleanup(cache.delete, lease.get_result_cache_key("winner"))
+        self.assertEqual(cache.get(lease.get_result_cache_key("winner"))["data"], json.loads(resp1.content))
+
+        # A duplicate which finds the winner still holding the lease gets its stored response
+        self._hold_basket_lease(user, basket_id, token="winner")
+        with mock.patch.object(BasketCheckoutLease, "wait_timeout", 0):
+            resp2 = self._checkout(data)
+        self.assertEqual(resp2.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp2.headers["Checkout-Coalesced"], "true")
+        self.assertEqual(resp2.data, json.loads(resp1.content))
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_checkout_releases_basket_lease(self):
+        user = self.login(is_staff=True)
+        basket_id = self._prepare_basket()
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {
+            "cash": {
+                "enabled": True,
+                "amount": "10.00",
+            }
+        }
+        acquired = mock.MagicMock()
+        checkout_lease_acquired.connect(acquired)
+        self.addCleanup(checkout_lease_acquired.disconnect, acquired)
+
+        resp = self._checkout(data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        lease = BasketCheckoutLease(mock.Mock(), f"user-{user.pk}", str(basket_id))
+        self.assertIsNone(cache.get(lease.cache_key))
+        self.assertEqual(acquired.call_count, 1)
+        self.assertEqual(acquired.call_args.kwargs["basket_id"], str(basket_id))
+        self.assertFalse(acquired.call_args.kwargs["contended"])
+
+    def _count_order_update_queries(self, num_lines, username):
+        self.login(username=username)
+        basket_id = self._get_basket_id()
+        for _i in range(num_lines):
+            resp = self._add_to_basket(self._create_product().id, quantity=2)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {"credit-card": {"enabled": True, "pay_balance": True}}
+        first_resp = self._checkout(data)
+        self.assertEqual(first_resp.status_code, status.HTTP_200_OK)
+        order = Order.objects.get(number=first_resp.data["number"])
+        _set_order_payment_declined(order, first_resp.wsgi_request)
+
+        query_counts = []
+        update_order = utils.OrderUpdater.update_order
+
+        def counting_update_order(updater, *args, **kwargs):
+            with CaptureQueriesContext(connection) as ctx:
+                updated = update_order(updater, *args, **kwargs)
+            query_counts.append(len(ctx.captured_queries))
+            return updated
+
+        with mock.patch.object(utils.OrderUpdater, "update_order", counting_update_order):
+            retry_resp = self._checkout(data)
+        self.assertEqual(retry_resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry_resp.data["number"], first_resp.data["number"])
+        self.client.logout()
+
+        # The lines were replaced, and their stock re-allocated
+        order.refresh_from_db()
+        self.assertEqual(order.lines.count(), num_lines)
+        self.assertEqual(order.line_prices.count(), num_lines)
+        for line in order.lines.all():
+            self.assertEqual(line.stockrecord.num_allocated, 2)
+        return query_counts[0]
+
+    def test_order_update_query_count_independent_of_line_count(self):
+        # The pre_save/post_save signals of StockRecord.allocate are still sent once per
+        # allocated stockrecord, so the queries of their receivers (Oscar's stock alert and
+        # product alert receivers) scale with the number of lines. Only count our own.
+        for receiver in (update_stock_alerts, send_product_alerts):
+            if post_save.disconnect(receiver, sender=StockRecord):
+                self.addCleanup(post_save.connect, receiver, sender=StockRecord)
+
+        for reconcile in (True, False):
+            with override_settings(API_CHECKOUT_RECONCILE_ORDER_LINES=reconcile):
+                self.assertEqual(
+                    self._count_order_update_queries(2, username=f"joe-{reconcile}-2"),
+                    self._count_order_update_queries(8, username=f"joe-{reconcile}-8"),
+                )
+
+    def test_order_update_reconciles_lines(self):
+        self.login(is_staff=False)
+        basket_id = self._get_basket_id()
+        product_a = self._create_product()
+        product_b = self._create_product()
+        product_c = self._create_product()
+        self._add_to_basket(product_a.id, quantity=1)
+        self._add_to_basket(product_b.id, quantity=2)
+        self._add_to_basket(product_c.id, quantity=1)
+
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {"credit-card": {"enabled": True, "pay_balance": True}}
+        first_resp = self._checkout(data)
+        self.assertEqual(first_resp.status_code, status.HTTP_200_OK)
+        order = Order.objects.get(number=first_resp.data["number"])
+        lines = {line.product_id: line.pk for line in order.lines.all()}
+        _set_order_payment_declined(order, first_resp.wsgi_request)
+
+        # Retrying with the same basket keeps every line, and their stock allocations
+        with CaptureQueriesContext(connection) as ctx:
+            retry_resp = self._checkout(data)
+        self.assertEqual(retry_resp.status_code, status.HTTP_200_OK)
+        self.assertFalse([q for q in ctx.captured_queries if q["sql"].startswith('UPDATE "partner_stockrecord"')])
+        self.assertEqual({line.product_id: line.pk for line in order.lines.all()}, lines)
+        self.assertEqual(order.line_prices.count(), 3)
+        order.refresh_from_db()
+        _set_order_payment_declined(order, retry_resp.wsgi_request)
+
+        # Buy one more B, drop C, and add D
+        product_d = self._create_product()
+        self._add_to_basket(product_b.id, quantity=1)
+        Basket.objects.get(pk=basket_id).lines.filter(product=product_c).delete()
+        self._add_to_basket(product_d.id, quantity=1)
+        retry_resp = self._checkout(data)
+        self.assertEqual(retry_resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry_resp.data["number"], first_resp.data["number"])
+
+        new_lines = {line.product_id: line for line in order.lines.all()}
+        self.assertEqual(new_lines.keys(), {product_a.id, product_b.id, product_d.id})
+        self.assertEqual(new_lines[product_a.id].pk, lines[product_a.id])
+        self.assertEqual(new_lines[product_b.id].pk, lines[product_b.id])
+        self.assertEqual(new_lines[product_b.id].quantity, 3)
+        self.assertEqual(new_lines[product_b.id].line_price_incl_tax, D("30.00"))
+        self.assertEqual(order.line_prices.count(), 3)
+
+        allocated = {product.id: product.stockrecords.get().num_allocated for product in (product_a, product_b, product_c, product_d)}
+        self.assertEqual(
+            allocated,
+            {
+                product_a.id: 1,
+                product_b.id: 3,
+                product_c.id: 0,
+                product_d.id: 1,
+            },
+        )
+
+    def test_order_lines_prepared_before_locking(self):
+        self.login(is_staff=True)
+        basket_id = self._get_basket_id()
+        for _i in range(3):
+            self._add_to_basket(self._create_product().id)
+        data = self._get_checkout_data(basket_id)
+        data["payment"] = {"cash": {"enabled": True, "pay_balance": True}}
+
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self._checkout(data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        # While rows are locked, the product and partner data of the lines isn't fetched anymore
+        queries = [q["sql"] for q in ctx.captured_queries]
+        first_lock = next(i for i, sql in enumerate(queries) if "FOR UPDATE" in sql)
+        allocation = next(i for i, sql in enumerate(queries) if sql.startswith('UPDATE "partner_stockrecord"'))
+        self.assertLess(first_lock, allocation)
+        for sql in queries[first_lock:allocation]:
+            self.assertNotIn('FROM "catalogue_product"', sql)
+            self.assertNotIn('FROM "partner_partner"', sql)
@@ -0,0 +1,302 @@
+from decimal import Decimal
+from threading import Barrier, Event, Thread
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.signing import Signer
+from django.db import OperationalError, connection, transaction
+from django.test import override_settings
+from django.urls import reverse
+from oscar.core.loading import get_model
+from oscar.test import factories
+from oscar.test.factories import create_order
+from rest_framework import status
+from rest_framework.test import APIClient, APITransactionTestCase
+
+from sandbox.clientside.methods import ClientSideCard
+
+from ..locking import lock_rows
+from ..signals import checkout_lease_contended, order_payment_authorized
+from ..states import ClientSidePaymentRequired
+from ..stores import DatabasePaymentStateStore
+
+Country = get_model("address", "Country")
+Order = get_model("order", "Order")
+SourceType = get_model("payment", "SourceType")
+StockRecord = get_model("partner", "StockRecord")
+
+
+@override_settings(API_CHECKOUT_PAYMENT_STATE_STORE="oscarapicheckout.stores.DatabasePaymentStateStore")
+class ConcurrentPaymentCallbackTest(APITransactionTestCase):
+    num_methods = 4
+
+    def test_parallel_callbacks_authorize_once(self):
+        order = create_order(status="Pending", guest_email="guest@example.com")
+        SourceType.objects.create(name=ClientSideCard.name)
+        method_keys = [f"client-side-card-{i}" for i in range(self.num_methods)]
+        DatabasePaymentStateStore().set_many(
+            {key: ClientSidePaymentRequired(Decimal("1.00"), payment_processor="sandbox-processor", data={}) for key in method_keys},
+            order=order,
+        )
+
+        authorized = mock.Mock()
+        order_payment_authorized.connect(authorized)
+        self.addCleanup(order_payment_authorized.disconnect, authorized)
+
+        barrier = Barrier(len(method_keys))
+        status_codes = {}
+
+        def complete_payment(method_key):
+            try:
+                barrier.wait()
+                # Gateway callbacks don't share the shopper's session
+                resp = APIClient(raise_request_exception=False).post(
+                    reverse("clientside-complete"),
+                    {
+                        "amount": "1.00",
+                        "reference_number": order.number,
+                        "transaction_id": Signer().sign(method_key),
+                        "result_token": method_key,
+                    },
+                )
+                status_codes[method_key] = resp.status_code
+            finally:
+                connection.close()
+
+        threads = [Thread(target=complete_payment, args=(key,)) for key in method_keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(status_codes, {key: status.HTTP_200_OK for key in method_keys})
+        order.refresh_from_db()
+        self.assertEqual(order.status, "Authorized")
+        self.assertEqual(authorized.call_count, 1)
+        states = DatabasePaymentStateStore().list(order=order)
+        self.assertEqual(states.statuses(), {key: "Consumed" for key in method_keys})
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_callback_for_order_without_email(self):
+        order = create_order(status="Pending")
+        SourceType.objects.create(name=ClientSideCard.name)
+        DatabasePaymentStateStore().set(
+            "client-side-card",
+            ClientSidePaymentRequired(Decimal("1.00"), payment_processor="sandbox-processor", data={}),
+            order=order,
+        )
+
+        resp = APIClient().post(
+            reverse("clientside-complete"),
+            {
+                "amount": "1.00",
+                "reference_number": order.number,
+                "transaction_id": Signer().sign("client-side-card"),
+                "result_token": "client-side-card",
+            },
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        order.refresh_from_db()
+        self.assertEqual(order.status, "Authorized")
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(API_CHECKOUT_PAYMENT_STATE_MAX_RETRIES=1, API_CHECKOUT_PAYMENT_STATE_RETRY_BACKOFF=0)
+    def test_callback_retryable_when_states_keep_changing(self):
+        order = create_order(status="Pending", guest_email="guest@example.com")
+        SourceType.objects.create(name=ClientSideCard.name)
+        DatabasePaymentStateStore().set(
+            "client-side-card",
+            ClientSidePaymentRequired(Decimal("1.00"), payment_processor="sandbox-processor", data={}),
+            order=order,
+        )
+
+        data = {
+            "amount": "1.00",
+            "reference_number": order.number,
+            "transaction_id": Signer().sign("client-side-card"),
+            "result_token": "client-side-card",
+        }
+        with mock.patch("oscarapicheckout.utils.mark_payment_methods_consumed", return_value=False):
+            resp = APIClient().post(reverse("clientside-complete"), data)
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.data["detail"].code, "payment_state_conflict")
+        self.assertEqual(resp["Retry-After"], "1")
+        order.refresh_from_db()
+        self.assertEqual(order.status, "Pending")
+
+        # Once the concurrent updates finish, the gateway's retry succeeds
+        resp = APIClient().post(reverse("clientside-complete"), data)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        order.refresh_from_db()
+        self.assertEqual(order.status, "Authorized")
+
+
+class ConcurrentCheckoutTest(APITransactionTestCase):
+    num_checkouts = 6
+
+    def setUp(self):
+        Country.objects.create(
+            display_order=0,
+            is_shipping_country=True,
+            iso_3166_1_a2="US",
+            iso_3166_1_a3="USA",
+            iso_3166_1_numeric="840",
+            name="United States of America",
+            printable_name="United States",
+        )
+
+    def _create_product(self):
+        product = factories.create_product(title="Hot Product", product_class="Hot Product Class")
+        record = factories.create_stockrecord(currency="USD", product=product, num_in_stock=1000, price=Decimal("10.00"))
+        factories.create_purchase_info(record)
+        return product
+
+    def _prepare_checkout(self, i, products):
+        username = f"shopper{i}"
+        User.objects.create_user(username=username, password="schmoe", email=f"{username}@example.com")
+        client = APIClient()
+        client.login(username=username, password="schmoe")
+        basket_id = client.get(reverse("api-basket")).data["id"]
+        for product in products:
+            resp = client.post(
+                reverse("api-basket-add-product"),
+                {"url": reverse("product-detail", args=[product.id]), "quantity": 2},
+            )
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        address = {
+            "first_name": "Joe",
+            "last_name": "Schmoe",
+            "line1": "234 5th Ave",
+            "line4": "Manhattan",
+            "postcode": "10001",
+            "state": "NY",
+            "country": reverse("country-detail", args=["US"]),
+            "phone_number": "+1 (717) 467-1111",
+        }
+        data = {
+            "guest_email": f"{username}@example.com",
+            "basket": reverse("basket-detail", args=[basket_id]),
+            "shipping_address": address,
+            "billing_address": address,
+            "payment": {"credit-card": {"enabled": True, "pay_balance": True}},
+        }
+        return client, data
+
+    def test_hot_sku_checkouts(self):
+        hot_products = [self._create_product() for _i in range(3)]
+        checkouts = []
+        for i in range(self.num_checkouts):
+            # Alternate the order in which the hot products are added to the basket
+            products = hot_products if i % 2 else list(reversed(hot_products))
+            checkouts.append(self._prepare_checkout(i, products))
+
+        barrier = Barrier(len(checkouts))
+        responses = []
+
+        def checkout(client, data):
+            try:
+                barrier.wait()
+                responses.append(client.post(reverse("api-checkout"), data, format="json"))
+            finally:
+                connection.close()
+
+        threads = [Thread(target=checkout, args=checkout_args) for checkout_args in checkouts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([resp.status_code for resp in responses], [status.HTTP_200_OK] * self.num_checkouts)
+        self.assertEqual(Order.objects.count(), self.num_checkouts)
+        for product in hot_products:
+            self.assertEqual(product.stockrecords.get().num_allocated, 2 * self.num_checkouts)
+
+    def test_duplicate_checkouts_of_basket_coalesced(self):
+        product = self._create_product()
+        client, data = self._prepare_checkout(0, [product])
+        # A second tab, logged in as the same shopper, submits the same basket
+        duplicate_client = APIClient()
+        duplicate_client.login(username="shopper0", password="schmoe")
+
+        contended = mock.Mock()
+        checkout_lease_contended.connect(contended)
+        self.addCleanup(checkout_lease_contended.disconnect, contended)
+
+        barrier = Barrier(2)
+        responses = []
+
+        def checkout(client):
+            try:
+                barrier.wait()
+                responses.append(client.post(reverse("api-checkout"), data, format="json"))
+            finally:
+                connection.close()
+
+        threads = [Thread(target=checkout, args=(c,)) for c in (client, duplicate_client)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The holder placed the order and released its lease, and the waiter got its response
+        self.assertEqual([resp.status_code for resp in responses], [status.HTTP_200_OK] * 2)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual({resp.data["number"] for resp in responses}, {Order.objects.get().number})
+        self.assertEqual(sorted(resp.headers.get("Checkout-Coalesced", "") for resp in responses), ["", "true"])
+        self.assertEqual(contended.call_args.kwargs["outcome"], "coalesced")
+
+    def _hold_lock(self, stockrecord):
+        locked = Event()
+        release = Event()
+
+        def hold():
+            try:
+                with transaction.atomic():
+                    StockRecord.objects.select_for_update().get(pk=stockrecord.pk)
+                    locked.set()
+                    release.wait(timeout=30)
+            finally:
+                connection.close()
+
+        thread = Thread(target=hold)
+        thread.start()
+        locked.wait(timeout=30)
+
+        def cleanup():
+            release.set()
+            thread.join()
+
+        self.addCleanup(cleanup)
+        return cleanup
+
+    def test_fail_fast_when_stock_locked(self):
+        product = self._create_product()
+        for i, lock_mode in enumerate(("nowait", "skip_locked")):
+            client, data = self._prepare_checkout(i, [product])
+            release = self._hold_lock(product.stockrecords.get())
+            with override_settings(API_CHECKOUT_LOCK_MODE=lock_mode):
+                resp = client.post(reverse("api-checkout"), data, format="json")
+            self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+            self.assertEqual(resp.data["detail"].code, "lock_unavailable")
+            self.assertEqual(Order.objects.count(), 0)
+
+            # Retrying after the lock is released succeeds
+            release()
+            with override_settings(API_CHECKOUT_LOCK_MODE=lock_mode):
+                resp = client.post(reverse("api-checkout"), data, format="json")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            Order.objects.all().delete()
+
+    def test_other_lock_errors_not_masked(self):
+        error = OperationalError("canceling statement due to statement timeout")
+        error.__cause__ = Exception()
+        error.__cause__.pgcode = "57014"  # type: ignore[attr-defined]
+        with (
+            override_settings(API_CHECKOUT_LOCK_MODE="nowait"),
+            mock.patch("django.db.models.query.QuerySet._fetch_all", side_effect=error),
+            transaction.atomic(),
+            self.assertRaises(OperationalError) as cm,
+        ):
+            lock_rows(StockRecord.objects.all(), [1])
+        self.assertIs(cm.exception, error)
@@ -1,15 +1,30 @@
 from datetime import timedelta
 from decimal import Decimal
+from io import StringIO
+from threading import Event
+from typing import Any, ClassVar
+from unittest import mock
+import time
 
+from django import db
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import override_settings
 from django.utils import timezone
 from oscar.core.loading import get_class, get_model
+from oscar.test.factories import create_order
 from rest_framework import serializers
 
 from .. import fraud
+from .. import settings as pkgsettings
+from ..models import OrderAddressFingerprint
+from ..signals import order_updated
 from .base import BaseTest
 
 Order = get_model("order", "Order")
 ShippingAddress = get_model("order", "ShippingAddress")
+BillingAddress = get_model("order", "BillingAddress")
 Basket = get_model("basket", "Basket")
 Default = get_class("partner.strategy", "Default")
 OrderCreator = get_class("order.utils", "OrderCreator")
@@ -55,3 +70,413 @@ class AddressVelocityTest(BaseTest):
         # Address should now fail the fraud check
         with self.assertRaises(serializers.ValidationError):
             fraud.run_enabled_fraud_checks(checkout_data)
+
+
+class RejectAll:
+    def validate(self, *args, **kwargs):
+        raise serializers.ValidationError("Rejected")
+
+
+class ScoreHalf:
+    def validate(self, *args, **kwargs):
+        pass
+
+    def score(self, *args, **kwargs):
+        return 0.5
+
+
+class SlowRule:
+    release = Event()
+
+    def validate(self, *args, **kwargs):
+        self.release.wait(timeout=5)
+
+
+class RecordConnection:
+    connections: ClassVar[list[Any]] = []
+
+    def validate(self, *args, **kwargs):
+        with db.connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.connections.append(db.connection.connection)
+
+
+class FraudChecksTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(fraud.reload_enabled_fraud_checks)
+        fraud.reload_enabled_fraud_checks()
+
+    def test_rules_are_cached(self):
+        rules = fraud.get_enabled_fraud_checks()
+        self.assertEqual(len(rules), 1)
+        self.assertIsInstance(rules[0], fraud.AddressVelocity)
+        self.assertIs(fraud.get_enabled_fraud_checks()[0], rules[0])
+
+    def test_rules_reload_upon_setting_change(self):
+        with override_settings(API_CHECKOUT_FRAUD_CHECKS=[{"rule": "oscarapicheckout.tests.test_fraud.RejectAll", "kwargs": {}}]):
+            rules = fraud.get_enabled_fraud_checks()
+            self.assertEqual(len(rules), 1)
+            self.assertIsInstance(rules[0], RejectAll)
+        self.assertIsInstance(fraud.get_enabled_fraud_checks()[0], fraud.AddressVelocity)
+
+    def test_invalid_rule_cost(self):
+        config = {"rule": "oscarapicheckout.tests.test_fraud.RejectAll", "kwargs": {}, "cost": "free"}
+        msg = "Fraud rule oscarapicheckout.tests.test_fraud.RejectAll has an invalid cost 'free'. Expected one of: cheap, moderate, expensive."
+        # The rules are rebuilt as soon as the setting changes
+        with self.assertRaisesMessage(ImproperlyConfigured, msg), override_settings(API_CHECKOUT_FRAUD_CHECKS=[config]):
+            pass
+        self.assertIsInstance(fraud.get_enabled_fraud_checks()[0], fraud.AddressVelocity)
+
+    def test_setting_overrides_not_leaked(self):
+        with override_settings(API_CHECKOUT_FRAUD_CHECK_MODE="score"):
+            self.assertEqual(pkgsettings.get_setting("API_CHECKOUT_FRAUD_CHECK_MODE"), "score")
+        self.assertEqual(pkgsettings.get_setting("API_CHECKOUT_FRAUD_CHECK_MODE"), "reject")
+        # The module's import-time values aren't changed by overrides
+        self.assertEqual(pkgsettings.API_CHECKOUT_FRAUD_CHECK_MODE, "reject")
+
+    @override_settings(
+        API_CHECKOUT_FRAUD_CHECKS=[
+            {"rule": "oscarapicheckout.fraud.AddressVelocity", "kwargs": {}},
+            {"rule": "oscarapicheckout.tests.test_fraud.RejectAll", "kwargs": {}},
+        ]
+    )
+    def test_metrics(self):
+        address_data = {
+            "line1": "123 Test St",
+            "postcode": "TEST123",
+        }
+        checkout_data = {
+            "shipping_address": address_data,
+            "billing_address": address_data,
+        }
+        for _i in range(2):
+            with self.assertRaises(serializers.ValidationError):
+                fraud.run_enabled_fraud_checks(checkout_data)
+
+        stats = fraud.get_fraud_metrics().stats
+        velocity_stats = stats["oscarapicheckout.fraud.AddressVelocity"]
+        self.assertEqual(velocity_stats.evaluations, 2)
+        self.assertEqual(velocity_stats.rejections, 0)
+        self.assertGreater(velocity_stats.total_duration, 0)
+        reject_stats = stats["oscarapicheckout.tests.test_fraud.RejectAll"]
+        self.assertEqual(reject_stats.evaluations, 2)
+        self.assertEqual(reject_stats.rejections, 2)
+
+
+@override_settings(
+    API_CHECKOUT_FRAUD_CHECK_EXECUTOR="concurrent",
+    API_CHECKOUT_FRAUD_CHECK_DEADLINE=0.2,
+)
+class ConcurrentFraudChecksTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.checkout_data = {
+            "shipping_address": {},
+            "billing_address": {},
+        }
+        self.addCleanup(fraud.reload_enabled_fraud_checks)
+        fraud.reload_enabled_fraud_checks()
+        SlowRule.release.clear()
+        self.addCleanup(SlowRule.release.set)
+
+    def _set_rules(self, *rules):
+        configs = [{"rule": f"oscarapicheckout.tests.test_fraud.{rule}", "kwargs": {}, **extra} for rule, extra in rules]
+        override = override_settings(API_CHECKOUT_FRAUD_CHECKS=configs)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_rejection_short_circuits(self):
+        self._set_rules(("SlowRule", {}), ("RejectAll", {}))
+        started = time.monotonic()
+        with self.assertRaises(serializers.ValidationError):
+            fraud.run_enabled_fraud_checks(self.checkout_data)
+        self.assertLess(time.monotonic() - started, 0.2)
+
+    def test_timeout_fails_open(self):
+        self._set_rules(("SlowRule", {"timeout_policy": "fail_open"}))
+        fraud.run_enabled_fraud_checks(self.checkout_data)
+        stats = fraud.get_fraud_metrics().stats["oscarapicheckout.tests.test_fraud.SlowRule"]
+        self.assertEqual(stats.timeouts, 1)
+
+    def test_timeout_fails_closed(self):
+        self._set_rules(("SlowRule", {"timeout_policy": "fail_closed"}))
+        started = time.monotonic()
+        with self.assertRaises(serializers.ValidationError):
+            fraud.run_enabled_fraud_checks(self.checkout_data)
+        self.assertLess(time.monotonic() - started, 1)
+
+    @override_settings(API_CHECKOUT_FRAUD_CHECK_MAX_WORKERS=1)
+    def test_worker_connections_reused(self):
+        self._set_rules(("RecordConnection", {}))
+        RecordConnection.connections = []
+        conn_settings = db.connections.settings[db.DEFAULT_DB_ALIAS]
+        self.addCleanup(conn_settings.__setitem__, "CONN_MAX_AGE", conn_settings["CONN_MAX_AGE"])
+        conn_settings["CONN_MAX_AGE"] = 60
+        # Close the worker thread's connection, so that the test database can be dropped
+        self.addCleanup(lambda: [conn.close() for conn in RecordConnection.connections])
+
+        for _i in range(2):
+            fraud.run_enabled_fraud_checks(self.checkout_data)
+        self.assertEqual(len(RecordConnection.connections), 2)
+        self.assertIs(RecordConnection.connections[0], RecordConnection.connections[1])
+
+
+class FraudRulePipelineTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(fraud.reload_enabled_fraud_checks)
+        self.checkout_data = {
+            "shipping_address": {},
+            "billing_address": {},
+        }
+
+    def _set_rules(self, *configs, **settings):
+        override = override_settings(API_CHECKOUT_FRAUD_CHECKS=list(configs), **settings)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_cheap_rules_run_first(self):
+        self._set_rules(
+            {"rule": "oscarapicheckout.fraud.AddressVelocity", "kwargs": {}},
+            {"rule": "oscarapicheckout.tests.test_fraud.RejectAll", "kwargs": {}, "cost": "expensive"},
+            {"rule": "oscarapicheckout.fraud.RecaptchaScore", "kwargs": {"min_score": 0.5}},
+        )
+        rules = fraud.get_enabled_fraud_checks()
+        self.assertEqual(
+            [rule.__class__ for rule in rules],
+            [fraud.RecaptchaScore, fraud.AddressVelocity, RejectAll],
+        )
+
+        # A bot is rejected without querying the database
+        with self.assertNumQueries(0), self.assertRaises(serializers.ValidationError):
+            fraud.run_enabled_fraud_checks(self.checkout_data, recaptcha_score=0.1)
+
+    def test_scoring(self):
+        self._set_rules(
+            {"rule": "oscarapicheckout.fraud.RecaptchaScore", "kwargs": {}, "weight": 0.5},
+            {"rule": "oscarapicheckout.tests.test_fraud.ScoreHalf", "kwargs": {}, "weight": 1.0},
+            {"rule": "oscarapicheckout.tests.test_fraud.RejectAll", "kwargs": {}, "cost": "expensive", "weight": 0.2},
+            API_CHECKOUT_FRAUD_CHECK_MODE="score",
+        )
+
+        # 0.5 * 1 + 1.0 * 0.5 crosses the threshold before the expensive rule runs
+        with mock.patch.object(RejectAll, "validate") as validate, self.assertRaises(serializers.ValidationError):
+            fraud.run_enabled_fraud_checks(self.checkout_data, recaptcha_score=0.1)
+        validate.assert_not_called()
+
+        # 0.5 * 0 + 1.0 * 0.5 can no longer cross the threshold, so the expensive rule is skipped
+        with mock.patch.object(RejectAll, "validate") as validate:
+            fraud.run_enabled_fraud_checks(self.checkout_data, recaptcha_score=0.9)
+        validate.assert_not_called()
+
+
+class CachedAddressVelocityTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(fraud.reload_enabled_fraud_checks)
+        override = override_settings(API_CHECKOUT_FRAUD_CHECKS=[{"rule": "oscarapicheckout.fraud.CachedAddressVelocity", "kwargs": {"threshold": 3}}])
+        override.enable()
+        self.addCleanup(override.disable)
+        self.rule = fraud.get_enabled_fraud_checks()[0]
+        self.db_rule = fraud.AddressVelocity(threshold=3)
+
+    def _get_address_data(self, line1):
+        return {
+            "first_name": "John",
+            "last_name": "Doe",
+            "line1": line1,
+            "line2": "",
+            "line3": "",
+            "line4": "Test City",
+            "state": "Test State",
+            "postcode": "TEST123",
+            "country": Country.objects.get(pk="US"),
+        }
+
+    def _place_order(self, shipping_address_data, billing_address_data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_order(
+                shipping_address=ShippingAddress.objects.create(**shipping_address_data),
+                billing_address=BillingAddress.objects.create(**billing_address_data),
+            )
+
+    def test_consistent_with_database_counts(self):
+        address_a = self._get_address_data("123 Test St")
+        address_b = self._get_address_data("456 Other Ave")
+        address_c = self._get_address_data("789 Unused Rd")
+        self._place_order(address_a, address_a)
+        self._place_order(address_a, address_b)
+        self._place_order({**address_a, "line1": "123 TEST ST"}, address_b)
+
+        # The first check of each address counts its orders in the database, and later checks use the cache
+        for address in (address_a, address_b, address_c):
+            for addr_type in ("shipping_address", "billing_address"):
+                with self.assertNumQueries(1):
+                    count = self.rule.get_address_use_count(addr_type, address)
+                self.assertEqual(count, self.db_rule.get_address_use_count(addr_type, address))
+
+        self._place_order(address_b, address_a)
+        for address in (address_a, address_b, address_c):
+            for addr_type in ("shipping_address", "billing_address"):
+                with self.assertNumQueries(0):
+                    count = self.rule.get_address_use_count(addr_type, address)
+                self.assertEqual(count, self.db_rule.get_address_use_count(addr_type, address))
+
+        checkout_data = {
+            "shipping_address": address_a,
+            "billing_address": address_c,
+        }
+        with self.assertNumQueries(0), self.assertRaises(serializers.ValidationError):
+            fraud.run_enabled_fraud_checks(checkout_data)
+
+    def test_updated_orders_counted_once(self):
+        address_a = self._get_address_data("123 Test St")
+        address_b = self._get_address_data("456 Other Ave")
+        for address in (address_a, address_b):
+            for addr_type in ("shipping_address", "billing_address"):
+                self.rule.get_address_use_count(addr_type, address)
+        order = self._place_order(address_a, address_a)
+
+        # The declined order is placed again, shipping to another address
+        previous_order = Order.objects.get(pk=order.pk)
+        order.shipping_address = ShippingAddress.objects.create(**address_b)
+        order.date_placed = timezone.now()
+        order.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            order_updated.send(sender=Order, order=order, previous_order=previous_order)
+
+        for address in (address_a, address_b):
+            for addr_type in ("shipping_address", "billing_address"):
+                with self.assertNumQueries(0):
+                    count = self.rule.get_address_use_count(addr_type, address)
+                self.assertEqual(count, self.db_rule.get_address_use_count(addr_type, address))
+
+    def test_evicted_counters_counted_in_database(self):
+        address = self._get_address_data("123 Test St")
+        self._place_order(address, address)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.rule.get_address_use_count("shipping_address", address), 1)
+        self._place_order(address, address)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.rule.get_address_use_count("shipping_address", address), 2)
+
+        # Counters left over from before the eviction aren't counted again
+        fingerprint = fraud.get_address_fingerprint(address)
+        cache.delete(self.rule.get_generation_cache_key("shipping_address", fingerprint))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.rule.get_address_use_count("shipping_address", address), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.rule.get_address_use_count("shipping_address", address), 2)
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.rule.get_address_use_count("shipping_address", address), 2)
+
+    def test_missing_fields_match_blank_fields(self):
+        address = self._get_address_data("123 Test St")
+        partial_address = {k: v for k, v in address.items() if k != "line2"}
+        self._place_order({**address, "line2": "Apt 1"}, address)
+
+        # Counted the same way in the database and in the cache
+        self.assertEqual(self.rule.get_address_use_count("shipping_address", partial_address), 0)
+        self.assertEqual(self.rule.get_address_use_count("billing_address", partial_address), 1)
+        self._place_order(address, address)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.rule.get_address_use_count("shipping_address", partial_address), 1)
+            self.assertEqual(self.rule.get_address_use_count("billing_address", partial_address), 2)
+
+
+class IndexedAddressVelocityTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(fraud.reload_enabled_fraud_checks)
+        override = override_settings(API_CHECKOUT_FRAUD_CHECKS=[{"rule": "oscarapicheckout.fraud.IndexedAddressVelocity", "kwargs": {}}])
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _get_address_data(self, line1):
+        return {
+            "first_name": "John",
+            "last_name": "Doe",
+            "line1": line1,
+            "line4": "Test City",
+            "postcode": "TEST123",
+            "country": Country.objects.get(pk="US"),
+        }
+
+    def _place_order(self, shipping_address_data, billing_address_data):
+        return create_order(
+            shipping_address=ShippingAddress.objects.create(**shipping_address_data),
+            billing_address=BillingAddress.objects.create(**billing_address_data),
+        )
+
+    def _assert_consistent_with_database_counts(self, *addresses):
+        rule = fraud.IndexedAddressVelocity()
+        db_rule = fraud.AddressVelocity()
+        for address in addresses:
+            for addr_type in ("shipping_address", "billing_address"):
+                self.assertEqual(
+                    rule.get_address_use_count(addr_type, address),
+                    db_rule.get_address_use_count(addr_type, address),
+                )
+
+    def test_fingerprints(self):
+        address_a = self._get_address_data("123 Test St")
+        address_b = self._get_address_data("456 Other Ave")
+        order = self._place_order(address_a, address_b)
+        self._place_order({**address_a, "line1": " 123  test st"}, address_a)
+
+        self.assertEqual(
+            set(order.address_fingerprints.values_list("address_type", "fingerprint")),
+            {
+                ("shipping_address", fraud.get_address_fingerprint(address_a)),
+                ("billing_address", fraud.get_address_fingerprint(address_b)),
+            },
+        )
+        self.assertEqual(fraud.IndexedAddressVelocity().get_address_use_count("shipping_address", address_a), 2)
+        self._assert_consistent_with_database_counts(address_b, self._get_address_data("789 Unused Rd"))
+
+    def test_fingerprints_only_saved_while_enabled(self):
+        address = self._get_address_data("123 Test St")
+        with override_settings(API_CHECKOUT_FRAUD_CHECKS=[]):
+            order = self._place_order(address, address)
+        self.assertFalse(order.address_fingerprints.exists())
+
+    def test_fingerprints_refreshed_on_update(self):
+        address_a = self._get_address_data("123 Test St")
+        address_b = self._get_address_data("456 Other Ave")
+        order = self._place_order(address_a, address_a)
+
+        # The declined order is placed again, shipping to another address
+        previous_order = Order.objects.get(pk=order.pk)
+        order.shipping_address = ShippingAddress.objects.create(**address_b)
+        order.date_placed = timezone.now()
+        order.save()
+        order_updated.send(sender=Order, order=order, previous_order=previous_order)
+
+        self.assertEqual(
+            set(order.address_fingerprints.values_list("address_type", "fingerprint", "date_placed")),
+            {
+                ("shipping_address", fraud.get_address_fingerprint(address_b), order.date_placed),
+                ("billing_address", fraud.get_address_fingerprint(address_a), order.date_placed),
+            },
+        )
+        self._assert_consistent_with_database_counts(address_a, address_b)
+
+    def test_backfill(self):
+        address_a = self._get_address_data("123 Test St")
+        address_b = self._get_address_data("456 Other Ave")
+        for _i in range(3):
+            self._place_order(address_a, address_b)
+        self._place_order(address_b, address_b)
+        OrderAddressFingerprint.objects.all().delete()
+
+        call_command("backfill_address_fingerprints", batch_size=2, stdout=StringIO())
+        self.assertEqual(OrderAddressFingerprint.objects.count(), 8)
+        self._assert_consistent_with_database_counts(address_a, address_b)
+
+        # Running it again doesn't create duplicates
+        call_command("backfill_address_fingerprints", stdout=StringIO())
+        self.assertEqual(OrderAddressFingerprint.objects.count(), 8)
@@ -1,8 +1,8 @@
 from decimal import Decimal
 
-from oscar.test.factories import create_order
+from oscar.test.factories import create_basket, create_order, create_product
 
-from ..methods import Cash, PaymentMethod, PaymentMethodSerializer
+from ..methods import Cash, PaymentMethod, PaymentMethodSerializer, prefetch_order_sources, source_types
 from .base import BaseTest
 
 
@@ -138,6 +138,43 @@ class PaymentMethodTest(BaseTest):
         self.assertEqual(order.sources.all().count(), 1)
         self.assertEqual(order.sources.first().id, source.id)
 
+    def test_source_type_cache(self):
+        self.addCleanup(source_types.clear)
+        order = create_order()
+        method = PaymentMethod()
+        with self.captureOnCommitCallbacks(execute=True):
+            source = method.get_source(order, reference="12345")
+
+        # The source type is now cached
+        with self.assertNumQueries(0):
+            self.assertEqual(source_types.get(method.name), source.source_type)
+
+        # Saving a source type clears the cache
+        source.source_type.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(source_types.get(method.name), source.source_type)
+
+    def test_get_source_queries(self):
+        self.addCleanup(source_types.clear)
+        order = create_order()
+        method = PaymentMethod()
+        with self.captureOnCommitCallbacks(execute=True):
+            source = method.get_source(order, reference="12345")
+
+        # Unchanged sources aren't saved again
+        with self.assertNumQueries(1):
+            self.assertEqual(method.get_source(order, reference="12345"), source)
+
+        # Sources are looked up among the order's prefetched sources
+        prefetch_order_sources(order)
+        with self.assertNumQueries(0):
+            self.assertEqual(method.get_source(order, reference="12345"), source)
+        with self.assertNumQueries(1):
+            other_source = method.get_source(order, reference="67890")
+        with self.assertNumQueries(0):
+            self.assertEqual(method.get_source(order, reference="67890"), other_source)
+        self.assertEqual(order.sources.count(), 2)
+
 
 class CashTest(BaseTest):
     def test_record_payment(self):
@@ -161,3 +198,17 @@ class CashTest(BaseTest):
 
         transaction = source.transactions.get(txn_type="Debit")
         self.assertEqual(transaction.amount, Decimal("1.00"))
+
+    def test_record_payment_event_quantities(self):
+        basket = create_basket(empty=True)
+        for i in range(3):
+            basket.add_product(create_product(price=Decimal("10.00"), num_in_stock=10), quantity=i + 1)
+        order = create_order(basket=basket)
+        Cash().record_payment(None, order, "cash", amount=order.total_incl_tax)
+
+        event = order.payment_events.get(event_type__name="Debit")
+        self.assertEqual(
+            sorted(event.line_quantities.values_list("line_id", "quantity")),
+            sorted(order.lines.values_list("id", "quantity")),
+        )
+        self.assertEqual(event.line_quantities.count(), 3)
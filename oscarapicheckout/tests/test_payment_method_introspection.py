@@ -1,6 +1,10 @@
+from unittest import mock
+
+from django.core.cache import cache
 from rest_framework import status
 from rest_framework.reverse import reverse
 
+from ..views import PaymentMethodsView
 from .base import BaseTest
 
 
@@ -321,3 +325,23 @@ class PaymentMethodsViewTest(BaseTest):
                 },
             },
         )
+
+    def test_introspection_is_cached(self):
+        cache.clear()
+        url = reverse("api-checkout-payment-methods")
+        anon_data = self.client.get(url).data
+        self.login(is_staff=True)
+        staff_data = self.client.get(url).data
+        self.assertNotEqual(anon_data, staff_data)
+
+        # Repeated requests for the same set of permitted methods are served from the cache
+        with mock.patch.object(PaymentMethodsView, "get_metadata") as get_metadata:
+            self.assertEqual(self.client.get(url).data, staff_data)
+            self.client.logout()
+            self.assertEqual(self.client.get(url).data, anon_data)
+        get_metadata.assert_not_called()
+
+        # But not for another language
+        with mock.patch.object(PaymentMethodsView, "get_metadata", return_value={}) as get_metadata:
+            self.client.get(url, HTTP_ACCEPT_LANGUAGE="es")
+        get_metadata.assert_called_once_with()
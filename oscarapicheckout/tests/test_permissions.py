@@ -1,6 +1,8 @@
+from typing import ClassVar
+
 from rest_framework.test import APIRequestFactory
 
-from ..permissions import Public, StaffOnly
+from ..permissions import CustomerOnly, PaymentMethodPermission, Public, StaffOnly, evaluate_permissions
 from .base import BaseTest
 
 
@@ -40,3 +42,48 @@ class StaffOnlyTest(BaseTest):
         factory = APIRequestFactory()
         request = factory.get("/")
         self.assertTrue(StaffOnly().is_permitted(request, user))
+
+
+class CountingPermission(PaymentMethodPermission):
+    batches: ClassVar[list[list[str]]] = []
+
+    def __init__(self, name):
+        self.name = name
+
+    @classmethod
+    def is_permitted_many(cls, permissions, request=None, user=None):
+        cls.batches.append([permission.name for permission in permissions])
+        return [permission.name != "denied" for permission in permissions]
+
+    def get_cache_key(self):
+        return (self.__class__, self.name)
+
+
+class EvaluatePermissionsTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        CountingPermission.batches = []
+
+    def test_permissions_are_batched_and_memoized(self):
+        user = self.login(is_staff=True)
+        request = APIRequestFactory().get("/")
+        permissions = [
+            CountingPermission("allowed"),
+            StaffOnly(),
+            CountingPermission("denied"),
+            CustomerOnly(),
+        ]
+        self.assertEqual(evaluate_permissions(permissions, request, user), [True, True, False, False])
+        self.assertEqual(CountingPermission.batches, [["allowed", "denied"]])
+
+        # Evaluated once per request
+        self.assertEqual(evaluate_permissions(permissions, request, user), [True, True, False, False])
+        self.assertEqual(CountingPermission.batches, [["allowed", "denied"]])
+
+        # ...and user
+        self.assertEqual(evaluate_permissions(permissions, request, None), [True, False, False, True])
+        self.assertEqual(CountingPermission.batches, [["allowed", "denied"], ["allowed", "denied"]])
+
+        other_request = APIRequestFactory().get("/")
+        evaluate_permissions(permissions, other_request, user)
+        self.assertEqual(len(CountingPermission.batches), 3)
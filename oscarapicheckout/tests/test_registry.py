@@ -0,0 +1,50 @@
+from unittest import mock
+
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+
+from ..methods import Cash, PayLater
+from ..registry import get_payment_method_registry, reload_payment_method_registry
+from .base import BaseTest
+
+
+class PaymentMethodRegistryTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(reload_payment_method_registry)
+
+    def test_registry_is_cached(self):
+        registry = get_payment_method_registry()
+        with mock.patch("oscarapicheckout.registry.import_string") as import_string:
+            self.assertIs(get_payment_method_registry(), registry)
+        import_string.assert_not_called()
+
+    def test_get_permitted_methods(self):
+        configs = [
+            {
+                "method": "oscarapicheckout.methods.Cash",
+                "permission": "oscarapicheckout.permissions.StaffOnly",
+                "method_kwargs": {},
+                "permission_kwargs": {},
+            },
+            {
+                "method": "oscarapicheckout.methods.PayLater",
+                "permission": "oscarapicheckout.permissions.Public",
+                "method_kwargs": {},
+                "permission_kwargs": {},
+            },
+        ]
+        with override_settings(API_ENABLED_PAYMENT_METHODS=configs):
+            registry = get_payment_method_registry()
+        request = APIRequestFactory().get("/")
+
+        methods = registry.get_permitted_methods(request, None)
+        self.assertEqual(list(methods.keys()), ["pay-later"])
+        self.assertIsInstance(methods["pay-later"], PayLater)
+
+        staff = self.login(is_staff=True)
+        methods = registry.get_permitted_methods(request, staff)
+        self.assertEqual(list(methods.keys()), ["cash", "pay-later"])
+        self.assertIsInstance(methods["cash"], Cash)
+        # Method instances are shared between requests
+        self.assertIs(registry.get_permitted_methods(request, staff)["cash"], methods["cash"])
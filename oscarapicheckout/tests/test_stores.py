@@ -0,0 +1,313 @@
+from decimal import Decimal
+from threading import Timer
+from unittest import mock
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from oscar.test.factories import create_order
+from rest_framework.test import APIRequestFactory
+
+from ..models import PaymentState
+from ..states import (
+    ClientSidePaymentRequired,
+    Complete,
+    Consumed,
+    Declined,
+    Deferred,
+    FormPostRequired,
+)
+from ..stores import (
+    CHECKOUT_ORDER_ID,
+    CHECKOUT_PAYMENT_STEPS,
+    CachePaymentStateStore,
+    DatabasePaymentStateStore,
+    LazyPaymentStates,
+    PaymentStateConflict,
+    SessionPaymentStateStore,
+    _session_pickle,
+    decode_state,
+    encode_state,
+    get_payment_state_store,
+)
+from .base import BaseTest
+
+
+class CustomComplete(Complete):
+    pass
+
+
+class StateEncodingTest(BaseTest):
+    def test_source_bound_states(self):
+        for StateClass in (Complete, Deferred, Declined, Consumed):
+            state = StateClass(Decimal("10.50"), source_id=42)
+            encoded = encode_state(state)
+            self.assertTrue(encoded.startswith("["))
+            self.assertLess(len(encoded), len(_session_pickle(state)))
+            decoded = decode_state(encoded)
+            self.assertIs(type(decoded), StateClass)
+            self.assertEqual(decoded.amount, Decimal("10.50"))
+            self.assertEqual(decoded.source_id, 42)
+
+    def test_form_post_required(self):
+        state = FormPostRequired(
+            Decimal("8.00"),
+            name="get-token",
+            url="/get-token/",
+            fields=[{"key": "amount", "value": "8.00"}],
+        )
+        encoded = encode_state(state)
+        self.assertEqual(
+            encoded,
+            '["form-post-required",1,"8.00","get-token","/get-token/","POST",[["amount","8.00"]]]',
+        )
+        decoded = decode_state(encoded)
+        self.assertIs(type(decoded), FormPostRequired)
+        self.assertEqual(decoded.amount, Decimal("8.00"))
+        self.assertEqual(decoded.get_required_action(), state.get_required_action())
+
+    def test_client_side_payment_required(self):
+        state = ClientSidePaymentRequired(
+            Decimal("8.00"),
+            payment_processor="sandbox-processor",
+            data={"token": "abc"},
+        )
+        decoded = decode_state(encode_state(state))
+        self.assertIs(type(decoded), ClientSidePaymentRequired)
+        self.assertEqual(decoded.amount, Decimal("8.00"))
+        self.assertEqual(decoded.get_required_action(), state.get_required_action())
+
+    def test_client_side_payment_required_non_json_data(self):
+        for data in ({"items": ("a", "b")}, {1: "a"}, {"amount": Decimal("1.00")}):
+            state = ClientSidePaymentRequired(
+                Decimal("8.00"),
+                payment_processor="sandbox-processor",
+                data=data,
+            )
+            encoded = encode_state(state)
+            # Pickled, so that the data isn't changed by the JSON encoding
+            self.assertFalse(encoded.startswith("["))
+            decoded = decode_state(encoded)
+            self.assertIs(type(decoded), ClientSidePaymentRequired)
+            self.assertEqual(decoded.get_required_action()["data"], data)
+            self.assertEqual([type(v) for v in decoded.get_required_action()["data"].values()], [type(v) for v in data.values()])
+
+    def test_decode_legacy_pickle(self):
+        decoded = decode_state(_session_pickle(Complete(Decimal("1.00"), source_id=1)))
+        self.assertIs(type(decoded), Complete)
+        self.assertEqual(decoded.amount, Decimal("1.00"))
+
+    def test_unregistered_subclass_uses_pickle(self):
+        encoded = encode_state(CustomComplete(Decimal("1.00")))
+        self.assertFalse(encoded.startswith("["))
+        self.assertIs(type(decode_state(encoded)), CustomComplete)
+
+    def test_unknown_tag(self):
+        with self.assertRaises(ValueError):
+            decode_state('["foo",1,"1.00"]')
+
+
+class LazyPaymentStatesTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.encoded = {
+            "cash": encode_state(Consumed(Decimal("2.00"))),
+            "credit-card": encode_state(FormPostRequired(Decimal("8.00"), name="get-token", url="/")),
+            "legacy": _session_pickle(Declined(Decimal("1.00"))),
+        }
+
+    def test_decodes_on_access(self):
+        decoder = mock.Mock(wraps=decode_state)
+        states = LazyPaymentStates(self.encoded, decoder)
+        self.assertEqual(len(states), 3)
+        self.assertEqual(list(states), ["cash", "credit-card", "legacy"])
+        decoder.assert_not_called()
+        self.assertEqual(states["credit-card"].amount, Decimal("8.00"))
+        decoder.assert_called_once_with(self.encoded["credit-card"])
+
+    def test_statuses_from_header(self):
+        decoder = mock.Mock(wraps=decode_state)
+        states = LazyPaymentStates(self.encoded, decoder)
+        self.assertEqual(
+            states.statuses(),
+            {
+                "cash": "Consumed",
+                "credit-card": "Pending",
+                "legacy": "Declined",
+            },
+        )
+        # Only the legacy pickled entry had to be decoded
+        decoder.assert_called_once_with(self.encoded["legacy"])
+
+    def test_store_memoized_per_request(self):
+        order = create_order()
+        request = APIRequestFactory().get("/")
+        request.session = SessionStore()
+        store = get_payment_state_store(request)
+        self.assertIs(get_payment_state_store(request), store)
+        store.set("cash", Complete(Decimal("2.00")), order=order)
+        with mock.patch("oscarapicheckout.stores.decode_state") as decode:
+            state = get_payment_state_store(request).list(order=order)["cash"]
+        decode.assert_not_called()
+        self.assertEqual(state.amount, Decimal("2.00"))
+
+
+class PaymentStateStoreTestMixin:
+    store_class = SessionPaymentStateStore
+
+    def _get_request(self):
+        request = APIRequestFactory().get("/")
+        request.session = SessionStore()
+        return request
+
+    def test_set_and_list(self):
+        order = create_order()
+        store = self.store_class(self._get_request())
+        self.assertEqual(store.list(order=order), {})
+        self.assertIsNone(store.get("cash", order=order))
+
+        store.set("cash", Complete(Decimal("2.00"), source_id=1), order=order)
+        store.set(
+            "credit-card",
+            FormPostRequired(Decimal("8.00"), name="get-token", url="/get-token/"),
+            order=order,
+        )
+
+        states = store.list(order=order)
+        self.assertEqual(states.keys(), {"cash", "credit-card"})
+        self.assertEqual(states["cash"].status, "Complete")
+        self.assertEqual(states["cash"].amount, Decimal("2.00"))
+        self.assertEqual(states["cash"].source_id, 1)
+        self.assertEqual(states["credit-card"].status, "Pending")
+        self.assertEqual(states["credit-card"].get_required_action()["url"], "/get-token/")
+
+        state = store.get("cash", order=order)
+        self.assertEqual(state.status, "Complete")
+
+    def test_overwrite_and_delete(self):
+        order = create_order()
+        store = self.store_class(self._get_request())
+        store.set("cash", Complete(Decimal("2.00")), order=order)
+        store.set("cash", Consumed(Decimal("2.00")), order=order)
+        store.set("credit-card", Declined(Decimal("8.00")), order=order)
+        self.assertEqual(store.get("cash", order=order).status, "Consumed")
+
+        store.delete(["cash"], order=order)
+        self.assertEqual(store.list(order=order).keys(), {"credit-card"})
+
+        store.clear(order=order)
+        self.assertEqual(store.list(order=order), {})
+
+    def test_order_from_session(self):
+        order = create_order()
+        request = self._get_request()
+        request.session[CHECKOUT_ORDER_ID] = order.pk
+        store = self.store_class(request)
+        store.set("cash", Complete(Decimal("2.00")))
+        self.assertEqual(store.list(order=order).keys(), {"cash"})
+        self.assertEqual(store.list().keys(), {"cash"})
+
+    def test_compare_and_set(self):
+        order = create_order()
+        store = self.store_class(self._get_request())
+        store.set("cash", Complete(Decimal("2.00")), order=order)
+        versions = store.list(order=order).versions
+
+        # A new key must not already exist
+        self.assertFalse(store.compare_and_set({"cash": Consumed(Decimal("2.00"))}, {"cash": None}, order=order))
+        self.assertTrue(store.compare_and_set({"credit-card": Declined(Decimal("8.00"))}, {"credit-card": None}, order=order))
+        self.assertTrue(store.compare_and_set({"cash": Consumed(Decimal("2.00"))}, versions, order=order))
+        self.assertEqual(store.get("cash", order=order).status, "Consumed")
+
+        # The stamps read earlier are now stale
+        self.assertFalse(store.compare_and_set({"cash": Declined(Decimal("2.00"))}, versions, order=order))
+        self.assertEqual(store.get("cash", order=order).status, "Consumed")
+
+
+class SessionPaymentStateStoreTest(PaymentStateStoreTestMixin, BaseTest):
+    store_class = SessionPaymentStateStore
+
+    def test_writes_to_session(self):
+        order = create_order()
+        request = self._get_request()
+        SessionPaymentStateStore(request).set("cash", Complete(Decimal("2.00")), order=order)
+        self.assertEqual(request.session[CHECKOUT_PAYMENT_STEPS].keys(), {"cash"})
+
+
+class DatabasePaymentStateStoreTest(PaymentStateStoreTestMixin, BaseTest):
+    store_class = DatabasePaymentStateStore
+
+    def test_isolated_by_order(self):
+        order1 = create_order()
+        order2 = create_order()
+        request = self._get_request()
+        store = DatabasePaymentStateStore(request)
+        store.set("cash", Complete(Decimal("2.00")), order=order1)
+        store.set("cash", Declined(Decimal("3.00")), order=order2)
+        self.assertEqual(store.get("cash", order=order1).status, "Complete")
+        self.assertEqual(store.get("cash", order=order2).status, "Declined")
+        self.assertEqual(PaymentState.objects.count(), 2)
+        self.assertNotIn(CHECKOUT_PAYMENT_STEPS, request.session)
+
+    def test_version_incremented_on_write(self):
+        order = create_order()
+        store = DatabasePaymentStateStore()
+        store.set("cash", Complete(Decimal("2.00")), order=order)
+        self.assertEqual(PaymentState.objects.get(order=order, method_key="cash").version, 1)
+        store.set("cash", Consumed(Decimal("2.00")), order=order)
+        self.assertEqual(PaymentState.objects.get(order=order, method_key="cash").version, 2)
+        store.set_many(
+            {
+                "cash": Complete(Decimal("2.00")),
+                "credit-card": Complete(Decimal("8.00")),
+            },
+            order=order,
+        )
+        self.assertEqual(PaymentState.objects.get(order=order, method_key="cash").version, 3)
+        self.assertEqual(PaymentState.objects.get(order=order, method_key="credit-card").version, 1)
+
+
+class CachePaymentStateStoreTest(PaymentStateStoreTestMixin, BaseTest):
+    store_class = CachePaymentStateStore
+
+    def test_isolated_by_order(self):
+        order1 = create_order()
+        order2 = create_order()
+        request = self._get_request()
+        store = CachePaymentStateStore(request)
+        store.set("cash", Complete(Decimal("2.00")), order=order1)
+        store.set("cash", Declined(Decimal("3.00")), order=order2)
+        self.assertEqual(store.get("cash", order=order1).status, "Complete")
+        self.assertEqual(store.get("cash", order=order2).status, "Declined")
+        self.assertNotIn(CHECKOUT_PAYMENT_STEPS, request.session)
+
+    def test_writes_wait_for_lock(self):
+        order = create_order()
+        store = CachePaymentStateStore()
+        lock_key = f"{store._index_key(order.pk)}.lock"
+        cache.add(lock_key, "other-writer")
+        self.addCleanup(cache.delete, lock_key)
+
+        # The lock is released while the write waits for it
+        release = Timer(0.1, cache.delete, args=(lock_key,))
+        release.start()
+        self.addCleanup(release.join)
+        store.set("cash", Complete(Decimal("2.00")), order=order)
+        self.assertEqual(store.list(order=order).keys(), {"cash"})
+        self.assertIsNone(cache.get(lock_key))
+
+    def test_lock_wait_timeout(self):
+        order = create_order()
+        store = CachePaymentStateStore()
+        store.set("cash", Complete(Decimal("2.00")), order=order)
+        versions = store.list(order=order).versions
+        lock_key = f"{store._index_key(order.pk)}.lock"
+        cache.add(lock_key, "other-writer")
+        self.addCleanup(cache.delete, lock_key)
+
+        with mock.patch.object(CachePaymentStateStore, "lock_wait", 0):
+            self.assertFalse(store.compare_and_set({"cash": Consumed(Decimal("2.00"))}, versions, order=order))
+            with self.assertRaises(PaymentStateConflict):
+                store.set("credit-card", Complete(Decimal("8.00")), order=order)
+        self.assertEqual(store.list(order=order).keys(), {"cash"})
+        # Another writer's lock is never released
+        self.assertEqual(cache.get(lock_key), "other-writer")
@@ -1,7 +1,10 @@
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
 from decimal import Decimal
 from typing import Any, TypedDict
-import base64
-import pickle
+import logging
+import random
+import time
 
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.auth.models import AnonymousUser, User
@@ -13,10 +16,29 @@ from django.utils.translation import gettext_lazy as _
 from oscar.core.loading import get_class, get_model
 from oscar.core.prices import Price
 from oscarapi.basket import operations
+from rest_framework import exceptions, status
 
+from . import settings as pkgsettings
+from .lines import PreparedOrderLines, delete_order_lines, reconcile_order_lines
+from .locking import lock_checkout_rows
+from .mixins import AddressWriter, get_shipping_discount
 from .settings import ORDER_STATUS_AUTHORIZED, ORDER_STATUS_PAYMENT_DECLINED
-from .signals import order_payment_authorized, order_payment_declined
+from .signals import (
+    order_payment_authorized,
+    order_payment_declined,
+    order_updated,
+    payment_state_conflict,
+)
 from .states import Complete, Consumed, Declined, PaymentMethodStatus, PaymentStatus
+from .stores import (  # NOQA
+    CHECKOUT_ORDER_ID,
+    CHECKOUT_PAYMENT_STEPS,
+    LazyPaymentStates,
+    PaymentStateConflict,
+    _session_pickle,
+    _session_unpickle,
+    get_payment_state_store,
+)
 
 Basket = get_model("basket", "Basket")
 Order = get_model("order", "Order")
@@ -26,36 +48,45 @@ BillingAddress = get_model("order", "BillingAddress")
 OrderCreator = get_class("order.utils", "OrderCreator")
 ShippingMethod = get_class("shipping.methods", "Base")
 
-CHECKOUT_ORDER_ID = "api_checkout_pending_order_id"
-CHECKOUT_PAYMENT_STEPS = "api_checkout_payment_steps"
+logger = logging.getLogger(__name__)
 
 
-def _session_pickle(obj: Any) -> str:
-    pickled = pickle.dumps(obj)
-    base64ed = base64.standard_b64encode(pickled)
-    utfed = base64ed.decode("utf8")
-    return utfed
+class PaymentStateUnavailable(exceptions.APIException):
+    """
+    Raised, instead of a ``PaymentStateConflict``, when an order's payment states kept
+    changing concurrently and its status couldn't be updated. The request (e.g. a
+    payment gateway callback) can safely be retried once the other updates finish.
+    """
 
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _("The payment state of this order is being updated by another request. Please try again.")
+    default_code = "payment_state_conflict"
+    # Sent as the Retry-After header
+    wait = 1
 
-def _session_unpickle(utfed: str) -> Any:
-    base64ed = utfed.encode("utf8")
-    pickled = base64.standard_b64decode(base64ed)
-    obj = pickle.loads(pickled)
-    return obj
+
+@contextmanager
+def payment_state_conflicts_retryable() -> Iterator[None]:
+    """
+    Turn a ``PaymentStateConflict`` raised while updating payment states into a
+    retryable ``PaymentStateUnavailable`` API error, rather than a server error.
+    """
+    try:
+        yield
+    except PaymentStateConflict as e:
+        raise PaymentStateUnavailable() from e
 
 
 def _update_payment_method_state(
-    request: HttpRequest,
+    request: HttpRequest | None,
     method_key: str,
     state: PaymentStatus,
+    order: Order | None = None,
 ) -> None:
-    states = request.session.get(CHECKOUT_PAYMENT_STEPS, {})
-    states[method_key] = _session_pickle(state)
-    request.session[CHECKOUT_PAYMENT_STEPS] = states
-    request.session.modified = True
+    get_payment_state_store(request).set(method_key, state, order=order)
 
 
-def _set_order_authorized(order: Order, request: HttpRequest) -> None:
+def _set_order_authorized(order: Order, request: HttpRequest | None) -> None:
     # Set the order status
     order.set_status(ORDER_STATUS_AUTHORIZED)
 
@@ -72,7 +103,7 @@ def _set_order_authorized(order: Order, request: HttpRequest) -> None:
     order_payment_authorized.send(sender=order, order=order, request=request)
 
 
-def _set_order_payment_declined(order: Order, request: HttpRequest) -> None:
+def _set_order_payment_declined(order: Order, request: HttpRequest | None) -> None:
     # Set the order status
     order.set_status(ORDER_STATUS_PAYMENT_DECLINED)
 
@@ -97,61 +128,103 @@ def _set_order_payment_declined(order: Order, request: HttpRequest) -> None:
     if order.basket is not None:
         # Thaw the basket and put it back into the request.session so that it can be retried
         order.basket.thaw()
-        operations.store_basket_in_session(order.basket, request.session)
+        if request is not None:
+            operations.store_basket_in_session(order.basket, request.session)
 
     # Send a signal
     order_payment_declined.send(sender=order, order=order, request=request)
 
 
-def _update_order_status(order: Order, request: HttpRequest) -> None:
-    states = list_payment_method_states(request)
-
-    declined = [s for k, s in states.items() if s.status == PaymentMethodStatus.DECLINED]
-    if len(declined) > 0:
-        _set_order_payment_declined(order, request)
-
-    not_complete = [s for k, s in states.items() if s.status != PaymentMethodStatus.COMPLETE]
-    if len(not_complete) <= 0:
-        # Authorized the order and consume all the payments
-        _set_order_authorized(order, request)
-        for key, state in states.items():
-            mark_payment_method_consumed(
-                order,
-                request,
-                key,
-                state.amount,
-                source_id=getattr(state, "source_id", None),
-            )
-
-
-def list_payment_method_states(request: HttpRequest) -> dict[str, PaymentStatus]:
-    states = request.session.get(CHECKOUT_PAYMENT_STEPS, {})
-    return {method_key: _session_unpickle(state) for method_key, state in states.items()}
-
-
-def clear_payment_method_states(request: HttpRequest) -> None:
-    request.session[CHECKOUT_PAYMENT_STEPS] = {}
-    request.session.modified = True
+def _update_order_status(
+    order: Order,
+    request: HttpRequest | None,
+    states: Mapping[str, PaymentStatus] | None = None,
+) -> None:
+    max_attempts = max(pkgsettings.get_setting("API_CHECKOUT_PAYMENT_STATE_MAX_RETRIES"), 0) + 1
+    for attempt in range(1, max_attempts + 1):
+        if states is None:
+            states = list_payment_method_states(request, order=order)
+        statuses = _get_payment_method_statuses(states)
+
+        declined = [s for k, s in statuses.items() if s == PaymentMethodStatus.DECLINED]
+        if len(declined) > 0:
+            _set_order_payment_declined(order, request)
+
+        not_complete = [s for k, s in statuses.items() if s != PaymentMethodStatus.COMPLETE]
+        if len(not_complete) > 0:
+            return
+
+        # Consume all the payments and authorize the order. Consuming the payments
+        # only succeeds if none of the states changed since they were read, so when
+        # several requests complete the last payments at the same time, only one of
+        # them authorizes the order.
+        with transaction.atomic():
+            if mark_payment_methods_consumed(order, request, states):
+                _set_order_authorized(order, request)
+                return
+
+        logger.warning(
+            "Payment states of order %s changed concurrently (attempt %s of %s)",
+            order.number,
+            attempt,
+            max_attempts,
+        )
+        payment_state_conflict.send(sender=order.__class__, order=order, attempt=attempt)
+        # Back off (exponentially, with jitter) to let the concurrent writer finish,
+        # then re-read the states and re-evaluate the order status
+        if attempt < max_attempts:
+            backoff = pkgsettings.get_setting("API_CHECKOUT_PAYMENT_STATE_RETRY_BACKOFF") * 2 ** (attempt - 1)
+            time.sleep(backoff * random.uniform(0.5, 1))
+        states = None
+        order.refresh_from_db(fields=["status"])
+    raise PaymentStateConflict(f"Payment states of order {order.number} kept changing concurrently")
+
+
+def _get_payment_method_statuses(
+    states: Mapping[str, PaymentStatus],
+) -> dict[str, PaymentMethodStatus]:
+    # Lazily decoded states can tell us their status without being fully decoded
+    if isinstance(states, LazyPaymentStates):
+        return states.statuses()
+    return {key: state.status for key, state in states.items()}
+
+
+def list_payment_method_states(
+    request: HttpRequest | None,
+    order: Order | None = None,
+) -> Mapping[str, PaymentStatus]:
+    """
+    List the payment states of the given order (or the order currently being
+    checked-out in the session). States are decoded lazily, when accessed.
+    """
+    return get_payment_state_store(request).list(order=order)
+
+
+def clear_payment_method_states(
+    request: HttpRequest,
+    order: Order | None = None,
+) -> None:
+    get_payment_state_store(request).clear(order=order)
 
 
-def clear_consumed_payment_method_states(request: HttpRequest) -> None:
-    curr_states = list_payment_method_states(request)
-    new_states = {}
-    for key, state in curr_states.items():
-        if state.status != PaymentMethodStatus.CONSUMED:
-            new_states[key] = state
-    clear_payment_method_states(request)
-    for key, state in new_states.items():
-        _update_payment_method_state(request, key, state)
+def clear_consumed_payment_method_states(
+    request: HttpRequest,
+    order: Order | None = None,
+) -> None:
+    store = get_payment_state_store(request)
+    curr_statuses = store.list(order=order).statuses()
+    consumed = [key for key, status in curr_statuses.items() if status == PaymentMethodStatus.CONSUMED]
+    if consumed:
+        store.delete(consumed, order=order)
 
 
 def update_payment_method_state(
     order: Order,
-    request: HttpRequest,
+    request: HttpRequest | None,
     method_key: str,
     state: PaymentStatus,
 ) -> None:
-    _update_payment_method_state(request, method_key, state)
+    _update_payment_method_state(request, method_key, state, order=order)
     _update_order_status(order, request)
 
 
@@ -160,10 +233,10 @@ def set_payment_method_states(
     request: HttpRequest,
     states: dict[str, PaymentStatus],
 ) -> None:
-    clear_payment_method_states(request)
-    for method_key, state in states.items():
-        _update_payment_method_state(request, method_key, state)
-    _update_order_status(order, request)
+    # Write the whole state map at once and hand the already-decoded states to the
+    # status evaluation, rather than re-reading them from the store.
+    get_payment_state_store(request).replace(states, order=order)
+    _update_order_status(order, request, states=states)
 
 
 def mark_payment_method_completed(
@@ -211,6 +284,61 @@ def mark_payment_method_consumed(
     )
 
 
+def mark_payment_methods_consumed(
+    order: Order,
+    request: HttpRequest | None,
+    states: Mapping[str, PaymentStatus],
+) -> bool:
+    """
+    Mark each of the given payment methods as consumed using a single write to the
+    payment state store. Unlike ``mark_payment_method_consumed``, this doesn't
+    re-evaluate the order status afterwards, since consuming a payment never changes it.
+
+    If ``states`` was read from the store, the write only happens if none of the
+    states changed since. Returns ``False`` if they did.
+    """
+    consumed: dict[str, PaymentStatus] = {
+        key: Consumed(
+            state.amount,
+            source_id=getattr(state, "source_id", None),
+        )
+        for key, state in states.items()
+    }
+    store = get_payment_state_store(request)
+    if not isinstance(states, LazyPaymentStates):
+        store.set_many(consumed, order=order)
+        return True
+    return store.compare_and_set(consumed, states.versions, order=order)
+
+
+def list_payment_method_states_by_order_number(
+    order_number: str,
+) -> Mapping[str, PaymentStatus]:
+    """
+    List the payment states of an order without using the shopper's session. Requires
+    an order-keyed payment state store, such as ``DatabasePaymentStateStore``.
+    """
+    order = Order._default_manager.get(number=order_number)
+    return list_payment_method_states(None, order=order)
+
+
+def update_payment_method_state_by_order_number(
+    order_number: str,
+    method_key: str,
+    state: PaymentStatus,
+    request: HttpRequest | None = None,
+) -> Order:
+    """
+    Update the state of a single payment method on an order, identified by its
+    number rather than by the shopper's session. This allows asynchronous gateway
+    notifications (webhooks) to be handled by any worker. Requires an order-keyed
+    payment state store, such as ``DatabasePaymentStateStore``.
+    """
+    order = Order._default_manager.get(number=order_number)
+    update_payment_method_state(order, request, method_key, state)
+    return order
+
+
 def get_order_ownership(
     request: HttpRequest,
     given_user: User | None,
@@ -247,11 +375,15 @@ class OrderUpdater:
         order_number: str | None = None,
         status: str | None = None,
         request: HttpRequest | None = None,
+        save_addresses: AddressWriter | None = None,
         **kwargs: Any,
     ) -> Order:
         """
         Similar to OrderCreator.place_order, except this updates an existing "Payment Declined" order instead
         of creating a new order.
+
+        ``order_updated`` is sent inside the update's transaction, so its receivers should defer any side
+        effects (e.g. sending messages, or writing to the cache) with ``transaction.on_commit``.
         """
         if basket.is_empty:
             # Translators: Error message in checkout
@@ -277,20 +409,32 @@ class OrderUpdater:
         order_user: AbstractBaseUser | None = user if isinstance(user, AbstractBaseUser) else None
         creator = OrderCreator()
 
+        # Work out the new order lines before opening the transaction, so that the rows locked
+        # below are held for as short a time as possible.
+        prepared_lines = PreparedOrderLines(creator, basket.all_lines())
+        shipping_discount = get_shipping_discount(basket, shipping_method)
+
         # Wrap the update in a transaction so that a failure during line/stock
         # creation rolls back the freshly written voucher-usage and discount
         # rows, mirroring the atomic guarantee of OrderCreatorMixin.place_order.
         with transaction.atomic():
-            # Remove all the order lines and cancel and stock they allocated. We'll make new lines from the
-            # basket after this.
-            for order_line in order.lines.all():
-                product_class = order_line.product.get_product_class() if order_line.product else None
-                if product_class and product_class.track_stock and order_line.stockrecord:
-                    order_line.stockrecord.cancel_allocation(order_line.quantity)
-                order_line.delete()
+            if save_addresses is not None:
+                shipping_address, billing_address = save_addresses()
+
+            # Lock the vouchers and stockrecords this update will change before changing anything, in a
+            # consistent order.
+            vouchers = lock_checkout_rows(basket, order=order)
+
+            reconcile_lines = pkgsettings.get_setting("API_CHECKOUT_RECONCILE_ORDER_LINES")
+            if not reconcile_lines:
+                # Remove all the order lines and cancel and stock they allocated. We'll make new lines from the
+                # basket after this.
+                delete_order_lines(order)
 
             # Use the built in OrderCreator, but specify a pk so that Django actually does an update instead
-            # of an insert on the order.Order model.
+            # of an insert on the order.Order model. The instance we were given is left as it was, for
+            # receivers of ``order_updated`` to compare against.
+            previous_order = order
             order = creator.create_order_model(
                 order_user,
                 basket,
@@ -309,7 +453,7 @@ class OrderUpdater:
             # Make sure all the vouchers are still available to the user placing the order (not necessarily the
             # same as the order owner)
             voucher_user = request.user if request and request.user else user
-            for voucher in basket.vouchers.select_for_update():
+            for voucher in vouchers:
                 available_to_user, msg = voucher.is_available_to_user(user=voucher_user)
                 if not voucher.is_active() or not available_to_user:
                     raise ValueError(msg)
@@ -323,8 +467,7 @@ class OrderUpdater:
                 # Record offer application results
                 if application["result"].affects_shipping:
                     # Skip zero shipping discounts
-                    shipping_discount = shipping_method.discount(basket)
-                    if shipping_discount <= Decimal("0.00"):
+                    if shipping_discount is None or shipping_discount <= Decimal("0.00"):
                         continue
                     # If a shipping offer, we need to grab the actual discount off
                     # the shipping method instance, which should be wrapped in an
@@ -337,12 +480,17 @@ class OrderUpdater:
             for voucher in basket.vouchers.all():
                 creator.record_voucher_usage(order, voucher, user)
 
-            # Make new order lines to replace the ones we deleted. Done last so that
-            # create_line_discount_models can link each OrderLine to the OrderDiscount
-            # records created above.
-            for basket_line in basket.all_lines():
-                creator.create_line_models(order, basket_line)
-                creator.update_stock_records(basket_line)
+            # Make new order lines to replace the ones we deleted (or, when reconciling, only the
+            # ones which changed). Done last so that create_line_discount_models can link each
+            # OrderLine to the OrderDiscount records created above.
+            if reconcile_lines:
+                reconcile_order_lines(prepared_lines, order)
+            else:
+                prepared_lines.create_lines(order)
+                prepared_lines.allocate_stock()
+
+            # Like Oscar's order_placed signal, but for an existing order placed again
+            order_updated.send(sender=self.__class__, order=order, previous_order=previous_order, user=user)
 
         # Done! Return the order.Order model
         return order
@@ -1,13 +1,23 @@
+from collections.abc import Iterable, Mapping
 from typing import Any
+import hashlib
 
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
+from django.utils import translation
+from django.utils.encoding import force_str
 from oscar.core.loading import get_model
 from rest_framework import generics, status
 from rest_framework.request import Request
 from rest_framework.response import Response
 
+from . import settings as pkgsettings
 from . import utils
-from .methods import PaymentMethod, PaymentMethodData
+from .idempotency import IdempotentRequest
+from .leases import BasketCheckoutLease
+from .locking import CheckoutLockUnavailable
+from .methods import PaymentMethod, PaymentMethodData, prefetch_order_sources
+from .registry import get_payment_method_registry
 from .serializers import (
     CheckoutSerializer,
     CompleteDeferredPaymentSerializer,
@@ -17,16 +27,40 @@ from .serializers import (
 )
 from .signals import order_placed
 from .states import CONSUMED, DECLINED, PaymentStatus
+from .stores import CHECKOUT_ORDER_ID
 
 Order = get_model("order", "Order")
 
-CHECKOUT_ORDER_ID = "checkout_order_id"
-
 
 class PaymentMethodsView(generics.GenericAPIView[Any]):
     serializer_class = PaymentMethodsSerializer  # type:ignore[assignment]
 
+    @property
+    def cache_timeout(self) -> int:
+        timeout: int = pkgsettings.get_setting("API_CHECKOUT_PAYMENT_METHODS_METADATA_TIMEOUT")
+        return timeout
+
     def get(self, request: Request) -> Response:
+        """
+        Describe the payment methods the user may use. The description only depends
+        on which methods those are (and the active language), so it's cached per
+        set of permitted methods.
+        """
+        codes = get_payment_method_registry().get_permitted_entries(request=request, user=request.user).keys()
+        cache_key = self.get_metadata_cache_key(codes)
+        data = cache.get(cache_key)
+        if data is None:
+            data = self.get_metadata()
+            cache.set(cache_key, data, self.cache_timeout)
+        return Response(data)
+
+    def get_metadata_cache_key(self, codes: Iterable[str]) -> str:
+        # The registry version changes with the payment method configuration
+        version = get_payment_method_registry().version
+        digest = hashlib.sha256(",".join(sorted(codes)).encode()).hexdigest()
+        return f"oscarapicheckout.views.{self.__class__.__name__}.{version}.{translation.get_language()}.{digest}"
+
+    def get_metadata(self) -> dict[str, Any]:
         root_serializer: PaymentMethodsSerializer = (
             self.get_serializer()  # type:ignore[assignment]
         )
@@ -41,10 +75,10 @@ class PaymentMethodsView(generics.GenericAPIView[Any]):
                 "type": "nested object",
                 "required": False,
                 "read_only": False,
-                "label": method.name,
+                "label": force_str(method.name),
                 "children": meta.get_serializer_info(method_serializer),
             }
-        return Response(data)
+        return data
 
 
 class CheckoutView(generics.GenericAPIView[Any]):
@@ -85,11 +119,27 @@ class CheckoutView(generics.GenericAPIView[Any]):
     }
 
     Returns the order object.
+
+    Send an ``Idempotency-Key`` header to make retrying the request safe. Retries
+    with the same key get the response of the original request replayed.
     """
 
     serializer_class = CheckoutSerializer
 
     def post(self, request: Request, format: str | None = None) -> Response:
+        idempotent_request = IdempotentRequest.from_request(request)
+        if idempotent_request is not None:
+            return idempotent_request.run(lambda: self._checkout_single_flight(request))
+        return self._checkout_single_flight(request)
+
+    def _checkout_single_flight(self, request: Request) -> Response:
+        # Coalesce concurrent checkouts of the same basket before doing any expensive work
+        lease = BasketCheckoutLease.from_request(request)
+        if lease is not None:
+            return lease.run(lambda: self._checkout(request))
+        return self._checkout(request)
+
+    def _checkout(self, request: Request) -> Response:
         # Wipe out any previous state data
         utils.clear_consumed_payment_method_states(request)
 
@@ -105,7 +155,12 @@ class CheckoutView(generics.GenericAPIView[Any]):
         basket.freeze()
 
         # Save Order
-        order = c_ser.save()
+        try:
+            order = c_ser.save()
+        except CheckoutLockUnavailable:
+            # Nothing was saved, so let the shopper retry checking out the same basket
+            basket.thaw()
+            raise
         request.session[CHECKOUT_ORDER_ID] = order.id
 
         # Send order_placed signal
@@ -118,7 +173,7 @@ class CheckoutView(generics.GenericAPIView[Any]):
         )
 
         # Save payment steps into session for processing
-        previous_states = utils.list_payment_method_states(request)
+        previous_states = utils.list_payment_method_states(request, order=order)
         new_states = self._record_payments(
             previous_states=previous_states,
             request=request,
@@ -126,7 +181,8 @@ class CheckoutView(generics.GenericAPIView[Any]):
             methods=c_ser.fields["payment"].methods,  # type:ignore[attr-defined]
             data=c_ser.validated_data["payment"],
         )
-        utils.set_payment_method_states(order, request, new_states)
+        with utils.payment_state_conflicts_retryable():
+            utils.set_payment_method_states(order, request, new_states)
 
         # Return order data
         o_ser = OrderSerializer(order, context={"request": request})
@@ -134,7 +190,7 @@ class CheckoutView(generics.GenericAPIView[Any]):
 
     def _record_payments(
         self,
-        previous_states: dict[str, PaymentStatus],
+        previous_states: Mapping[str, PaymentStatus],
         request: Request,
         order: Order,
         methods: dict[str, PaymentMethod[PaymentMethodData]],
@@ -143,6 +199,11 @@ class CheckoutView(generics.GenericAPIView[Any]):
         order_balance = [order.total_incl_tax]
         new_states: dict[str, PaymentStatus] = {}
 
+        # When retrying payment, the order already has sources. Fetch them all at once,
+        # rather than once per payment method.
+        if previous_states and len(data) > 1:
+            prefetch_order_sources(order)
+
         def record(method_key: str, method_data: PaymentMethodData) -> PaymentStatus:
             # If a previous payment method at least partially succeeded, hasn't been consumed by an
             # order, and is for the same amount, recycle it. This requires that the amount hasn't changed.
@@ -205,7 +266,7 @@ class CompleteDeferredPaymentView(CheckoutView):
         request.session[CHECKOUT_ORDER_ID] = order.id
 
         # Save payment steps into session for processing
-        previous_states = utils.list_payment_method_states(request)
+        previous_states = utils.list_payment_method_states(request, order=order)
         new_states = self._record_payments(
             previous_states=previous_states,
             request=request,
@@ -213,7 +274,8 @@ class CompleteDeferredPaymentView(CheckoutView):
             methods=c_ser.fields["payment"].methods,  # type:ignore[attr-defined]
             data=c_ser.validated_data["payment"],
         )
-        utils.set_payment_method_states(order, request, new_states)
+        with utils.payment_state_conflicts_retryable():
+            utils.set_payment_method_states(order, request, new_states)
 
         # Return order data
         o_ser = OrderSerializer(order, context={"request": request})
@@ -231,7 +293,7 @@ class PaymentStatesView(generics.GenericAPIView[Any]):
         order = get_object_or_404(Order, pk=pk)
 
         # Return order status and payment states
-        states = utils.list_payment_method_states(request)
+        states = utils.list_payment_method_states(request, order=order)
         state_data = {}
         for key, state in states.items():
             ser = PaymentStateSerializer(instance=state)
@@ -65,8 +65,7 @@ class ClientSideCard(PaymentMethod[PaymentMethodData]):
 
         source.allocate(amount, reference=reference, status="ACCEPTED")
         event = self.make_authorize_event(order, amount, reference)
-        for line in order.lines.all():
-            self.make_event_quantity(event, line, line.quantity)
+        self.make_order_event_quantities(event, order)
 
         return Complete(amount, source_id=source.pk)
 
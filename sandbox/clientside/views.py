@@ -35,10 +35,12 @@ class CompleteClientSidePaymentView(generics.GenericAPIView[Any]):
         new_state: PaymentStatus
         if data.get("deny"):
             new_state = ClientSideCard().record_declined_authorization(order, amount, reference="")
-            utils.update_payment_method_state(order, request, method_key, new_state)
+            with utils.payment_state_conflicts_retryable():
+                utils.update_payment_method_state(order, request, method_key, new_state)
             return Response({"status": "Declined"})
 
         reference = data.get("result_token", "")
         new_state = ClientSideCard().record_successful_authorization(order, amount, reference)
-        utils.update_payment_method_state(order, request, method_key, new_state)
+        with utils.payment_state_conflicts_retryable():
+            utils.update_payment_method_state(order, request, method_key, new_state)
         return Response({"status": "Success"})
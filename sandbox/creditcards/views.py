@@ -35,7 +35,8 @@ class GetCardTokenView(generics.GenericAPIView[Any]):
 
         # Decline the payment
         if data.get("deny"):
-            utils.mark_payment_method_declined(order, request, method_key, data["amount"])
+            with utils.payment_state_conflicts_retryable():
+                utils.mark_payment_method_declined(order, request, method_key, data["amount"])
             return Response(
                 {
                     "status": "Declined",
@@ -44,7 +45,8 @@ class GetCardTokenView(generics.GenericAPIView[Any]):
 
         # Require the client to do another form post
         new_state = CreditCard().require_authorization_post(order, method_key, amount)
-        utils.update_payment_method_state(order, request, method_key, new_state)
+        with utils.payment_state_conflicts_retryable():
+            utils.update_payment_method_state(order, request, method_key, new_state)
         return Response(
             {
                 "status": "Success",
@@ -73,7 +75,8 @@ class AuthorizeCardView(generics.GenericAPIView[Any]):
         # Decline the payment
         if data.get("deny"):
             new_state = CreditCard().record_declined_authorization(order, amount, reference)
-            utils.update_payment_method_state(order, request, method_key, new_state)
+            with utils.payment_state_conflicts_retryable():
+                utils.update_payment_method_state(order, request, method_key, new_state)
             return Response(
                 {
                     "status": "Declined",
@@ -82,7 +85,8 @@ class AuthorizeCardView(generics.GenericAPIView[Any]):
 
         # Record the funds allocation
         new_state = CreditCard().record_successful_authorization(order, amount, reference)
-        utils.update_payment_method_state(order, request, method_key, new_state)
+        with utils.payment_state_conflicts_retryable():
+            utils.update_payment_method_state(order, request, method_key, new_state)
         return Response(
             {
                 "status": "Success",